@@ -29,12 +29,17 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """``cacheutils`` contains consistent implementations of fundamental
-cache types. Currently there are two to choose from:
+cache types. Currently there are seven to choose from:
 
   * :class:`LRI` - Least-recently inserted
   * :class:`LRU` - Least-recently used
+  * :class:`TTLCache` - Least-recently inserted, with time-based expiry
+  * :class:`TinyLFU` - Scan-resistant, frequency-aware admission
+  * :class:`ShardedLRU` - Lock-striped LRU for multithreaded use
+  * :class:`TieredCache` - In-memory LRU backed by an on-disk store
+  * :class:`SharedCache` - Approximate LRU shared between processes
 
-Both caches are :class:`dict` subtypes, designed to be as
+The first four caches are :class:`dict` subtypes, designed to be as
 interchangeable as possible, to facilitate experimentation. A key
 practice with performance enhancement with caching is ensuring that
 the caching strategy is working. If the cache is constantly missing,
@@ -52,24 +57,36 @@ statistics are:
     ``miss_count``.
 
 Additionally, ``cacheutils`` provides :class:`ThresholdCounter`, a
-cache-like bounded counter useful for online statistics collection.
+cache-like bounded counter useful for online statistics collection,
+and :class:`SpaceSavingCounter`, its fixed-size counterpart.
 
 Learn more about `caching algorithms on Wikipedia
 <https://en.wikipedia.org/wiki/Cache_algorithms#Examples>`_.
 
 """
 
-# TODO: TimedLRI
 # TODO: support 0 max_size?
 
 
+import os
+import mmap
+import bisect
+import time
 import heapq
+import struct
+import pickle
+import sqlite3
+import hashlib
+import inspect
 import weakref
 import itertools
 from operator import attrgetter
+from functools import partial
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
 
 try:
-    from threading import RLock
+    from threading import RLock, Event
 except Exception:
     class RLock:
         'Dummy reentrant lock for builds without threads'
@@ -79,11 +96,160 @@ except Exception:
         def __exit__(self, exctype, excinst, exctb):
             pass
 
+    class Event:
+        'Dummy event for builds without threads, never waits'
+        def set(self):
+            pass
+
+        def wait(self, timeout=None):
+            return True
+
 _MISSING = object()
-_KWARG_MARK = object()
+_object_hash = object.__hash__
+
+
+class _KwargMark:
+    # separates positional and keyword arguments in cache keys, and
+    # pickles by name, so that serialized keys load back equal
+    __slots__ = ()
+
+    def __repr__(self):
+        return '_KWARG_MARK'
+
+    def __reduce__(self):
+        return '_KWARG_MARK'
+
+
+_KWARG_MARK = _KwargMark()
+
+# names for the fields of the list-based links used before _Link. no
+# longer used here, but kept for code which imported them.
+PREV, NEXT, KEY, VALUE = range(4)
+
+
+class _Link:
+    # a node in the LRI's doubly linked list. slotted objects are
+    # about a third smaller than the four-item lists used before, and
+    # their fields are as quick to access.
+    __slots__ = ('prev', 'next', 'key', 'value')
+
+    def __init__(self, prev, next, key, value):
+        self.prev = prev
+        self.next = next
+        self.key = key
+        self.value = value
+
+
+class _ExpiringLink(_Link):
+    # a link which also carries its item's deadline, for TTLCache
+    __slots__ = ('expires',)
+
+    def __init__(self, prev, next, key, value, expires=None):
+        super().__init__(prev, next, key, value)
+        self.expires = expires
+
 
-PREV, NEXT, KEY, VALUE = range(4)   # names for the link fields
 DEFAULT_MAX_SIZE = 128
+DEFAULT_SHARD_COUNT = 16
+DEFAULT_TTL = 60
+DEFAULT_NEGATIVE_TTL = 10
+
+# eviction reasons, as passed to on_evict hooks
+EVICT_CAPACITY = 'capacity'   # the cache was at max_size
+EVICT_WEIGHT = 'weight'       # the cache was over max_weight
+EVICT_EXPIRED = 'expired'     # the item's ttl ran out
+EVICT_REJECTED = 'rejected'   # the item was not admitted (TinyLFU), or
+                              # was heavier than max_weight on its own
+
+
+def _combine_evict_hooks(*hooks):
+    hooks = [hook for hook in hooks if hook is not None]
+    if len(hooks) < 2:
+        return hooks[0] if hooks else None
+
+    def _on_evict(key, value, reason):
+        for hook in hooks:
+            hook(key, value, reason)
+    return _on_evict
+
+
+def _fill_misses(cache, hits, misses):
+    # the second half of get_many(), filling in missing keys with
+    # on_miss_many() or on_miss(), outside of the cache's lock
+    if not misses:
+        return hits, misses
+    on_miss_complete = getattr(cache.stats, 'on_miss_complete', None)
+    if cache.on_miss_many:
+        start = time.perf_counter()
+        found = dict(cache.on_miss_many(misses))
+        if on_miss_complete is not None:
+            # the batch's time is split evenly between its keys
+            elapsed = (time.perf_counter() - start) / len(misses)
+            for key in misses:
+                on_miss_complete(key, elapsed)
+    elif cache.on_miss:
+        if on_miss_complete is None:
+            found = {key: cache.on_miss(key) for key in misses}
+        else:
+            found = {}
+            for key in misses:
+                start = time.perf_counter()
+                found[key] = cache.on_miss(key)
+                on_miss_complete(key, time.perf_counter() - start)
+    else:
+        return hits, misses
+    cache.set_many(found)
+    hits.update(found)
+    return hits, [key for key in misses if key not in found]
+
+
+SNAPSHOT_FORMAT = 1
+
+
+def _write_snapshot(file, header, records, protocol):
+    # a snapshot is a stream of pickles, a header dict followed by one
+    # record per item, so neither saving nor loading needs the whole
+    # file in memory at once.
+    if not isinstance(file, (str, os.PathLike)):
+        pickle.dump(header, file, protocol)
+        for record in records:
+            pickle.dump(record, file, protocol)
+        return
+    # paths are written to a temporary file and moved into place, so
+    # a crash mid-save never leaves a truncated snapshot behind
+    tmp_path = '%s.%s.tmp' % (os.fspath(file), os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            _write_snapshot(f, header, records, protocol)
+        os.replace(tmp_path, file)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _read_snapshot(file):
+    # yields the header, once it has been checked, then each record,
+    # reading them from the file one at a time. records are read with
+    # pickle.load, which can run arbitrary code, so snapshots must
+    # only ever come from a trusted source.
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as f:
+            yield from _read_snapshot(f)
+        return
+    header = pickle.load(file)
+    if not isinstance(header, dict) or 'snapshot_format' not in header:
+        raise ValueError('expected a cache snapshot, not %r' % (file,))
+    if header['snapshot_format'] > SNAPSHOT_FORMAT:
+        raise ValueError('unsupported snapshot format: %r'
+                         % header['snapshot_format'])
+    yield header
+    while True:
+        try:
+            record = pickle.load(file)
+        except EOFError:
+            return
+        yield record
 
 
 class LRI(dict):
@@ -107,9 +273,32 @@ class LRI(dict):
     None
     >>> cap_cache.hit_count, cap_cache.miss_count, cap_cache.soft_miss_count
     (3, 1, 1)
+
+    Caches can also be bounded by the combined size of their values,
+    rather than only their number, by passing *max_weight* and a
+    *weigher*, a callable which accepts a key and value and returns a
+    nonnegative number. The least recently inserted items are evicted
+    until the total weight fits, and the current total is available as
+    ``total_weight``. A *weigher* alone tracks ``total_weight`` without
+    limiting it. An item heavier than *max_weight* on its own is not
+    cached at all, and is passed to *on_evict* as ``'rejected'``.
+
+    >>> text_cache = LRI(max_size=100, max_weight=10,
+    ...                  weigher=lambda key, value: len(value))
+    >>> text_cache['a'], text_cache['b'] = 'aaaa', 'bbbb'
+    >>> text_cache.total_weight
+    8
+    >>> text_cache['c'] = 'cccc'
+    >>> sorted(text_cache.keys()), text_cache.total_weight
+    (['b', 'c'], 8)
     """
+    # the shape of the records in this type's snapshots, which only
+    # caches with the same shape can load
+    _snapshot_records = 'items'
+
     def __init__(self, max_size=DEFAULT_MAX_SIZE, values=None,
-                 on_miss=None):
+                 on_miss=None, max_weight=None, weigher=None,
+                 on_miss_many=None, on_evict=None, stats=None):
         if max_size <= 0:
             raise ValueError('expected max_size > 0, not %r' % max_size)
         self.hit_count = self.miss_count = self.soft_miss_count = 0
@@ -121,22 +310,65 @@ class LRI(dict):
             raise TypeError('expected on_miss to be a callable'
                             ' (or None), not %r' % on_miss)
         self.on_miss = on_miss
+        if on_miss_many is not None and not callable(on_miss_many):
+            raise TypeError('expected on_miss_many to be a callable'
+                            ' (or None), not %r' % on_miss_many)
+        self.on_miss_many = on_miss_many
+        self._init_hooks(on_evict, stats)
+
+        if weigher is not None and not callable(weigher):
+            raise TypeError('expected weigher to be a callable'
+                            ' (or None), not %r' % weigher)
+        if max_weight is not None:
+            if weigher is None:
+                raise TypeError('expected a weigher to go with max_weight')
+            if max_weight <= 0:
+                raise ValueError('expected max_weight > 0, not %r'
+                                 % max_weight)
+        self.max_weight = max_weight
+        self.weigher = weigher
+        self.total_weight = 0
+        self._weight_map = {} if weigher is not None else None
 
         if values:
             self.update(values)
 
     # TODO: fromkeys()?
 
+    def _init_hooks(self, on_evict, stats):
+        if on_evict is not None and not callable(on_evict):
+            raise TypeError('expected on_evict to be a callable'
+                            ' (or None), not %r' % on_evict)
+        self.on_evict = on_evict
+        self.stats = stats
+        # hooks are looked up once here, so that a disabled hook only
+        # costs a None check
+        self._on_hit = getattr(stats, 'on_hit', None)
+        self._on_miss_complete = getattr(stats, 'on_miss_complete', None)
+        self._on_evict = _combine_evict_hooks(on_evict,
+                                              getattr(stats, 'on_evict', None))
+
+    def _fill_miss(self, key):
+        # call on_miss for a missing key and cache the result
+        if self._on_miss_complete is None:
+            ret = self[key] = self.on_miss(key)
+            return ret
+        start = time.perf_counter()
+        ret = self.on_miss(key)
+        self._on_miss_complete(key, time.perf_counter() - start)
+        self[key] = ret
+        return ret
+
     # linked list manipulation methods.
     #
     # invariants:
     # 1) 'anchor' is the sentinel node in the doubly linked list.  there is
-    #    always only one, and its KEY and VALUE are both _MISSING.
+    #    always only one, and its key and value are both _MISSING.
     # 2) the most recently accessed node comes immediately before 'anchor'.
     # 3) the least recently accessed node comes immediately after 'anchor'.
     def _init_ll(self):
-        anchor = []
-        anchor[:] = [anchor, anchor, _MISSING, _MISSING]
+        anchor = _Link(None, None, _MISSING, _MISSING)
+        anchor.prev = anchor.next = anchor
         # a link lookup table for finding linked list links in O(1)
         # time.
         self._link_lookup = {}
@@ -153,8 +385,8 @@ class LRI(dict):
         flattened_list = []
         link = self._anchor
         while True:
-            flattened_list.append((link[KEY], link[VALUE]))
-            link = link[NEXT]
+            flattened_list.append((link.key, link.value))
+            link = link.next
             if link is self._anchor:
                 break
         return flattened_list
@@ -165,25 +397,25 @@ class LRI(dict):
         newest = self._link_lookup[key]
 
         # splice out what will become the newest link.
-        newest[PREV][NEXT] = newest[NEXT]
-        newest[NEXT][PREV] = newest[PREV]
+        newest.prev.next = newest.next
+        newest.next.prev = newest.prev
 
         # move what will become the newest link immediately before
         # anchor (invariant 2)
         anchor = self._anchor
-        second_newest = anchor[PREV]
-        second_newest[NEXT] = anchor[PREV] = newest
-        newest[PREV] = second_newest
-        newest[NEXT] = anchor
+        second_newest = anchor.prev
+        second_newest.next = anchor.prev = newest
+        newest.prev = second_newest
+        newest.next = anchor
         return newest
 
     def _set_key_and_add_to_front_of_ll(self, key, value):
         # create a new link and place it immediately before anchor
         # (invariant 2).
         anchor = self._anchor
-        second_newest = anchor[PREV]
-        newest = [second_newest, anchor, key, value]
-        second_newest[NEXT] = anchor[PREV] = newest
+        second_newest = anchor.prev
+        newest = _Link(second_newest, anchor, key, value)
+        second_newest.next = anchor.prev = newest
         self._link_lookup[key] = newest
 
     def _set_key_and_evict_last_in_ll(self, key, value):
@@ -194,36 +426,99 @@ class LRI(dict):
         # (invariant 2).  no links are moved; only their keys
         # and values are changed.
         oldanchor = self._anchor
-        oldanchor[KEY] = key
-        oldanchor[VALUE] = value
+        oldanchor.key = key
+        oldanchor.value = value
 
-        self._anchor = anchor = oldanchor[NEXT]
-        evicted = anchor[KEY]
-        anchor[KEY] = anchor[VALUE] = _MISSING
+        self._anchor = anchor = oldanchor.next
+        evicted = anchor.key
+        anchor.key = anchor.value = _MISSING
         del self._link_lookup[evicted]
         self._link_lookup[key] = oldanchor
+        if self._weight_map is not None:
+            self.total_weight -= self._weight_map.pop(evicted)
         return evicted
 
     def _remove_from_ll(self, key):
         # splice a link out of the list and drop it from our lookup
         # table.
         link = self._link_lookup.pop(key)
-        link[PREV][NEXT] = link[NEXT]
-        link[NEXT][PREV] = link[PREV]
+        link.prev.next = link.next
+        link.next.prev = link.prev
+        if self._weight_map is not None:
+            self.total_weight -= self._weight_map.pop(key)
+
+    # weight tracking methods, only used when there is a weigher. the
+    # weight is computed before the cache is modified, so a failing
+    # weigher leaves the cache untouched.
+    def _weigh(self, key, value):
+        weight = self.weigher(key, value)
+        if weight < 0:
+            raise ValueError('expected weigher to return a weight >= 0,'
+                             ' not %r' % (weight,))
+        return weight
+
+    def _reject_overweight(self, key, value, weight):
+        # an item heavier than max_weight on its own would evict every
+        # other item before being evicted itself, so it is not stored
+        # at all. any older value for the key is dropped with it.
+        if self.max_weight is None or weight <= self.max_weight:
+            return False
+        if key in self._link_lookup:
+            self._remove_from_ll(key)
+            dict.__delitem__(self, key)
+        if self._on_evict is not None:
+            self._on_evict(key, value, EVICT_REJECTED)
+        return True
+
+    def _add_weight(self, key, weight):
+        weight_map = self._weight_map
+        self.total_weight += weight - weight_map.get(key, 0)
+        weight_map[key] = weight
+        if self.max_weight is None:
+            return
+        anchor = self._anchor
+        while self.total_weight > self.max_weight:
+            # evict from the cold end (invariant 3). while loading a
+            # snapshot, this can include the item just loaded.
+            evicted = anchor.next.key
+            self._remove_from_ll(evicted)
+            evicted_value = dict.pop(self, evicted)
+            if self._on_evict is not None:
+                self._on_evict(evicted, evicted_value, EVICT_WEIGHT)
+        return
+
+    # item access methods which expect the lock to be held, shared by
+    # the single-item and bulk APIs.
+    def _set_item(self, key, value):
+        if self.weigher is not None:
+            weight = self._weigh(key, value)
+            if self._reject_overweight(key, value, weight):
+                return
+        evicted = _MISSING
+        try:
+            link = self._get_link_and_move_to_front_of_ll(key)
+        except KeyError:
+            if len(self) < self.max_size:
+                self._set_key_and_add_to_front_of_ll(key, value)
+            else:
+                evicted = self._set_key_and_evict_last_in_ll(key, value)
+                evicted_value = dict.pop(self, evicted)
+        else:
+            link.value = value
+        dict.__setitem__(self, key, value)
+        if evicted is not _MISSING and self._on_evict is not None:
+            self._on_evict(evicted, evicted_value, EVICT_CAPACITY)
+        if self.weigher is not None:
+            self._add_weight(key, weight)
+        return
+
+    def _get_hit_value(self, key):
+        # raises KeyError on misses, without counting them
+        return self._link_lookup[key].value
 
     def __setitem__(self, key, value):
         with self._lock:
-            try:
-                link = self._get_link_and_move_to_front_of_ll(key)
-            except KeyError:
-                if len(self) < self.max_size:
-                    self._set_key_and_add_to_front_of_ll(key, value)
-                else:
-                    evicted = self._set_key_and_evict_last_in_ll(key, value)
-                    super().__delitem__(evicted)
-            else:
-                link[VALUE] = value
-            super().__setitem__(key, value)
+            self._set_item(key, value)
         return
 
     def __getitem__(self, key):
@@ -234,11 +529,12 @@ class LRI(dict):
                 self.miss_count += 1
                 if not self.on_miss:
                     raise
-                ret = self[key] = self.on_miss(key)
-                return ret
+                return self._fill_miss(key)
 
             self.hit_count += 1
-            return link[VALUE]
+            if self._on_hit is not None:
+                self._on_hit(key)
+            return link.value
 
     def get(self, key, default=None):
         try:
@@ -275,9 +571,17 @@ class LRI(dict):
         with self._lock:
             super().clear()
             self._init_ll()
+            if self._weight_map is not None:
+                self._weight_map.clear()
+                self.total_weight = 0
 
     def copy(self):
-        return self.__class__(max_size=self.max_size, values=self)
+        return self.__class__(max_size=self.max_size, values=self,
+                              on_miss=self.on_miss,
+                              max_weight=self.max_weight,
+                              weigher=self.weigher,
+                              on_miss_many=self.on_miss_many,
+                              on_evict=self.on_evict, stats=self.stats)
 
     def setdefault(self, key, default=None):
         with self._lock:
@@ -293,7 +597,11 @@ class LRI(dict):
         with self._lock:
             if E is self:
                 return
-            setitem = self.__setitem__
+            # subtypes overriding __setitem__ get it called for each item
+            if type(self).__setitem__ is LRI.__setitem__:
+                setitem = self._set_item
+            else:
+                setitem = self.__setitem__
             if callable(getattr(E, 'keys', None)):
                 for k in E.keys():
                     setitem(k, E[k])
@@ -304,6 +612,185 @@ class LRI(dict):
                 setitem(k, F[k])
             return
 
+    def get_many(self, keys):
+        """Look up several *keys* at once, taking the cache's lock only
+        once. Returns a tuple of a dict mapping the keys found to their
+        values, and a list of the keys not found.
+
+        >>> cache = LRI(on_miss_many=lambda keys: {k: k.upper() for k in keys
+        ...                                        if k != 'c'})
+        >>> cache['a'] = 'A'
+        >>> hits, misses = cache.get_many(['a', 'b', 'c'])
+        >>> sorted(hits.items()), misses
+        ([('a', 'A'), ('b', 'B')], ['c'])
+        >>> cache.hit_count, cache.miss_count
+        (1, 2)
+
+        Missing keys are passed, as a list, to *on_miss_many*, which
+        returns a mapping of the keys it could find to their values.
+        These are added to the cache and the returned hits. Without
+        *on_miss_many*, *on_miss* is called for each missing key.
+        Either way, the callable is called without the lock held, and
+        each missing key counts toward ``miss_count``.
+        """
+        hits, misses = self._lookup_many(keys)
+        return _fill_misses(self, hits, misses)
+
+    def _lookup_many(self, keys):
+        hits, misses = {}, {}
+        hit_count = 0
+        with self._lock:
+            get_hit_value = self._get_hit_value
+            for key in keys:
+                try:
+                    hits[key] = get_hit_value(key)
+                    hit_count += 1
+                except KeyError:
+                    misses[key] = None
+            self.hit_count += hit_count
+            self.miss_count += len(misses)
+            if self._on_hit is not None:
+                for key in hits:
+                    self._on_hit(key)
+        return hits, list(misses)
+
+    def set_many(self, items):
+        """Set several items at once, taking the cache's lock only once.
+        *items* can be a mapping or an iterable of key-value pairs.
+        """
+        self.update(items)
+
+    def delete_many(self, keys):
+        """Remove several *keys* at once, taking the cache's lock only
+        once. Keys not in the cache are ignored. Returns the number of
+        items removed.
+        """
+        ret = 0
+        with self._lock:
+            for key in keys:
+                if dict.__contains__(self, key):
+                    dict.__delitem__(self, key)
+                    self._remove_from_ll(key)
+                    ret += 1
+        return ret
+
+    def save_snapshot(self, file, protocol=4):
+        """Save the cache's items to *file*, a path or a file opened in
+        binary mode, from least- to most-recently used (or inserted),
+        for :meth:`load_snapshot` to warm up a cache later, e.g.,
+        after a restart. Returns the number of items saved.
+
+        >>> import io
+        >>> cache, f = LRU(max_size=3), io.BytesIO()
+        >>> cache['a'], cache['b'], cache['c'] = 'A', 'B', 'C'
+        >>> cache['a']
+        'A'
+        >>> cache.save_snapshot(f)
+        3
+        >>> _ = f.seek(0)
+        >>> new_cache = LRU(max_size=3)
+        >>> new_cache.load_snapshot(f)
+        3
+        >>> new_cache['d'] = 'D'  # 'b' is still the least recently used
+        >>> sorted(new_cache)
+        ['a', 'c', 'd']
+
+        Keys and values are serialized with :mod:`pickle`, using
+        *protocol*. Items are written one at a time, straight from the
+        cache, so saving takes no more memory than the file's buffer,
+        but the cache's lock is held until the snapshot is written.
+        Paths are written to a temporary file first, then renamed, so
+        an existing snapshot is only replaced by a complete one.
+        """
+        with self._lock:
+            count, records = self._get_snapshot_records()
+            header = {'snapshot_format': SNAPSHOT_FORMAT,
+                      'type': self.__class__.__name__,
+                      'records': self._snapshot_records,
+                      'count': count,
+                      'saved_at': time.time()}
+            _write_snapshot(file, header, records, protocol)
+        return count
+
+    def load_snapshot(self, file):
+        """Load items saved by :meth:`save_snapshot` from *file*, a path
+        or a file opened in binary mode, keeping their recency order.
+        Returns the number of items loaded.
+
+        Loaded items are older than any already in the cache, so
+        existing keys are not overwritten, and when the cache fills,
+        the oldest loaded items are dropped first. Items are read one
+        at a time, and added while the cache's lock is held just once.
+
+        Snapshots can only be loaded by caches of the same kind as the
+        one which saved them, e.g., an :class:`LRU` snapshot by an
+        :class:`LRI` or :class:`LRU`, but not a :class:`TTLCache`, and
+        a :exc:`ValueError` is raised before any items are loaded
+        otherwise. Snapshots are read with :func:`pickle.load`, which
+        can run arbitrary code, so only load snapshots from a trusted
+        source.
+        """
+        records = _read_snapshot(file)
+        try:
+            header = next(records)
+            if header.get('records') != self._snapshot_records:
+                raise ValueError('cannot load a %s snapshot into a %s'
+                                 % (header.get('type'),
+                                    self.__class__.__name__))
+            with self._lock:
+                return self._load_records(records)
+        finally:
+            records.close()
+
+    def _get_snapshot_records(self):
+        # the number of records, and a generator of (key, value) pairs,
+        # from the cold end to the hot end (invariant 3). called with
+        # the lock held, which must be kept until the records are used.
+        def _iter_records(anchor):
+            link = anchor.next
+            while link is not anchor:
+                yield link.key, link.value
+                link = link.next
+        return len(self), _iter_records(self._anchor)
+
+    def _load_records(self, records):
+        # loaded links go on the cold side of existing ones, in order,
+        # each right after the last one loaded
+        ret = 0
+        link_lookup = self._link_lookup
+        cursor = self._anchor
+        for key, value in records:
+            if key in link_lookup:
+                continue
+            if self.weigher is not None:
+                weight = self._weigh(key, value)
+                if self._reject_overweight(key, value, weight):
+                    continue
+            if len(self) >= self.max_size:
+                if cursor is self._anchor:
+                    break  # full of existing items, which are newer
+                oldest = self._anchor.next
+                if oldest is cursor:
+                    cursor = self._anchor
+                evicted = oldest.key
+                self._remove_from_ll(evicted)
+                evicted_value = dict.pop(self, evicted)
+                if self._on_evict is not None:
+                    self._on_evict(evicted, evicted_value, EVICT_CAPACITY)
+            link = _Link(cursor, cursor.next, key, value)
+            cursor.next.prev = link
+            cursor.next = link
+            link_lookup[key] = link
+            dict.__setitem__(self, key, value)
+            ret += 1
+            cursor = link
+            if self.weigher is not None:
+                self._add_weight(key, weight)
+                if link_lookup.get(key) is not link:
+                    # outweighed, along with any items loaded before it
+                    cursor = self._anchor
+        return ret
+
     def __eq__(self, other):
         with self._lock:
             if self is other:
@@ -333,6 +820,28 @@ class LRU(LRI):
         values (iterable): Initial values for the cache. Defaults to ``None``.
         on_miss (callable): a callable which accepts a single argument, the
             key not present in the cache, and returns the value to be cached.
+        max_weight (number): Max total weight of the items in the
+            cache, as computed by *weigher*. Defaults to ``None``, for
+            no weight limit.
+        weigher (callable): a callable which accepts a key and value,
+            and returns the nonnegative weight of the item, e.g., its
+            size in bytes. Required for *max_weight*.
+        on_miss_many (callable): a callable which accepts a list of
+            keys missing from a :meth:`~LRI.get_many` call, and returns
+            a mapping of those it could find to their values.
+        on_evict (callable): a callable which accepts the key and
+            value of each item evicted from the cache, along with the
+            reason, one of ``'capacity'``, ``'weight'``, ``'expired'``
+            (:class:`TTLCache`) or ``'rejected'`` (:class:`TinyLFU`, or
+            items heavier than *max_weight*).
+            Items removed with ``del`` or :meth:`pop` are not evictions.
+            It is called while the cache's lock is held, so it should
+            be quick, and may not block on other threads using the cache.
+        stats (CacheStats): An object receiving events about cache
+            activity. It may define any of ``on_hit(key)``,
+            ``on_miss_complete(key, elapsed)``, called after *on_miss*
+            with the number of seconds it took, and ``on_evict(key,
+            value, reason)``. See :class:`CacheStats`.
 
     >>> cap_cache = LRU(max_size=2)
     >>> cap_cache['a'], cap_cache['b'] = 'A', 'B'
@@ -355,9 +864,15 @@ class LRU(LRI):
     >>> cap_cache.hit_count, cap_cache.miss_count, cap_cache.soft_miss_count
     (3, 1, 1)
 
+    When weighing items, evictions start with the least-recently
+    used item, until the ``total_weight`` is within *max_weight*.
+
     Other than the size-limiting caching behavior and statistics,
     ``LRU`` acts like its parent class, the built-in Python :class:`dict`.
     """
+    def _get_hit_value(self, key):
+        return self._get_link_and_move_to_front_of_ll(key).value
+
     def __getitem__(self, key):
         with self._lock:
             try:
@@ -366,78 +881,2033 @@ class LRU(LRI):
                 self.miss_count += 1
                 if not self.on_miss:
                     raise
-                ret = self[key] = self.on_miss(key)
-                return ret
+                return self._fill_miss(key)
 
             self.hit_count += 1
-            return link[VALUE]
+            if self._on_hit is not None:
+                self._on_hit(key)
+            return link.value
 
 
-### Cached decorator
-# Key-making technique adapted from Python 3.4's functools
+class TTLCache(LRI):
+    """The ``TTLCache`` is an :class:`LRI` whose items also expire
+    *ttl* seconds after they were last set.
 
-class _HashedKey(list):
-    """The _HashedKey guarantees that hash() will be called no more than once
-    per cached function invocation.
+    Args:
+        max_size (int): Max number of items to cache. Defaults to ``128``.
+        ttl (float): Number of seconds an item stays valid after it
+            is set. Defaults to ``60``.
+        values (iterable): Initial values for the cache. Defaults to ``None``.
+        on_miss (callable): a callable which accepts a single argument, the
+            key not present in the cache, and returns the value to be cached.
+        timer (callable): The clock used for deadlines, defaults to
+            :func:`time.monotonic`.
+        max_weight (number): Max total weight of the items in the
+            cache, as with :class:`LRU`.
+        weigher (callable): Computes item weights, as with :class:`LRU`.
+
+    >>> now = [0]
+    >>> cache = TTLCache(max_size=2, ttl=10, timer=lambda: now[0])
+    >>> cache['a'] = 'A'
+    >>> cache['a']
+    'A'
+    >>> now[0] = 15
+    >>> print(cache.get('a'))
+    None
+    >>> cache.hit_count, cache.miss_count, cache.expired_count
+    (1, 1, 1)
+
+    Each link in the cache's linked list carries the deadline of its
+    item. Because every item gets the same *ttl*, and setting an item
+    moves it to the front of the list, the list is always ordered by
+    deadline. Expired items are evicted lazily when they are
+    accessed, and proactively from the cold end of the list whenever
+    an item is set, so a sweep never visits more than the expired
+    items themselves. Call :meth:`expire` to sweep on demand.
+
+    In addition to the usual ``hit_count``, ``miss_count``, and
+    ``soft_miss_count``, ``expired_count`` tracks how many items have
+    been evicted because their time ran out. Accessing an expired
+    item counts as a miss.
+
+    Note that :func:`len` and iteration include items which have
+    expired but have not yet been swept.
+
+    Snapshots saved with :meth:`~LRI.save_snapshot` record deadlines
+    as wall clock times, so that :meth:`~LRI.load_snapshot` can skip
+    items which expired in the meantime, and keep the rest expiring
+    on schedule, but no later than this cache's *ttl* allows.
     """
-    __slots__ = 'hash_value'
+    _snapshot_records = 'deadlines'
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL,
+                 values=None, on_miss=None, timer=time.monotonic,
+                 max_weight=None, weigher=None, on_miss_many=None,
+                 on_evict=None, stats=None):
+        if ttl <= 0:
+            raise ValueError('expected ttl > 0, not %r' % ttl)
+        self.ttl = ttl
+        self.expired_count = 0
+        self._timer = timer
+        super().__init__(max_size=max_size, values=values, on_miss=on_miss,
+                         max_weight=max_weight, weigher=weigher,
+                         on_miss_many=on_miss_many, on_evict=on_evict,
+                         stats=stats)
+
+    def _init_ll(self):
+        anchor = _ExpiringLink(None, None, _MISSING, _MISSING)
+        anchor.prev = anchor.next = anchor
+        self._link_lookup = {}
+        self._anchor = anchor
+
+    def _set_key_and_add_to_front_of_ll(self, key, value):
+        anchor = self._anchor
+        second_newest = anchor.prev
+        newest = _ExpiringLink(second_newest, anchor, key, value)
+        second_newest.next = anchor.prev = newest
+        self._link_lookup[key] = newest
+
+    def _expire_cold(self, now):
+        # the list is ordered by deadline, oldest after the anchor
+        # (invariant 3), so stop at the first link still in date.
+        anchor = self._anchor
+        link = anchor.next
+        expired = [] if self._on_evict is not None else None
+        while link is not anchor and link.expires <= now:
+            next_link = link.next
+            key = link.key
+            del self._link_lookup[key]
+            dict.__delitem__(self, key)
+            if self._weight_map is not None:
+                self.total_weight -= self._weight_map.pop(key)
+            if expired is not None:
+                expired.append((key, link.value))
+            self.expired_count += 1
+            link = next_link
+        anchor.next = link
+        link.prev = anchor
+        if expired:
+            for key, value in expired:
+                self._on_evict(key, value, EVICT_EXPIRED)
+
+    def expire(self):
+        """Evict all expired items, returning the number of items
+        evicted.
+        """
+        with self._lock:
+            orig_count = self.expired_count
+            self._expire_cold(self._timer())
+            return self.expired_count - orig_count
+
+    def _set_item(self, key, value):
+        if self.weigher is not None:
+            weight = self._weigh(key, value)
+            if self._reject_overweight(key, value, weight):
+                return
+        now = self._timer()
+        self._expire_cold(now)
+        evicted = _MISSING
+        try:
+            link = self._get_link_and_move_to_front_of_ll(key)
+        except KeyError:
+            if len(self) < self.max_size:
+                self._set_key_and_add_to_front_of_ll(key, value)
+            else:
+                evicted = self._set_key_and_evict_last_in_ll(key, value)
+                evicted_value = dict.pop(self, evicted)
+            link = self._link_lookup[key]
+        else:
+            link.value = value
+        link.expires = now + self.ttl
+        dict.__setitem__(self, key, value)
+        if evicted is not _MISSING and self._on_evict is not None:
+            self._on_evict(evicted, evicted_value, EVICT_CAPACITY)
+        if self.weigher is not None:
+            self._add_weight(key, weight)
+        return
+
+    def _get_hit_value(self, key):
+        link = self._link_lookup[key]
+        now = self._timer()
+        if link.expires <= now:
+            # the expired link is at the cold end, so a regular sweep
+            # takes care of it
+            self._expire_cold(now)
+            raise KeyError(key)
+        return link.value
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                ret = self._get_hit_value(key)
+            except KeyError:
+                self.miss_count += 1
+                if not self.on_miss:
+                    raise
+                return self._fill_miss(key)
+
+            self.hit_count += 1
+            if self._on_hit is not None:
+                self._on_hit(key)
+            return ret
+
+    def __contains__(self, key):
+        with self._lock:
+            try:
+                link = self._link_lookup[key]
+            except KeyError:
+                return False
+            return link.expires > self._timer()
+
+    def pop(self, key, default=_MISSING):
+        with self._lock:
+            self._expire_cold(self._timer())
+            return super().pop(key, default)
+
+    def _get_snapshot_records(self):
+        # deadlines are saved as wall clock times, as the timer, e.g.,
+        # time.monotonic(), means nothing to another process
+        now = self._timer()
+        self._expire_cold(now)
+        offset = time.time() - now
+
+        def _iter_records(anchor):
+            link = anchor.next
+            while link is not anchor:
+                yield link.key, link.value, link.expires + offset
+                link = link.next
+        return len(self), _iter_records(self._anchor)
+
+    def _load_records(self, records):
+        # expired records are skipped, and the rest placed by deadline
+        # (invariant 3). records come in deadline order, so the
+        # insertion point only ever moves toward the hot end.
+        now = self._timer()
+        self._expire_cold(now)
+        offset = now - time.time()
+        ret = 0
+        link_lookup = self._link_lookup
+        anchor = cursor = self._anchor
+        for key, value, deadline in records:
+            expires = min(deadline + offset, now + self.ttl)
+            if expires <= now or key in link_lookup:
+                continue
+            if self.weigher is not None:
+                weight = self._weigh(key, value)
+                if self._reject_overweight(key, value, weight):
+                    continue
+            while (cursor.next is not anchor
+                   and cursor.next.expires <= expires):
+                cursor = cursor.next
+            if len(self) >= self.max_size:
+                if cursor is anchor:
+                    continue  # it would be the first to go
+                oldest = anchor.next
+                if oldest is cursor:
+                    cursor = anchor
+                evicted = oldest.key
+                self._remove_from_ll(evicted)
+                evicted_value = dict.pop(self, evicted)
+                if self._on_evict is not None:
+                    self._on_evict(evicted, evicted_value, EVICT_CAPACITY)
+            link = _ExpiringLink(cursor, cursor.next, key, value, expires)
+            cursor.next.prev = link
+            cursor.next = link
+            link_lookup[key] = link
+            dict.__setitem__(self, key, value)
+            ret += 1
+            cursor = link
+            if self.weigher is not None:
+                self._add_weight(key, weight)
+                if link_lookup.get(key) is not link:
+                    cursor = anchor
+        return ret
+
+    def copy(self):
+        # copies keep the original deadlines, rather than restarting
+        # the clock on every item
+        with self._lock:
+            self._expire_cold(self._timer())
+            ret = self._copy_empty()
+            anchor = link = self._anchor
+            while link.next is not anchor:
+                link = link.next
+                ret[link.key] = link.value
+                ret._link_lookup[link.key].expires = link.expires
+        return ret
+
+    def _copy_empty(self):
+        # an empty cache configured like this one, for copy()
+        return self.__class__(max_size=self.max_size, ttl=self.ttl,
+                              on_miss=self.on_miss, timer=self._timer,
+                              max_weight=self.max_weight,
+                              weigher=self.weigher,
+                              on_miss_many=self.on_miss_many,
+                              on_evict=self.on_evict, stats=self.stats)
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        val_map = dict.__repr__(self)
+        return ('%s(max_size=%r, ttl=%r, on_miss=%r, values=%s)'
+                % (cn, self.max_size, self.ttl, self.on_miss, val_map))
+
+
+_HALVE_TABLE = bytes([i >> 1 for i in range(256)])
+
+
+class _FrequencySketch:
+    """A compact Count-Min sketch of key access frequencies, used by
+    :class:`TinyLFU`. Each of the four rows holds one saturating
+    counter (max 15) per byte, and all counters are halved once the
+    number of additions reaches ten times the cache size, so that the
+    sketch favors recent popularity over ancient history.
+    """
+    _max_count = 15
+
+    def __init__(self, max_size):
+        width = 16
+        while width < max_size:
+            width <<= 1
+        self._width = width
+        self._mask = width - 1
+        self._table = bytearray(width * 4)
+        self._sample_size = 10 * max_size
+        self._additions = 0
+
+    def _indexes(self, key):
+        # one 64-bit multiplicative hash, split for double hashing
+        h = (hash(key) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        mask, width = self._mask, self._width
+        return (h1 & mask,
+                width + ((h1 + h2) & mask),
+                2 * width + ((h1 + 2 * h2) & mask),
+                3 * width + ((h1 + 3 * h2) & mask))
+
+    def increment(self, key):
+        table, max_count = self._table, self._max_count
+        added = False
+        for idx in self._indexes(key):
+            if table[idx] < max_count:
+                table[idx] += 1
+                added = True
+        if added:
+            self._additions += 1
+            if self._additions >= self._sample_size:
+                self._table = self._table.translate(_HALVE_TABLE)
+                self._additions //= 2
+        return
+
+    def estimate(self, key):
+        table = self._table
+        return min([table[idx] for idx in self._indexes(key)])
+
+    def restore(self, key, count):
+        # raises the key's counters to at least count, when loading a
+        # snapshot, without counting toward the sample size
+        table = self._table
+        count = min(count, self._max_count)
+        for idx in self._indexes(key):
+            if table[idx] < count:
+                table[idx] = count
+        return
+
+
+class TinyLFU(LRI):
+    """The ``TinyLFU`` is a scan-resistant cache implementing the
+    *W-TinyLFU* policy, as described in "TinyLFU: A Highly Efficient
+    Cache Admission Policy" by Einziger, Friedman & Manes, and
+    popularized by the Caffeine library.
+
+    Args:
+        max_size (int): Max number of items to cache. Defaults to ``128``.
+        values (iterable): Initial values for the cache. Defaults to ``None``.
+        on_miss (callable): a callable which accepts a single argument, the
+            key not present in the cache, and returns the value to be cached.
+        window_ratio (float): The share of *max_size* given to the
+            admission window. Defaults to ``0.01``.
+
+    >>> cache = TinyLFU(max_size=3)
+    >>> cache['a'] = 'A'
+    >>> [cache['a'] for i in range(3)][0]
+    'A'
+    >>> for key in 'wxyz':
+    ...     cache[key] = key.upper()
+    >>> 'a' in cache
+    True
+    >>> cache.hit_count, cache.miss_count, cache.soft_miss_count
+    (3, 0, 0)
+
+    New items enter a small LRU "window". Items falling off the
+    window are only admitted into the main cache if a compact
+    frequency sketch shows they have been requested more often than
+    the item the main cache would evict to make room. This keeps
+    one-off keys, such as those from a large batch scan, from
+    flushing frequently-used items. The main cache itself is a
+    segmented LRU, which promotes items accessed more than once into
+    a "protected" segment.
+
+    The ``TinyLFU`` has the same dict-like API, statistics, and
+    *on_miss* support as the :class:`LRI`, and works with
+    :func:`cached` and :func:`cachedmethod`. Snapshots saved with
+    :meth:`~LRI.save_snapshot` keep each item's segment, and its
+    estimated frequency.
+    """
+    _snapshot_records = 'segments'
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, values=None,
+                 on_miss=None, window_ratio=0.01, on_miss_many=None,
+                 on_evict=None, stats=None):
+        if not 0 < window_ratio < 1:
+            raise ValueError('expected window_ratio between 0 and 1, not %r'
+                             % window_ratio)
+        self.window_ratio = window_ratio
+        super().__init__(max_size=max_size, values=values, on_miss=on_miss,
+                         on_miss_many=on_miss_many, on_evict=on_evict,
+                         stats=stats)
+
+    # segment management methods. TinyLFU has no single linked list,
+    # instead each segment is an OrderedDict of keys, least-recently
+    # used first.
+    def _init_ll(self):
+        window_size = max(1, int(self.max_size * self.window_ratio))
+        self._window_size = window_size
+        self._main_size = self.max_size - window_size
+        self._protected_size = int(self._main_size * 0.8)
+        self._window = OrderedDict()
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._sketch = _FrequencySketch(self.max_size)
+        # keys which missed, and have not been set since. a miss
+        # counts as the key's access, so the set which usually follows
+        # to fill it in is not counted again.
+        self._missed = {}
+
+    def _get_flattened_ll(self):
+        return [(k, dict.__getitem__(self, k))
+                for seg in (self._window, self._probation, self._protected)
+                for k in seg]
+
+    def _remove_from_ll(self, key):
+        for segment in (self._protected, self._probation, self._window):
+            if key in segment:
+                del segment[key]
+                return
+        raise KeyError(key)
+
+    def _touch(self, key):
+        protected = self._protected
+        if key in protected:
+            protected.move_to_end(key)
+        elif key in self._probation:
+            del self._probation[key]
+            protected[key] = None
+            if len(protected) > self._protected_size:
+                demoted, _ = protected.popitem(last=False)
+                self._probation[demoted] = None
+        else:
+            self._window.move_to_end(key)
+
+    def _admit(self, candidate):
+        # called with the least-recently used key from the window
+        if len(self._probation) + len(self._protected) < self._main_size:
+            self._probation[candidate] = None
+            return
+        victim_segment = self._probation or self._protected
+        if victim_segment:
+            victim = next(iter(victim_segment))
+            sketch = self._sketch
+            if sketch.estimate(candidate) > sketch.estimate(victim):
+                del victim_segment[victim]
+                victim_value = dict.pop(self, victim)
+                self._probation[candidate] = None
+                if self._on_evict is not None:
+                    self._on_evict(victim, victim_value, EVICT_CAPACITY)
+                return
+        candidate_value = dict.pop(self, candidate)
+        if self._on_evict is not None:
+            self._on_evict(candidate, candidate_value, EVICT_REJECTED)
+
+    def _set_item(self, key, value):
+        try:
+            del self._missed[key]
+        except KeyError:
+            self._sketch.increment(key)
+        if dict.__contains__(self, key):
+            self._touch(key)
+            dict.__setitem__(self, key, value)
+            return
+        dict.__setitem__(self, key, value)
+        window = self._window
+        window[key] = None
+        if len(window) > self._window_size:
+            candidate, _ = window.popitem(last=False)
+            self._admit(candidate)
+        return
+
+    def _get_hit_value(self, key):
+        # misses count toward frequency, too
+        self._sketch.increment(key)
+        try:
+            ret = dict.__getitem__(self, key)
+        except KeyError:
+            missed = self._missed
+            missed[key] = None
+            if len(missed) > self.max_size:
+                del missed[next(iter(missed))]
+            raise
+        self._touch(key)
+        return ret
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                ret = self._get_hit_value(key)
+            except KeyError:
+                self.miss_count += 1
+                if not self.on_miss:
+                    raise
+                return self._fill_miss(key)
+
+            self.hit_count += 1
+            if self._on_hit is not None:
+                self._on_hit(key)
+            return ret
+
+    def copy(self):
+        return self.__class__(max_size=self.max_size, values=self,
+                              on_miss=self.on_miss,
+                              window_ratio=self.window_ratio,
+                              on_miss_many=self.on_miss_many,
+                              on_evict=self.on_evict, stats=self.stats)
+
+    def _get_snapshot_records(self):
+        # (key, value, segment, frequency) records, with segments
+        # numbered from the window (0) to the protected segment (2),
+        # each from least to most recently used. the sketch's hashes
+        # don't carry over to other processes, so each key's estimated
+        # frequency is saved instead.
+        segments = (self._window, self._probation, self._protected)
+        sketch = self._sketch
+
+        def _iter_records():
+            for seg_idx, segment in enumerate(segments):
+                for key in segment:
+                    yield (key, dict.__getitem__(self, key), seg_idx,
+                           sketch.estimate(key))
+        return len(self), _iter_records()
+
+    def _load_records(self, records):
+        # loaded keys go on the cold end of their segments, keeping the
+        # most recent of those which fit alongside the existing keys
+        segments = window, probation, protected = (
+            self._window, self._probation, self._protected)
+        main_room = self._main_size - len(probation) - len(protected)
+        rooms = (self._window_size - len(window), main_room,
+                 min(self._protected_size - len(protected), main_room))
+        loaded = [deque(maxlen=room) for room in rooms]
+        for key, value, seg_idx, frequency in records:
+            if not dict.__contains__(self, key):
+                loaded[seg_idx].append((key, value, frequency))
+        # protected keys take their room from probation
+        to_probation, to_protected = loaded[1], loaded[2]
+        while len(to_probation) + len(to_protected) > main_room:
+            to_probation.popleft()
+
+        sketch = self._sketch
+        for segment, seg_loaded in zip(segments, loaded):
+            for key, value, frequency in reversed(seg_loaded):
+                dict.__setitem__(self, key, value)
+                segment[key] = None
+                segment.move_to_end(key, last=False)
+                sketch.restore(key, frequency)
+        return sum(len(seg_loaded) for seg_loaded in loaded)
+
+
+class ShardedLRU(MutableMapping):
+    """The ``ShardedLRU`` spreads its keys across several independent
+    :class:`LRU` segments ("shards"), each with its own lock and linked
+    list. Threads working with keys in different shards do not contend
+    for the same lock, which makes the ``ShardedLRU`` a better fit than
+    a single :class:`LRU` for hot, heavily multithreaded lookups.
+
+    Args:
+        max_size (int): Max number of items to cache, split as evenly as
+            possible across the shards. Defaults to ``128``.
+        values (iterable): Initial values for the cache. Defaults to ``None``.
+        on_miss (callable): a callable which accepts a single argument, the
+            key not present in the cache, and returns the value to be cached.
+        shard_count (int): Number of independent segments. Defaults
+            to ``16``, and is capped at *max_size*.
+        shard_type (type): The cache type used for each segment,
+            :class:`LRU` by default. :class:`LRI` also works.
+        on_miss_many (callable): a callable which accepts a list of
+            keys missing from a :meth:`get_many` call, and returns a
+            mapping of those it could find to their values.
+        on_evict (callable): Passed on to each shard. See :class:`LRU`.
+        stats (CacheStats): Shared by all the shards, so that it
+            reports on the cache as a whole. See :class:`LRU`.
+
+    >>> cap_cache = ShardedLRU(max_size=4, shard_count=2)
+    >>> cap_cache['a'], cap_cache['b'] = 'A', 'B'
+    >>> cap_cache['a']
+    'A'
+    >>> print(cap_cache.get('z'))
+    None
+    >>> cap_cache.hit_count, cap_cache.miss_count, cap_cache.soft_miss_count
+    (1, 1, 1)
+
+    Because eviction happens per shard, the ``ShardedLRU`` only
+    approximates the least-recently used ordering of a single
+    :class:`LRU`. With a well-distributed hash, the difference is
+    rarely measurable, but a shard can evict an item while other
+    shards still have room. Operations spanning the whole cache, such
+    as :func:`len` and iteration, visit the shards one at a time and
+    are not atomic.
+    """
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, values=None,
+                 on_miss=None, shard_count=DEFAULT_SHARD_COUNT,
+                 shard_type=LRU, on_miss_many=None, on_evict=None,
+                 stats=None):
+        if max_size <= 0:
+            raise ValueError('expected max_size > 0, not %r' % max_size)
+        if shard_count <= 0:
+            raise ValueError('expected shard_count > 0, not %r' % shard_count)
+        shard_count = min(shard_count, max_size)
+        base_size, remainder = divmod(max_size, shard_count)
+        self.max_size = max_size
+        self.on_miss = on_miss
+        self.on_miss_many = on_miss_many
+        self.on_evict = on_evict
+        self.stats = stats
+        self._shards = tuple(shard_type(max_size=base_size + (i < remainder),
+                                        on_miss=on_miss, on_evict=on_evict,
+                                        stats=stats)
+                             for i in range(shard_count))
+        self._shard_count = shard_count
+
+        if values:
+            self.update(values)
+
+    @property
+    def shards(self):
+        "A tuple of the underlying cache segments."
+        return self._shards
+
+    @property
+    def shard_count(self):
+        return self._shard_count
+
+    def get_shard(self, key):
+        "Get the cache segment responsible for *key*."
+        return self._shards[hash(key) % self._shard_count]
+
+    @property
+    def hit_count(self):
+        return sum([shard.hit_count for shard in self._shards])
+
+    @property
+    def miss_count(self):
+        return sum([shard.miss_count for shard in self._shards])
+
+    @property
+    def soft_miss_count(self):
+        return sum([shard.soft_miss_count for shard in self._shards])
+
+    def __getitem__(self, key):
+        return self._shards[hash(key) % self._shard_count][key]
+
+    def __setitem__(self, key, value):
+        self._shards[hash(key) % self._shard_count][key] = value
+
+    def __delitem__(self, key):
+        del self._shards[hash(key) % self._shard_count][key]
+
+    def __contains__(self, key):
+        return key in self._shards[hash(key) % self._shard_count]
+
+    def get(self, key, default=None):
+        return self._shards[hash(key) % self._shard_count].get(key, default)
+
+    def pop(self, key, default=_MISSING):
+        shard = self._shards[hash(key) % self._shard_count]
+        if default is _MISSING:
+            return shard.pop(key)
+        return shard.pop(key, default)
+
+    def popitem(self):
+        for shard in self._shards:
+            try:
+                return shard.popitem()
+            except KeyError:
+                continue
+        raise KeyError('popitem(): %s is empty' % self.__class__.__name__)
+
+    def setdefault(self, key, default=None):
+        shard = self._shards[hash(key) % self._shard_count]
+        return shard.setdefault(key, default)
+
+    def clear(self):
+        for shard in self._shards:
+            shard.clear()
+
+    def _group_by_shard(self, keys):
+        shard_count = self._shard_count
+        groups = [[] for _ in range(shard_count)]
+        for key in keys:
+            groups[hash(key) % shard_count].append(key)
+        return zip(self._shards, groups)
+
+    def get_many(self, keys):
+        """Look up several *keys* at once, taking each shard's lock at
+        most once. Returns a tuple of a dict of the keys found and
+        their values, and a list of the keys not found, grouped by
+        shard. Missing keys are handled as with :meth:`LRI.get_many`.
+        """
+        hits, misses = {}, []
+        for shard, shard_keys in self._group_by_shard(keys):
+            if shard_keys:
+                shard_hits, shard_misses = shard._lookup_many(shard_keys)
+                hits.update(shard_hits)
+                misses.extend(shard_misses)
+        return _fill_misses(self, hits, misses)
+
+    def set_many(self, items):
+        """Set several items at once, taking each shard's lock at most
+        once. *items* can be a mapping or an iterable of key-value pairs.
+        """
+        if callable(getattr(items, 'keys', None)):
+            items = [(k, items[k]) for k in items.keys()]
+        shard_count = self._shard_count
+        groups = [[] for _ in range(shard_count)]
+        for item in items:
+            groups[hash(item[0]) % shard_count].append(item)
+        for shard, shard_items in zip(self._shards, groups):
+            if shard_items:
+                shard.set_many(shard_items)
+        return
+
+    def delete_many(self, keys):
+        """Remove several *keys* at once, ignoring keys not in the cache.
+        Returns the number of items removed.
+        """
+        return sum([shard.delete_many(shard_keys)
+                    for shard, shard_keys in self._group_by_shard(keys)
+                    if shard_keys])
+
+    def copy(self):
+        return self.__class__(max_size=self.max_size, values=self,
+                              on_miss=self.on_miss,
+                              shard_count=self._shard_count,
+                              shard_type=type(self._shards[0]),
+                              on_miss_many=self.on_miss_many,
+                              on_evict=self.on_evict, stats=self.stats)
+
+    def __len__(self):
+        return sum([len(shard) for shard in self._shards])
+
+    def __iter__(self):
+        for shard in self._shards:
+            # snapshot each shard's keys under its lock so concurrent
+            # writes to that shard do not break iteration
+            with shard._lock:
+                keys = list(shard.keys())
+            yield from keys
+
+    # NB: values() and items() read the shards directly, so, like
+    # iteration, they do not affect hit/miss counts or recency.
+    def values(self):
+        ret = []
+        for shard in self._shards:
+            with shard._lock:
+                ret.extend(shard.values())
+        return ret
+
+    def items(self):
+        ret = []
+        for shard in self._shards:
+            with shard._lock:
+                ret.extend(shard.items())
+        return ret
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, (dict, ShardedLRU)):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        val_map = dict(self.items())
+        return ('%s(max_size=%r, on_miss=%r, shard_count=%r, values=%r)'
+                % (cn, self.max_size, self.on_miss, self._shard_count, val_map))
+
+
+class PickleSerializer:
+    """The default serializer for the :class:`TieredCache`. Any object
+    with ``dumps()`` and ``loads()`` methods converting to and from
+    :class:`bytes` (or :class:`str`) can be used in its place, such as
+    the :mod:`json` or :mod:`marshal` modules.
+    """
+    def __init__(self, protocol=4):
+        self.protocol = protocol
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, protocol=self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(protocol={self.protocol!r})'
+
+
+class TieredCache(MutableMapping):
+    """The ``TieredCache`` is a two-level cache, with an in-memory
+    :class:`LRU` in front of an on-disk :mod:`sqlite3` database. Items
+    evicted from memory are demoted to disk rather than dropped, and
+    items found on disk are promoted back into memory. This lets the
+    cache grow beyond available RAM, and with :meth:`flush` or
+    :meth:`close`, survive process restarts.
+
+    Args:
+        path (str): Path to the database file. ``':memory:'`` works
+            for testing, but does not survive restarts.
+        max_size (int): Max number of items kept in memory. Defaults
+            to ``128``.
+        max_disk_size (int): Max number of items kept on disk.
+            Defaults to ``None``, for no limit. When full, the items
+            least recently written to disk are dropped first.
+        values (iterable): Initial values for the cache. Defaults to ``None``.
+        on_miss (callable): a callable which accepts a single argument, the
+            key not present in either tier, and returns the value to
+            be cached.
+        serializer: An object with ``dumps()`` and ``loads()`` methods,
+            used to store values on disk. Defaults to a
+            :class:`PickleSerializer`.
+        key_serializer: The same, for keys. Keys are found on disk by
+            their serialized form, so it must be deterministic.
+            Defaults to a :class:`PickleSerializer`.
+
+    >>> cache = TieredCache(':memory:', max_size=2)
+    >>> cache['a'], cache['b'], cache['c'] = 'A', 'B', 'C'
+    >>> cache.memory_size, cache.disk_size
+    (2, 1)
+    >>> cache['a']
+    'A'
+    >>> cache.hit_count, cache.disk_hit_count, cache.miss_count
+    (0, 1, 0)
+    >>> cache.close()
+
+    ``hit_count`` only counts hits in memory, ``disk_hit_count``
+    counts hits on disk, and ``miss_count`` counts keys found in
+    neither. Each key lives in exactly one tier, so promotion
+    and demotion move items rather than copying them.
+
+    Both tiers are guarded by a single lock, so the ``TieredCache``
+    is threadsafe, but does not allow concurrent disk access. The
+    ``TieredCache`` can be used with :func:`cached`, in which case
+    all arguments must be serializable by the *key_serializer*.
+    """
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, max_disk_size=None,
+                 values=None, on_miss=None, serializer=None,
+                 key_serializer=None):
+        if max_disk_size is not None and max_disk_size <= 0:
+            raise ValueError('expected max_disk_size > 0, not %r'
+                             % max_disk_size)
+        if on_miss is not None and not callable(on_miss):
+            raise TypeError('expected on_miss to be a callable'
+                            ' (or None), not %r' % on_miss)
+        self.path = path
+        self.max_disk_size = max_disk_size
+        self.on_miss = on_miss
+        self.serializer = serializer or PickleSerializer()
+        self.key_serializer = key_serializer or PickleSerializer()
+        self.hit_count = self.disk_hit_count = 0
+        self.miss_count = self.soft_miss_count = 0
+        self._lock = RLock()
+        self._closed = False
+        # the memory tier hands evicted items off to disk instead of
+        # dropping them
+        self._memory = LRU(max_size=max_size, on_evict=self._on_memory_evict)
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS cache'
+                           ' (key BLOB PRIMARY KEY, value BLOB NOT NULL)')
+        self._disk_size = self._conn.execute('SELECT COUNT(*) FROM cache'
+                                             ).fetchone()[0]
+        if values:
+            self.update(values)
+
+    @property
+    def max_size(self):
+        return self._memory.max_size
+
+    @property
+    def memory_size(self):
+        "The number of items in the memory tier."
+        return len(self._memory)
+
+    @property
+    def disk_size(self):
+        "The number of items in the disk tier."
+        return self._disk_size
+
+    def _delete_from_disk(self, key_blob):
+        cur = self._conn.execute('DELETE FROM cache WHERE key = ?',
+                                 (key_blob,))
+        self._disk_size -= cur.rowcount
+        return cur.rowcount
+
+    def _on_memory_evict(self, key, value, reason):
+        self._demote(key, value)
+
+    def _demote(self, key, value):
+        key_blob = self.key_serializer.dumps(key)
+        value_blob = self.serializer.dumps(value)
+        # a fresh row gets a higher rowid, so rowids track the order
+        # items were written to disk
+        self._delete_from_disk(key_blob)
+        self._conn.execute('INSERT INTO cache (key, value) VALUES (?, ?)',
+                           (key_blob, value_blob))
+        self._disk_size += 1
+        if self.max_disk_size is not None:
+            overflow = self._disk_size - self.max_disk_size
+            if overflow > 0:
+                self._conn.execute('DELETE FROM cache WHERE rowid IN'
+                                   ' (SELECT rowid FROM cache'
+                                   ' ORDER BY rowid LIMIT ?)', (overflow,))
+                self._disk_size -= overflow
+
+    def _pop_from_disk(self, key):
+        key_blob = self.key_serializer.dumps(key)
+        row = self._conn.execute('SELECT value FROM cache WHERE key = ?',
+                                 (key_blob,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        self._delete_from_disk(key_blob)
+        return self.serializer.loads(row[0])
+
+    def __getitem__(self, key):
+        with self._lock:
+            memory = self._memory
+            if dict.__contains__(memory, key):
+                self.hit_count += 1
+                return memory[key]
+            try:
+                value = self._pop_from_disk(key)
+            except KeyError:
+                self.miss_count += 1
+                if not self.on_miss:
+                    raise
+                value = self[key] = self.on_miss(key)
+                return value
+            self.disk_hit_count += 1
+            memory[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if self._disk_size:
+                self._delete_from_disk(self.key_serializer.dumps(key))
+            self._memory[key] = value
+
+    def __delitem__(self, key):
+        with self._lock:
+            try:
+                del self._memory[key]
+            except KeyError:
+                self._pop_from_disk(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            if dict.__contains__(self._memory, key):
+                return True
+            row = self._conn.execute('SELECT 1 FROM cache WHERE key = ?',
+                                     (self.key_serializer.dumps(key),))
+            return row.fetchone() is not None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self.soft_miss_count += 1
+            return default
+
+    def __len__(self):
+        with self._lock:
+            return len(self._memory) + self._disk_size
+
+    def __iter__(self):
+        with self._lock:
+            keys = list(self._memory.keys())
+            rows = self._conn.execute('SELECT key FROM cache').fetchall()
+        yield from keys
+        for (key_blob,) in rows:
+            yield self.key_serializer.loads(key_blob)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute('DELETE FROM cache')
+            self._disk_size = 0
+
+    def flush(self):
+        """Demote all items in memory to disk, so that they survive a
+        restart. The memory tier is left empty, and warms back up as
+        items are promoted.
+        """
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                for key, value in list(self._memory.items()):
+                    self._demote(key, value)
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                self._disk_size = self._conn.execute(
+                    'SELECT COUNT(*) FROM cache').fetchone()[0]
+                raise
+            self._conn.execute('COMMIT')
+            self._memory.clear()
+
+    def close(self):
+        """Flush all items to disk and close the database. Calling
+        ``close()`` more than once is safe.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self.flush()
+            self._conn.close()
+            self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return ('%s(path=%r, max_size=%r, max_disk_size=%r, on_miss=%r)'
+                % (cn, self.path, self.max_size, self.max_disk_size,
+                   self.on_miss))
+
+
+# SharedCache memory layout: a header, one CLOCK hand per set, then
+# fixed-size slots, each with its own header followed by the key and
+# value data.
+_SC_MAGIC = b'BSC1'
+_SC_HEADER = struct.Struct('<4sIIIIQQQQ')  # magic, sets, ways, slot_size,
+                                           # count, hits, misses,
+                                           # soft_misses, rejects
+_SC_COUNT, _SC_HITS, _SC_MISSES, _SC_SOFT_MISSES, _SC_REJECTS = (16, 20, 28,
+                                                                 36, 44)
+_SC_SLOT = struct.Struct('<BBxxQII')  # used, ref bit, key hash,
+                                      # key length, value length
+_SC_EMPTY, _SC_USED = 0, 1
+DEFAULT_SLOT_SIZE = 1024
+DEFAULT_WAYS = 8
+_SC_MAX_WAYS = 256  # each set's clock hand is stored in a single byte
+
+
+class SharedCache(MutableMapping):
+    """The ``SharedCache`` is a fixed-size cache living in shared
+    memory, so that a single cache can serve several processes, such
+    as the forked workers of a pre-fork server. Keys and values are
+    serialized into a hash table of fixed-size slots, and evicted in
+    approximately least-recently used order.
+
+    Args:
+        max_size (int): Number of slots in the cache. Rounded up to a
+            multiple of *ways*. Defaults to ``128``.
+        slot_size (int): Size of each slot, in bytes. Items whose
+            serialized key and value do not fit are not cached.
+            Defaults to ``1024``.
+        path (str): Optional path of a file to map, so that the cache
+            survives restarts. Defaults to ``None``, for anonymous
+            shared memory.
+        on_miss (callable): a callable which accepts a single argument, the
+            key not present in the cache, and returns the value to be cached.
+        serializer: An object with ``dumps()`` and ``loads()`` methods
+            for values. Defaults to a :class:`PickleSerializer`.
+        key_serializer: The same, for keys, which must serialize
+            deterministically. Defaults to a :class:`PickleSerializer`.
+        ways (int): The number of slots a key can occupy, at most
+            ``256``. Defaults to ``8``.
+
+    >>> cache = SharedCache(max_size=16, slot_size=128)
+    >>> cache['a'] = 'A'
+    >>> cache['a']
+    'A'
+    >>> cache.get('b') is None
+    True
+    >>> cache.hit_count, cache.miss_count, cache.soft_miss_count
+    (1, 1, 1)
+
+    The cache must be created before worker processes are forked,
+    which then share its memory and lock. The table is
+    *set-associative*: each key hashes to a set of *ways* slots, and
+    when a set is full, the CLOCK algorithm picks a slot in the set
+    which has not been accessed since the clock hand last passed it.
+    Each lookup therefore touches at most *ways* slots, regardless of
+    cache size.
+
+    Statistics are stored in the shared memory, so ``hit_count``,
+    ``miss_count``, and ``soft_miss_count`` cover all processes.
+    ``reject_count`` counts items too large for a slot.
+
+    The ``SharedCache`` works with :func:`cached`, as long as all
+    arguments can be serialized by the *key_serializer*. Note that
+    values are copies, so mutating a returned value does not change
+    the cached value.
+    """
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, slot_size=DEFAULT_SLOT_SIZE,
+                 path=None, on_miss=None, serializer=None,
+                 key_serializer=None, ways=DEFAULT_WAYS):
+        from multiprocessing import Lock
+
+        if max_size <= 0:
+            raise ValueError('expected max_size > 0, not %r' % max_size)
+        if slot_size <= _SC_SLOT.size:
+            raise ValueError('expected slot_size > %r, not %r'
+                             % (_SC_SLOT.size, slot_size))
+        if not 0 < ways <= _SC_MAX_WAYS:
+            raise ValueError('expected 0 < ways <= %r, not %r'
+                             % (_SC_MAX_WAYS, ways))
+        if on_miss is not None and not callable(on_miss):
+            raise TypeError('expected on_miss to be a callable'
+                            ' (or None), not %r' % on_miss)
+        ways = min(ways, max_size)
+        set_count = -(-max_size // ways)
+        self.max_size = set_count * ways
+        self.slot_size = slot_size
+        self.path = path
+        self.on_miss = on_miss
+        self.serializer = serializer or PickleSerializer()
+        self.key_serializer = key_serializer or PickleSerializer()
+        self._set_count = set_count
+        self._ways = ways
+        self._hands_offset = _SC_HEADER.size
+        self._slots_offset = (_SC_HEADER.size + set_count + 7) & ~7
+        self._lock = Lock()
+        self._map = self._open_map(self._slots_offset
+                                   + self.max_size * slot_size)
+
+    def _open_map(self, size):
+        header = (_SC_MAGIC, self._set_count, self._ways, self.slot_size,
+                  0, 0, 0, 0, 0)
+        if self.path is None:
+            ret = mmap.mmap(-1, size)
+            _SC_HEADER.pack_into(ret, 0, *header)
+            return ret
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # reuse an existing file if it has the same layout,
+            # otherwise start fresh
+            existing = os.read(fd, _SC_HEADER.size)
+            is_valid = (os.fstat(fd).st_size == size
+                        and len(existing) == _SC_HEADER.size
+                        and (_SC_HEADER.unpack(existing)[:4] == header[:4]))
+            if not is_valid:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            ret = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        if not is_valid:
+            _SC_HEADER.pack_into(ret, 0, *header)
+        return ret
+
+    def _get_stat(self, offset):
+        return struct.unpack_from('<Q', self._map, offset)[0]
+
+    def _incr_stat(self, offset):
+        # only called with the lock held
+        struct.pack_into('<Q', self._map, offset,
+                         struct.unpack_from('<Q', self._map, offset)[0] + 1)
+
+    @property
+    def hit_count(self):
+        return self._get_stat(_SC_HITS)
+
+    @property
+    def miss_count(self):
+        return self._get_stat(_SC_MISSES)
+
+    @property
+    def soft_miss_count(self):
+        return self._get_stat(_SC_SOFT_MISSES)
+
+    @property
+    def reject_count(self):
+        return self._get_stat(_SC_REJECTS)
+
+    def _dump_key(self, key):
+        ret = self.key_serializer.dumps(key)
+        if isinstance(ret, str):
+            ret = ret.encode('utf8')
+        return ret
+
+    def _hash(self, key_blob):
+        digest = hashlib.blake2b(key_blob, digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
+
+    def _find(self, key_blob, key_hash):
+        # returns (set index, offset of the matching slot or None)
+        set_idx = key_hash % self._set_count
+        mm, slot_size, key_len = self._map, self.slot_size, len(key_blob)
+        offset = self._slots_offset + set_idx * self._ways * slot_size
+        for _ in range(self._ways):
+            used, _, slot_hash, slot_key_len, _ = _SC_SLOT.unpack_from(
+                mm, offset)
+            if (used and slot_hash == key_hash and slot_key_len == key_len):
+                data_start = offset + _SC_SLOT.size
+                if mm[data_start:data_start + key_len] == key_blob:
+                    return set_idx, offset
+            offset += slot_size
+        return set_idx, None
+
+    def _find_free(self, set_idx):
+        # an empty slot if there is one, otherwise the CLOCK victim
+        mm, slot_size, ways = self._map, self.slot_size, self._ways
+        set_start = self._slots_offset + set_idx * ways * slot_size
+        for way in range(ways):
+            offset = set_start + way * slot_size
+            if mm[offset] == _SC_EMPTY:
+                return offset
+        hand_offset = self._hands_offset + set_idx
+        hand = mm[hand_offset]
+        while True:
+            offset = set_start + hand * slot_size
+            hand = (hand + 1) % ways
+            if mm[offset + 1]:
+                mm[offset + 1] = 0  # second chance
+                continue
+            mm[hand_offset] = hand
+            self._set_count_delta(-1)
+            return offset
+
+    def _set_count_delta(self, delta):
+        count = struct.unpack_from('<I', self._map, _SC_COUNT)[0]
+        struct.pack_into('<I', self._map, _SC_COUNT, count + delta)
+
+    def __getitem__(self, key):
+        key_blob = self._dump_key(key)
+        key_hash = self._hash(key_blob)
+        with self._lock:
+            _, offset = self._find(key_blob, key_hash)
+            if offset is None:
+                self._incr_stat(_SC_MISSES)
+            else:
+                self._incr_stat(_SC_HITS)
+                mm = self._map
+                mm[offset + 1] = 1
+                _, _, _, key_len, value_len = _SC_SLOT.unpack_from(mm, offset)
+                value_start = offset + _SC_SLOT.size + key_len
+                value_blob = mm[value_start:value_start + value_len]
+        if offset is None:
+            if not self.on_miss:
+                raise KeyError(key)
+            ret = self[key] = self.on_miss(key)
+            return ret
+        return self.serializer.loads(value_blob)
+
+    def __setitem__(self, key, value):
+        key_blob = self._dump_key(key)
+        value_blob = self.serializer.dumps(value)
+        if isinstance(value_blob, str):
+            value_blob = value_blob.encode('utf8')
+        key_hash = self._hash(key_blob)
+        data_size = _SC_SLOT.size + len(key_blob) + len(value_blob)
+        with self._lock:
+            set_idx, offset = self._find(key_blob, key_hash)
+            if data_size > self.slot_size:
+                # too big to cache, also drop any stale value
+                self._incr_stat(_SC_REJECTS)
+                if offset is not None:
+                    self._map[offset] = _SC_EMPTY
+                    self._set_count_delta(-1)
+                return
+            if offset is None:
+                offset = self._find_free(set_idx)
+                self._set_count_delta(1)
+            mm = self._map
+            _SC_SLOT.pack_into(mm, offset, _SC_USED, 1, key_hash,
+                               len(key_blob), len(value_blob))
+            data_start = offset + _SC_SLOT.size
+            mm[data_start:data_start + len(key_blob)] = key_blob
+            data_start += len(key_blob)
+            mm[data_start:data_start + len(value_blob)] = value_blob
+        return
+
+    def __delitem__(self, key):
+        key_blob = self._dump_key(key)
+        with self._lock:
+            _, offset = self._find(key_blob, self._hash(key_blob))
+            if offset is None:
+                raise KeyError(key)
+            self._map[offset] = _SC_EMPTY
+            self._set_count_delta(-1)
+
+    def __contains__(self, key):
+        key_blob = self._dump_key(key)
+        with self._lock:
+            return self._find(key_blob, self._hash(key_blob))[1] is not None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            with self._lock:
+                self._incr_stat(_SC_SOFT_MISSES)
+            return default
+
+    def __len__(self):
+        return struct.unpack_from('<I', self._map, _SC_COUNT)[0]
+
+    def _iter_key_blobs(self):
+        mm, slot_size = self._map, self.slot_size
+        ret = []
+        with self._lock:
+            for idx in range(self.max_size):
+                offset = self._slots_offset + idx * slot_size
+                if mm[offset] != _SC_USED:
+                    continue
+                key_len = _SC_SLOT.unpack_from(mm, offset)[3]
+                data_start = offset + _SC_SLOT.size
+                ret.append(mm[data_start:data_start + key_len])
+        return ret
+
+    def __iter__(self):
+        loads = self.key_serializer.loads
+        for key_blob in self._iter_key_blobs():
+            yield loads(key_blob)
+
+    def clear(self):
+        mm, slot_size = self._map, self.slot_size
+        with self._lock:
+            for idx in range(self.max_size):
+                mm[self._slots_offset + idx * slot_size] = _SC_EMPTY
+            self._set_count_delta(-len(self))
+
+    def close(self):
+        "Unmap the shared memory, flushing it first if file-backed."
+        if self.path is not None:
+            self._map.flush()
+        self._map.close()
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return ('%s(max_size=%r, slot_size=%r, path=%r, on_miss=%r)'
+                % (cn, self.max_size, self.slot_size, self.path,
+                   self.on_miss))
+
+
+class CacheStats:
+    """A collector for the ``stats`` hooks of the caches and cache
+    decorators in this module. One ``CacheStats`` can be shared by
+    several caches, or by a cache and the :func:`cached` functions
+    using it, to get an aggregate view. Decorators leave counting hits
+    to caches which report to the same ``CacheStats``, so that each
+    hit is only counted once.
+
+    Args:
+        track_keys (bool): Whether to count hits per key, for
+            :meth:`get_hot_keys`. Defaults to ``True``.
+        key_threshold (float): The *threshold* of the
+            :class:`ThresholdCounter` used to count keys. Keys making
+            up less than this ratio of all hits may go uncounted.
+            Defaults to ``0.001``.
+
+    >>> stats = CacheStats()
+    >>> cache = LRU(max_size=1, on_miss=lambda k: k.upper(), stats=stats)
+    >>> cache['a'], cache['a'], cache['b']
+    ('A', 'A', 'B')
+    >>> stats.hit_count, stats.miss_count
+    (1, 2)
+    >>> stats.eviction_counts
+    {'capacity': 1}
+    >>> stats.get_hot_keys()
+    [('a', 1)]
+
+    Miss times are the time spent in *on_miss*, or in the decorated
+    function, and are kept in a histogram with buckets bounded by
+    ``miss_time_buckets``, in seconds. Failed background refreshes of
+    functions cached with a *soft_ttl* are counted in
+    ``refresh_error_count``, and the latest exception is kept as
+    ``last_refresh_error``. Key counts are best-effort and
+    bounded, the same as a :class:`ThresholdCounter`.
+    """
+    miss_time_buckets = (0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+
+    def __init__(self, track_keys=True, key_threshold=0.001):
+        self.track_keys = track_keys
+        self._lock = RLock()
+        self.hit_count = self.miss_count = self.refresh_error_count = 0
+        self.total_miss_time = self.max_miss_time = 0.0
+        self.eviction_counts = {}
+        self._miss_time_counts = [0] * (len(self.miss_time_buckets) + 1)
+        self.key_counts = ThresholdCounter(key_threshold)
+        self.last_refresh_error = None
+
+    def on_hit(self, key):
+        with self._lock:
+            self.hit_count += 1
+            if self.track_keys:
+                self.key_counts.add(key)
+
+    def on_miss_complete(self, key, elapsed):
+        with self._lock:
+            self.miss_count += 1
+            self.total_miss_time += elapsed
+            if elapsed > self.max_miss_time:
+                self.max_miss_time = elapsed
+            idx = bisect.bisect_left(self.miss_time_buckets, elapsed)
+            self._miss_time_counts[idx] += 1
+
+    def on_evict(self, key, value, reason):
+        with self._lock:
+            self.eviction_counts[reason] = \
+                self.eviction_counts.get(reason, 0) + 1
+
+    def on_refresh_error(self, key, exception):
+        with self._lock:
+            self.refresh_error_count += 1
+            self.last_refresh_error = exception
+
+    @property
+    def mean_miss_time(self):
+        "The average time taken by a miss, in seconds."
+        if not self.miss_count:
+            return 0.0
+        return self.total_miss_time / self.miss_count
+
+    def get_miss_time_histogram(self):
+        """Get a list of ``(upper_bound, count)`` pairs, counting the
+        misses which took at most *upper_bound* seconds, and more than
+        the previous bound. The last bound is ``float('inf')``.
+        """
+        bounds = self.miss_time_buckets + (float('inf'),)
+        with self._lock:
+            return list(zip(bounds, self._miss_time_counts))
+
+    def get_hot_keys(self, n=None):
+        """Get the *n* keys with the most hits, as a list of ``(key,
+        count)`` pairs, most hits first. All counted keys are returned
+        if *n* is ``None``.
+        """
+        with self._lock:
+            if n is None:
+                n = len(self.key_counts)
+            return self.key_counts.most_common(n)
+
+    def reset(self):
+        "Clear all collected statistics."
+        with self._lock:
+            self.hit_count = self.miss_count = self.refresh_error_count = 0
+            self.total_miss_time = self.max_miss_time = 0.0
+            self.eviction_counts = {}
+            self.last_refresh_error = None
+            self._miss_time_counts = [0] * len(self._miss_time_counts)
+            self.key_counts = ThresholdCounter(self.key_counts.threshold)
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return ('%s(hit_count=%r, miss_count=%r, mean_miss_time=%r,'
+                ' eviction_counts=%r)'
+                % (cn, self.hit_count, self.miss_count,
+                   self.mean_miss_time, self.eviction_counts))
+
+
+### Cached decorator
+# Key-making technique adapted from Python 3.4's functools
+
+class _HashedKey(list):
+    """The _HashedKey guarantees that hash() will be called no more than once
+    per cached function invocation.
+    """
+    __slots__ = 'hash_value'
+
+    def __init__(self, key):
+        self[:] = key
+        self.hash_value = hash(tuple(key))
+
+    def __hash__(self):
+        return self.hash_value
+
+    def __reduce__(self):
+        # leave out the hash, which can differ between processes, so
+        # that equal keys always serialize the same
+        return (self.__class__, (list(self),))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({list.__repr__(self)})'
+
+
+def make_cache_key(args, kwargs, typed=False,
+                   kwarg_mark=_KWARG_MARK,
+                   fasttypes=frozenset([int, str, frozenset, type(None),
+                                        float, bytes])):
+    """Make a generic key from a function's positional and keyword
+    arguments, suitable for use in caches. Arguments within *args* and
+    *kwargs* must be `hashable`_. If *typed* is ``True``, ``3`` and
+    ``3.0`` will be treated as separate keys.
+
+    The key is constructed in a way that is flat as possible rather than
+    as a nested structure that would take more memory.
+
+    If there is only a single argument and its data type is known to
+    hash quickly, then that argument is returned without a wrapper.
+    This saves space and improves lookup speed. Likewise, when all
+    arguments are of such types, the key is a plain :class:`tuple`,
+    and all-positional calls reuse *args* itself. All-positional calls
+    with objects hashed by identity, such as instances of most classes,
+    functions and the ``self`` of cached methods, also get plain tuples.
+    Otherwise, the key caches its hash, so that arguments with expensive
+    ``__hash__`` methods are only hashed once per call. :class:`bool` is
+    left out of the fast types, so that ``True`` and ``1`` make
+    different keys, even though they are equal.
+
+    >>> make_cache_key(('a', 'b'), {})
+    ('a', 'b')
+    >>> make_cache_key(('a', 'b'), {'c': ('d')})
+    ('a', 'b', _KWARG_MARK, ('c', 'd'))
+
+    .. _hashable: https://docs.python.org/2/glossary.html#term-hashable
+    """
+    if not kwargs and not typed:
+        # the all-positional fast path
+        for arg in args:
+            if type(arg) not in fasttypes:
+                break
+        else:
+            if len(args) == 1:
+                return args[0]
+            return args if type(args) is tuple else tuple(args)
+        # identity hashes are quick too, so caching them isn't worth a
+        # _HashedKey, though such args are never returned bare
+        for arg in args:
+            if (type(arg) not in fasttypes
+                    and type(arg).__hash__ is not _object_hash):
+                return _HashedKey(args)
+        return args if type(args) is tuple else tuple(args)
+
+    key = list(args)
+    if kwargs:
+        sorted_items = sorted(kwargs.items())
+        key.append(kwarg_mark)
+        key.extend(sorted_items)
+    if typed:
+        key.extend([type(v) for v in args])
+        if kwargs:
+            key.extend([type(v) for k, v in sorted_items])
+    for arg in args:
+        if type(arg) not in fasttypes:
+            return _HashedKey(key)
+    if kwargs:
+        for value in kwargs.values():
+            if type(value) not in fasttypes:
+                return _HashedKey(key)
+    return tuple(key)
+
+
+def _get_call_normalizer(func, skip=0):
+    """Precompute a function's positional parameters and defaults, and
+    return a ``(first_default, defaults, normalize)`` triple.
+    ``normalize(args, kwargs)`` moves keyword arguments into their
+    positional slots and drops trailing arguments equal to their
+    defaults, so that ``f(1)``, ``f(1, 2)`` and ``f(1, b=2)`` all get the
+    same cache key as ``f(1)``. Only calls with *kwargs*, or with more
+    than *first_default* positional arguments, the last of which is in
+    the *defaults* frozenset, need normalizing. *normalize* is ``None``
+    when there is nothing to gain, or the signature is unavailable.
+    """
+    try:
+        params = list(inspect.signature(func).parameters.values())[skip:]
+    except (TypeError, ValueError):
+        return 0, frozenset(), None
+    names, defaults = [], []
+    for param in params:
+        if param.kind is param.POSITIONAL_OR_KEYWORD:
+            names.append(param.name)
+        elif param.kind is param.POSITIONAL_ONLY:
+            names.append(None)
+        else:
+            break
+        if param.default is not param.empty:
+            defaults.append(param.default)
+    try:
+        defaults = tuple(defaults)
+        hash(defaults)
+    except TypeError:
+        # unhashable defaults are never dropped from keys, as before
+        defaults = ()
+    if not names or (not defaults and not any(names)):
+        return 0, frozenset(), None
+    arity = len(names)
+    first_default = arity - len(defaults)
+    index = {name: i for i, name in enumerate(names) if name is not None}
+    # pads[n] fills in the parameters after the first n, with defaults
+    # where there are any, and _MISSING for required parameters
+    pads = [(_MISSING,) * (first_default - n)
+            + defaults[max(n - first_default, 0):] for n in range(arity + 1)]
+
+    def normalize(args, kwargs):
+        nargs = len(args)
+        if nargs > arity:
+            return args, kwargs  # extra *args, left as-is
+        if kwargs:
+            slots = list(args)
+            slots.extend(pads[nargs])
+            required = first_default - nargs
+            rest = None
+            for name, value in kwargs.items():
+                i = index.get(name)
+                if i is None:
+                    if rest is None:
+                        rest = {}
+                    rest[name] = value
+                elif i < nargs:
+                    return args, kwargs  # an invalid call, left to fail as-is
+                else:
+                    if i < first_default:
+                        required -= 1
+                    slots[i] = value
+            if required > 0:
+                return args, kwargs
+            args, kwargs = slots, rest or {}
+            nargs = arity
+        end = nargs
+        while end > first_default:
+            # values of other types are kept, as True and 1, or 1 and
+            # 1.0, are equal, but make different typed keys
+            value, default = args[end - 1], defaults[end - 1 - first_default]
+            if value is not default and (type(value) is not type(default)
+                                         or value != default):
+                break
+            end -= 1
+        if type(args) is list:
+            return tuple(args[:end]), kwargs
+        if end == nargs:
+            return args, kwargs
+        return args[:end], kwargs
+
+    return first_default, frozenset(defaults), normalize
+
+
+# for backwards compatibility in case someone was importing it
+_make_cache_key = make_cache_key
+
+
+class _InFlightCall:
+    __slots__ = ('done', 'result', 'exception')
+
+    def __init__(self):
+        self.done = Event()
+        self.result = self.exception = None
+
+
+class _SingleFlight:
+    """Coalesces concurrent calls sharing the same key into a single
+    call, used by :class:`CachedFunction` and :class:`CachedMethod`
+    when *coalesce* is enabled. The first caller for a key runs the
+    call, and the rest wait for and share its result or exception.
+    Keys are forgotten as soon as their call completes.
+
+    Callers key calls by ``(id(cache), key)``, as bound methods can
+    share a _SingleFlight while filling different caches. The cache is
+    referenced by the call itself, so its id is not reused while the
+    call is in flight.
+    """
+    def __init__(self):
+        self._lock = RLock()
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def run(self, key, func, args, kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _InFlightCall()
+        if not is_leader:
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class _AsyncSingleFlight:
+    """The asyncio counterpart to :class:`_SingleFlight`. Concurrent
+    awaits of the same key, on the same event loop, share a single
+    task. Waiters are shielded from one another, so a cancelled waiter
+    does not cancel the shared task.
+    """
+    def __init__(self):
+        self._tasks = {}
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def _discard(self, task_key, task):
+        if self._tasks.get(task_key) is task:
+            del self._tasks[task_key]
+
+    async def run(self, key, func, args, kwargs):
+        import asyncio
+
+        task_key = (asyncio.get_running_loop(), key)
+        task = self._tasks.get(task_key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._tasks[task_key] = task
+            task.add_done_callback(lambda t: self._discard(task_key, t))
+        return await asyncio.shield(task)
+
+
+def _set_cache_result(cache, key, func, args, kwargs):
+    ret = cache[key] = func(*args, **kwargs)
+    return ret
+
+
+async def _set_cache_result_async(cache, key, func, args, kwargs):
+    ret = cache[key] = await func(*args, **kwargs)
+    return ret
+
+
+class _StaleEntry:
+    # the cache value used by cached functions with a soft_ttl.
+    # retry_at is set when a background refresh fails, to hold off the
+    # next one.
+    __slots__ = ('value', 'stale_at', 'expires_at', 'retry_at')
+
+    def __init__(self, value, stale_at, expires_at):
+        self.value = value
+        self.stale_at = stale_at
+        self.expires_at = expires_at
+        self.retry_at = None
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return ('%s(value=%r, stale_at=%r, expires_at=%r)'
+                % (cn, self.value, self.stale_at, self.expires_at))
+
+
+_REFRESH_EXECUTOR = None
+_REFRESH_EXECUTOR_LOCK = RLock()
+
+
+def _get_refresh_executor():
+    global _REFRESH_EXECUTOR
+    with _REFRESH_EXECUTOR_LOCK:
+        if _REFRESH_EXECUTOR is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _REFRESH_EXECUTOR = ThreadPoolExecutor(
+                max_workers=4, thread_name_prefix='cacheutils-refresh')
+        return _REFRESH_EXECUTOR
+
+
+class _Refresher:
+    """Implements stale-while-revalidate for cached functions with a
+    *soft_ttl*. Values older than *soft_ttl* are returned right away,
+    while a single background task per key computes a fresh value.
+    Values older than *hard_ttl* are recomputed before returning.
+    """
+    def __init__(self, soft_ttl, hard_ttl=None, executor=None,
+                 timer=time.monotonic):
+        if soft_ttl <= 0:
+            raise ValueError('expected soft_ttl > 0, not %r' % soft_ttl)
+        if hard_ttl is not None and hard_ttl < soft_ttl:
+            raise ValueError('expected hard_ttl >= soft_ttl, not %r'
+                             % hard_ttl)
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+        self.executor = executor
+        self.timer = timer
+        self._lock = RLock()
+        self._refreshing = set()
+
+    def fill(self, cache, key, func, args, kwargs):
+        value = func(*args, **kwargs)
+        now = self.timer()
+        expires_at = None if self.hard_ttl is None else now + self.hard_ttl
+        cache[key] = _StaleEntry(value, now + self.soft_ttl, expires_at)
+        return value
+
+    def get(self, cache, key, func, args, kwargs, single_flight=None,
+            on_hit=None, on_refresh_error=None):
+        try:
+            entry = cache[key]
+        except KeyError:
+            pass
+        else:
+            now = self.timer()
+            if now < entry.stale_at:
+                if on_hit is not None:
+                    on_hit(key)
+                return entry.value
+            if entry.expires_at is None or now < entry.expires_at:
+                if on_hit is not None:
+                    on_hit(key)
+                if entry.retry_at is None or now >= entry.retry_at:
+                    self._schedule(cache, key, entry, func, args, kwargs,
+                                   on_refresh_error)
+                return entry.value
+        if single_flight is None:
+            return self.fill(cache, key, func, args, kwargs)
+        return single_flight.run((id(cache), key), self.fill,
+                                 (cache, key, func, args, kwargs), {})
+
+    def _schedule(self, cache, key, entry, func, args, kwargs,
+                  on_refresh_error):
+        # keyed by cache as well, as with _SingleFlight
+        refresh_key = (id(cache), key)
+        with self._lock:
+            if refresh_key in self._refreshing:
+                return
+            self._refreshing.add(refresh_key)
+        executor = self.executor or _get_refresh_executor()
+        try:
+            executor.submit(self._refresh, cache, key, entry, func, args,
+                            kwargs, on_refresh_error)
+        except RuntimeError:
+            # the executor has been shut down, keep serving stale values
+            with self._lock:
+                self._refreshing.discard(refresh_key)
+
+    def _refresh(self, cache, key, entry, func, args, kwargs,
+                 on_refresh_error):
+        try:
+            self.fill(cache, key, func, args, kwargs)
+        except Exception as e:
+            # failed refreshes leave the stale value in place, to be
+            # retried by the first call after another soft_ttl
+            entry.retry_at = self.timer() + self.soft_ttl
+            if on_refresh_error is not None:
+                on_refresh_error(key, e)
+        finally:
+            with self._lock:
+                self._refreshing.discard((id(cache), key))
+
+
+class _CachedError:
+    # a negative cache entry for a call which raised. the traceback is
+    # kept separately, so that each replay starts from the original
+    # traceback, rather than adding to the last replay's.
+    __slots__ = ('exception', 'traceback')
+
+    def __init__(self, exception):
+        self.exception = exception
+        self.traceback = exception.__traceback__
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return f'{cn}({self.exception!r})'
 
-    def __init__(self, key):
-        self[:] = key
-        self.hash_value = hash(tuple(key))
 
-    def __hash__(self):
-        return self.hash_value
+class NegativeCache(TTLCache):
+    """A :class:`TTLCache` for the "not found" results of functions
+    wrapped with :func:`cached` and :func:`cachedmethod`, passed as
+    their *negative_cache*. Calls which raise one of *exceptions*, or
+    return one of *results*, are cached here instead of in the
+    decorator's main cache, and repeated calls raise or return the
+    same until they expire.
 
-    def __repr__(self):
-        return f'{self.__class__.__name__}({list.__repr__(self)})'
+    Args:
+        exceptions (tuple): Exception types to cache, as accepted by
+            an ``except`` clause. Defaults to ``()``.
+        results (tuple): Return values to cache, such as ``None``.
+            Results match if they are the same object, or of the same
+            type and equal, so ``0`` does not match ``False``. Defaults
+            to ``()``.
+        max_size (int): Max number of negative results to cache.
+            Defaults to ``128``.
+        ttl (float): Number of seconds a negative result is cached,
+            usually shorter than for found results. Defaults to ``10``.
+
+    Other arguments are as for :class:`TTLCache`.
+
+    >>> db, queries = {'a': 1}, []
+    >>> missing = NegativeCache(exceptions=KeyError, ttl=5)
+    >>> @cached(LRU(), negative_cache=missing)
+    ... def lookup(key):
+    ...     queries.append(key)
+    ...     return db[key]
+    >>> lookup('b')
+    Traceback (most recent call last):
+    ...
+    KeyError: 'b'
+    >>> lookup('b')
+    Traceback (most recent call last):
+    ...
+    KeyError: 'b'
+    >>> queries, missing.hit_count
+    (['b'], 1)
+
+    Keeping negative results apart means a burst of lookups for
+    missing keys can only evict other negative results, never the
+    found results in the main cache. A negative cache may be shared
+    between several cached functions, as its keys include the function
+    they were cached for.
+    """
+    def __init__(self, exceptions=(), results=(), max_size=DEFAULT_MAX_SIZE,
+                 ttl=DEFAULT_NEGATIVE_TTL, timer=time.monotonic,
+                 max_weight=None, weigher=None, on_evict=None, stats=None):
+        if isinstance(exceptions, type):
+            exceptions = (exceptions,)
+        exceptions = tuple(exceptions)
+        for exc_type in exceptions:
+            if not (isinstance(exc_type, type)
+                    and issubclass(exc_type, BaseException)):
+                raise TypeError('expected exceptions to be exception types,'
+                                ' not %r' % (exc_type,))
+        self.exceptions = exceptions
+        self.results = tuple(results)
+        super().__init__(max_size=max_size, ttl=ttl, timer=timer,
+                         max_weight=max_weight, weigher=weigher,
+                         on_evict=on_evict, stats=stats)
+
+    # negative results are keyed by (scope, key), where the scope is
+    # the wrapped function, as the keys of different functions sharing
+    # this cache can collide.
+    def _replay(self, scope, key):
+        # returns a cached result, or _MISSING, and raises cached
+        # exceptions. misses are not signaled with a KeyError, as that
+        # is often the very exception being cached.
+        entry = self.get((scope, key), _MISSING)
+        if type(entry) is _CachedError:
+            raise entry.exception.with_traceback(entry.traceback)
+        return entry
+
+    def _is_negative_result(self, ret):
+        # not `ret in self.results`, which would match 1 with True,
+        # and can raise for array-like results
+        ret_type = type(ret)
+        for result in self.results:
+            if ret is result or (type(result) is ret_type and ret == result):
+                return True
+        return False
 
+    def _fill(self, scope, cache, key, func, args, kwargs):
+        # the counterpart to _set_cache_result, routing each result to
+        # either the main cache or this one
+        try:
+            ret = func(*args, **kwargs)
+        except self.exceptions as e:
+            self[scope, key] = _CachedError(e)
+            raise
+        if self._is_negative_result(ret):
+            self[scope, key] = ret
+        else:
+            cache[key] = ret
+        return ret
 
-def make_cache_key(args, kwargs, typed=False,
-                   kwarg_mark=_KWARG_MARK,
-                   fasttypes=frozenset([int, str, frozenset, type(None)])):
-    """Make a generic key from a function's positional and keyword
-    arguments, suitable for use in caches. Arguments within *args* and
-    *kwargs* must be `hashable`_. If *typed* is ``True``, ``3`` and
-    ``3.0`` will be treated as separate keys.
+    async def _fill_async(self, scope, cache, key, func, args, kwargs):
+        try:
+            ret = await func(*args, **kwargs)
+        except self.exceptions as e:
+            self[scope, key] = _CachedError(e)
+            raise
+        if self._is_negative_result(ret):
+            self[scope, key] = ret
+        else:
+            cache[key] = ret
+        return ret
 
-    The key is constructed in a way that is flat as possible rather than
-    as a nested structure that would take more memory.
+    def _copy_empty(self):
+        return self.__class__(self.exceptions, self.results,
+                              max_size=self.max_size, ttl=self.ttl,
+                              timer=self._timer, max_weight=self.max_weight,
+                              weigher=self.weigher, on_evict=self.on_evict,
+                              stats=self.stats)
 
-    If there is only a single argument and its data type is known to cache
-    its hash value, then that argument is returned without a wrapper.  This
-    saves space and improves lookup speed.
+    def __repr__(self):
+        cn = self.__class__.__name__
+        val_map = dict.__repr__(self)
+        return ('%s(exceptions=%r, results=%r, max_size=%r, ttl=%r,'
+                ' values=%s)' % (cn, self.exceptions, self.results,
+                                 self.max_size, self.ttl, val_map))
 
-    >>> tuple(make_cache_key(('a', 'b'), {'c': ('d')}))
-    ('a', 'b', _KWARG_MARK, ('c', 'd'))
 
-    .. _hashable: https://docs.python.org/2/glossary.html#term-hashable
-    """
+def _get_hit_hook(wrapper, cache):
+    # a cache reporting to the same stats as a decorator already
+    # counts its own hits
+    if getattr(cache, 'stats', None) is wrapper.stats:
+        return None
+    return wrapper._on_hit
 
-    # key = [func_name] if func_name else []
-    # key.extend(args)
-    key = list(args)
-    if kwargs:
-        sorted_items = sorted(kwargs.items())
-        key.append(kwarg_mark)
-        key.extend(sorted_items)
-    if typed:
-        key.extend([type(v) for v in args])
-        if kwargs:
-            key.extend([type(v) for k, v in sorted_items])
-    elif len(key) == 1 and type(key[0]) in fasttypes:
-        return key[0]
-    return _HashedKey(key)
 
-# for backwards compatibility in case someone was importing it
-_make_cache_key = make_cache_key
+def _timed_call(func, key, on_miss_complete):
+    def _timed(*args, **kwargs):
+        start = time.perf_counter()
+        ret = func(*args, **kwargs)
+        on_miss_complete(key, time.perf_counter() - start)
+        return ret
+    return _timed
+
+
+def _timed_call_async(func, key, on_miss_complete):
+    async def _timed(*args, **kwargs):
+        start = time.perf_counter()
+        ret = await func(*args, **kwargs)
+        on_miss_complete(key, time.perf_counter() - start)
+        return ret
+    return _timed
+
+
+def _mark_coroutine_function(obj):
+    # lets inspect.iscoroutinefunction() see through the wrapper on
+    # Python 3.12+. older versions lack markcoroutinefunction(), so the
+    # wrapper gets the marker asyncio.iscoroutinefunction() looks for,
+    # which _is_coroutine_function() checks, too.
+    if hasattr(inspect, 'markcoroutinefunction'):
+        inspect.markcoroutinefunction(obj)
+    else:
+        import asyncio.coroutines
+        obj._is_coroutine = asyncio.coroutines._is_coroutine
+    return obj
+
+
+def _is_coroutine_function(func):
+    # inspect.iscoroutinefunction(), plus the wrappers marked above on
+    # Python < 3.12, so that cached coroutine functions can be stacked
+    if inspect.iscoroutinefunction(func):
+        return True
+    if hasattr(inspect, 'markcoroutinefunction'):
+        return False
+    import asyncio.coroutines
+    return (getattr(func, '_is_coroutine', None)
+            is asyncio.coroutines._is_coroutine)
 
 
 class CachedFunction:
     """This type is used by :func:`cached`, below. Instances of this
     class are used to wrap functions in caching logic.
     """
-    def __init__(self, func, cache, scoped=True, typed=False, key=None):
+    def __init__(self, func, cache, scoped=True, typed=False, key=None,
+                 coalesce=False, soft_ttl=None, hard_ttl=None, executor=None,
+                 stats=None, negative_cache=None):
         self.func = func
         if callable(cache):
             self.get_cache = cache
@@ -453,14 +2923,73 @@ class CachedFunction:
         self.scoped = scoped
         self.typed = typed
         self.key_func = key or make_cache_key
+        # only the default key function gets calls normalized against
+        # the signature, as custom ones may rely on the original kwargs
+        self._first_default, self._defaults, self._normalize = (
+            _get_call_normalizer(func) if key is None
+            else (0, frozenset(), None))
+        self.coalesce = coalesce
+        self._single_flight = _SingleFlight() if coalesce else None
+        self._refresher = None
+        if soft_ttl is not None:
+            self._refresher = _Refresher(soft_ttl, hard_ttl, executor)
+        elif hard_ttl is not None:
+            raise TypeError('expected soft_ttl to go with hard_ttl')
+        if negative_cache is not None and self._refresher is not None:
+            raise TypeError('negative_cache is not supported with soft_ttl')
+        self.negative_cache = negative_cache
+        self.stats = stats
+        self._on_hit = getattr(stats, 'on_hit', None)
+        self._on_miss_complete = getattr(stats, 'on_miss_complete', None)
+        self._on_refresh_error = getattr(stats, 'on_refresh_error', None)
+
+    def _make_key(self, args, kwargs):
+        if self._normalize and (kwargs or (len(args) > self._first_default
+                                           and args[-1] in self._defaults)):
+            key_args, key_kwargs = self._normalize(args, kwargs)
+            return self.key_func(key_args, key_kwargs, typed=self.typed)
+        return self.key_func(args, kwargs, typed=self.typed)
 
     def __call__(self, *args, **kwargs):
         cache = self.get_cache()
-        key = self.key_func(args, kwargs, typed=self.typed)
-        try:
-            ret = cache[key]
-        except KeyError:
-            ret = cache[key] = self.func(*args, **kwargs)
+        # _make_key() inlined, as the hit path is the hot path. calls
+        # leaving out all defaults, the most common, skip normalizing.
+        if self._normalize and (kwargs or (len(args) > self._first_default
+                                           and args[-1] in self._defaults)):
+            key_args, key_kwargs = self._normalize(args, kwargs)
+            key = self.key_func(key_args, key_kwargs, typed=self.typed)
+        else:
+            key = self.key_func(args, kwargs, typed=self.typed)
+        if self._refresher is None:
+            try:
+                ret = cache[key]
+            except KeyError:
+                pass
+            else:
+                if (self._on_hit is not None
+                        and getattr(cache, 'stats', None) is not self.stats):
+                    self._on_hit(key)
+                return ret
+
+        func = self.func
+        if self._on_miss_complete is not None:
+            func = _timed_call(func, key, self._on_miss_complete)
+        if self._refresher is not None:
+            return self._refresher.get(cache, key, func, args, kwargs,
+                                       self._single_flight,
+                                       _get_hit_hook(self, cache),
+                                       self._on_refresh_error)
+        fill = _set_cache_result
+        if self.negative_cache is not None:
+            ret = self.negative_cache._replay(self.func, key)
+            if ret is not _MISSING:
+                return ret
+            fill = partial(self.negative_cache._fill, self.func)
+        if self._single_flight is None:
+            ret = fill(cache, key, func, args, kwargs)
+        else:
+            ret = self._single_flight.run(
+                (id(cache), key), fill, (cache, key, func, args, kwargs), {})
         return ret
 
     def __repr__(self):
@@ -475,7 +3004,9 @@ class CachedMethod:
     """Similar to :class:`CachedFunction`, this type is used by
     :func:`cachedmethod` to wrap methods in caching logic.
     """
-    def __init__(self, func, cache, scoped=True, typed=False, key=None):
+    def __init__(self, func, cache, scoped=True, typed=False, key=None,
+                 coalesce=False, soft_ttl=None, hard_ttl=None, executor=None,
+                 stats=None, negative_cache=None):
         self.func = func
         self.__isabstractmethod__ = getattr(func, '__isabstractmethod__', False)
         if isinstance(cache, str):
@@ -494,30 +3025,93 @@ class CachedMethod:
         self.scoped = scoped
         self.typed = typed
         self.key_func = key or make_cache_key
+        # as with CachedFunction, skipping the self parameter, which
+        # is never part of args for bound methods
+        self._first_default, self._defaults, self._normalize = (
+            _get_call_normalizer(func, skip=1) if key is None
+            else (0, frozenset(), None))
+        self.coalesce = coalesce
+        self._single_flight = _SingleFlight() if coalesce else None
+        self._refresher = None
+        if soft_ttl is not None:
+            self._refresher = _Refresher(soft_ttl, hard_ttl, executor)
+        elif hard_ttl is not None:
+            raise TypeError('expected soft_ttl to go with hard_ttl')
+        if negative_cache is not None and self._refresher is not None:
+            raise TypeError('negative_cache is not supported with soft_ttl')
+        self.negative_cache = negative_cache
+        self.stats = stats
+        self._on_hit = getattr(stats, 'on_hit', None)
+        self._on_miss_complete = getattr(stats, 'on_miss_complete', None)
+        self._on_refresh_error = getattr(stats, 'on_refresh_error', None)
         self.bound_to = None
 
     def __get__(self, obj, objtype=None):
         if obj is None:
             return self
+        # a shallow copy, made on every attribute access, so skipping
+        # __init__. bound copies share in-flight calls with the original.
         cls = self.__class__
-        ret = cls(self.func, self.get_cache, typed=self.typed,
-                  scoped=self.scoped, key=self.key_func)
+        ret = cls.__new__(cls)
+        ret.__dict__.update(self.__dict__)
         ret.bound_to = obj
         return ret
 
     def __call__(self, *args, **kwargs):
         obj = args[0] if self.bound_to is None else self.bound_to
         cache = self.get_cache(obj)
-        key_args = (self.bound_to, self.func) + args if self.scoped else args
-        key = self.key_func(key_args, kwargs, typed=self.typed)
-        try:
-            ret = cache[key]
-        except KeyError:
-            if self.bound_to is not None:
-                args = (self.bound_to,) + args
-            ret = cache[key] = self.func(*args, **kwargs)
+        # _make_key() inlined, as with CachedFunction
+        if ((kwargs or (len(args) > self._first_default
+                        and args[-1] in self._defaults))
+                and self._normalize and self.bound_to is not None):
+            key_args, key_kwargs = self._normalize(args, kwargs)
+        else:
+            key_args, key_kwargs = args, kwargs
+        if self.scoped:
+            key_args = (self.bound_to, self.func) + key_args
+        key = self.key_func(key_args, key_kwargs, typed=self.typed)
+        if self._refresher is None:
+            try:
+                ret = cache[key]
+            except KeyError:
+                pass
+            else:
+                if (self._on_hit is not None
+                        and getattr(cache, 'stats', None) is not self.stats):
+                    self._on_hit(key)
+                return ret
+
+        func = self.func
+        if self._on_miss_complete is not None:
+            func = _timed_call(func, key, self._on_miss_complete)
+        if self.bound_to is not None:
+            args = (self.bound_to,) + args
+        if self._refresher is not None:
+            return self._refresher.get(cache, key, func, args, kwargs,
+                                       self._single_flight,
+                                       _get_hit_hook(self, cache),
+                                       self._on_refresh_error)
+        fill = _set_cache_result
+        if self.negative_cache is not None:
+            ret = self.negative_cache._replay(self.func, key)
+            if ret is not _MISSING:
+                return ret
+            fill = partial(self.negative_cache._fill, self.func)
+        if self._single_flight is None:
+            ret = fill(cache, key, func, args, kwargs)
+        else:
+            ret = self._single_flight.run(
+                (id(cache), key), fill, (cache, key, func, args, kwargs), {})
         return ret
 
+    def _make_key(self, args, kwargs):
+        if ((kwargs or (len(args) > self._first_default
+                        and args[-1] in self._defaults))
+                and self._normalize and self.bound_to is not None):
+            args, kwargs = self._normalize(args, kwargs)
+        key_args = (self.bound_to, self.func) + args if self.scoped else args
+        return self.key_func(key_args, kwargs, typed=self.typed)
+
     def __repr__(self):
         cn = self.__class__.__name__
         args = (cn, self.func, self.scoped, self.typed)
@@ -527,7 +3121,87 @@ class CachedMethod:
         return ("%s(func=%r, scoped=%r, typed=%r)" % args)
 
 
-def cached(cache, scoped=True, typed=False, key=None):
+class AsyncCachedFunction(CachedFunction):
+    """The :class:`CachedFunction` used by :func:`cached` for coroutine
+    functions. Calling it returns a coroutine, and it is the result of
+    awaiting the wrapped function that is cached, not the coroutine
+    object itself. Concurrent awaits on the same key always share a
+    single task.
+    """
+    def __init__(self, func, cache, scoped=True, typed=False, key=None,
+                 coalesce=True, stats=None, negative_cache=None):
+        super().__init__(func, cache, scoped=scoped, typed=typed, key=key,
+                         stats=stats, negative_cache=negative_cache)
+        self.coalesce = True
+        self._single_flight = _AsyncSingleFlight()
+        _mark_coroutine_function(self)
+
+    async def __call__(self, *args, **kwargs):
+        cache = self.get_cache()
+        key = self._make_key(args, kwargs)
+        try:
+            ret = cache[key]
+        except KeyError:
+            func = self.func
+            if self._on_miss_complete is not None:
+                func = _timed_call_async(func, key, self._on_miss_complete)
+            fill = _set_cache_result_async
+            if self.negative_cache is not None:
+                ret = self.negative_cache._replay(self.func, key)
+                if ret is not _MISSING:
+                    return ret
+                fill = partial(self.negative_cache._fill_async, self.func)
+            ret = await self._single_flight.run(
+                (id(cache), key), fill, (cache, key, func, args, kwargs), {})
+        else:
+            if (self._on_hit is not None
+                    and getattr(cache, 'stats', None) is not self.stats):
+                self._on_hit(key)
+        return ret
+
+
+class AsyncCachedMethod(CachedMethod):
+    """The :class:`CachedMethod` used by :func:`cachedmethod` for
+    coroutine methods. See :class:`AsyncCachedFunction` for details.
+    """
+    def __init__(self, func, cache, scoped=True, typed=False, key=None,
+                 coalesce=True, stats=None, negative_cache=None):
+        super().__init__(func, cache, scoped=scoped, typed=typed, key=key,
+                         stats=stats, negative_cache=negative_cache)
+        self.coalesce = True
+        self._single_flight = _AsyncSingleFlight()
+        _mark_coroutine_function(self)
+
+    async def __call__(self, *args, **kwargs):
+        obj = args[0] if self.bound_to is None else self.bound_to
+        cache = self.get_cache(obj)
+        key = self._make_key(args, kwargs)
+        try:
+            ret = cache[key]
+        except KeyError:
+            if self.bound_to is not None:
+                args = (self.bound_to,) + args
+            func = self.func
+            if self._on_miss_complete is not None:
+                func = _timed_call_async(func, key, self._on_miss_complete)
+            fill = _set_cache_result_async
+            if self.negative_cache is not None:
+                ret = self.negative_cache._replay(self.func, key)
+                if ret is not _MISSING:
+                    return ret
+                fill = partial(self.negative_cache._fill_async, self.func)
+            ret = await self._single_flight.run(
+                (id(cache), key), fill, (cache, key, func, args, kwargs), {})
+        else:
+            if (self._on_hit is not None
+                    and getattr(cache, 'stats', None) is not self.stats):
+                self._on_hit(key)
+        return ret
+
+
+def cached(cache, scoped=True, typed=False, key=None, coalesce=False,
+           soft_ttl=None, hard_ttl=None, executor=None, stats=None,
+           negative_cache=None):
     """Cache any function with the cache object of your choosing. Note
     that the function wrapped should take only `hashable`_ arguments.
 
@@ -546,6 +3220,37 @@ def cached(cache, scoped=True, typed=False, key=None):
         typed (bool): Whether to factor argument types into the cache
             check. Default ``False``, setting to ``True`` causes the
             cache keys for ``3`` and ``3.0`` to be considered unequal.
+        coalesce (bool): Whether concurrent cache misses on the same
+            key should share a single call. Default ``False``. When
+            ``True``, only the first thread to miss calls the function,
+            while the rest wait and receive its return value, or
+            exception. Useful for expensive functions with popular
+            keys, which would otherwise all be computed at once.
+        soft_ttl (float): Number of seconds after which a cached
+            result is considered stale. Stale results are still
+            returned right away, while a fresh result is computed in
+            the background, at most once per key at a time. Default
+            ``None``, for results which never go stale.
+        hard_ttl (float): Number of seconds after which a cached
+            result is no longer returned, and callers wait for a fresh
+            one. Requires *soft_ttl*. Default ``None``, for stale
+            results to be returned until they are refreshed.
+        executor (concurrent.futures.Executor): Runs background
+            refreshes. Defaults to a small thread pool shared by all
+            cached functions.
+        stats (CacheStats): An object whose ``on_hit(key)`` method is
+            called on cache hits, and whose ``on_miss_complete(key,
+            elapsed)`` method is called with the number of seconds the
+            function took on each cache miss. With *soft_ttl*, its
+            ``on_refresh_error(key, exception)`` method is called when
+            a background refresh fails. Each method is optional. See
+            :class:`CacheStats`.
+        negative_cache (NegativeCache): Where to cache "not found"
+            results, such as :exc:`KeyError` exceptions or ``None``
+            return values, separately from *cache* and usually with a
+            shorter ttl. Default ``None``, for exceptions to never be
+            cached, and all results to go in *cache*. Not supported
+            with *soft_ttl*.
 
     >>> my_cache = LRU()
     >>> @cached(my_cache)
@@ -557,15 +3262,44 @@ def cached(cache, scoped=True, typed=False, key=None):
     >>> len(my_cache)
     1
 
+    By default, calls are keyed by their arguments as bound to the
+    function's signature, so ``f(1)``, ``f(1, 2)`` and ``f(1, b=2)``
+    share one cache entry, for a function defined as ``def f(a,
+    b=2)``. Custom *key* functions receive the arguments as passed.
+
+    With *soft_ttl*, the cache holds the function's results along with
+    their deadlines, and failed background refreshes leave stale
+    results in place, to be retried by the first call after another
+    *soft_ttl*. This is often a
+    good fit for configuration and other lookups which can tolerate
+    slightly out-of-date values, but not waiting on a refresh.
+
+    Coroutine functions are also supported. For these, the awaited
+    result is cached, and concurrent awaits of the same key share a
+    single task, regardless of *coalesce*. *soft_ttl* is not yet
+    supported for coroutine functions.
+
     .. _hashable: https://docs.python.org/2/glossary.html#term-hashable
 
     """
     def cached_func_decorator(func):
-        return CachedFunction(func, cache, scoped=scoped, typed=typed, key=key)
+        if _is_coroutine_function(func):
+            if soft_ttl is not None:
+                raise TypeError('soft_ttl is not supported for coroutine'
+                                ' functions, not %r' % func)
+            return AsyncCachedFunction(func, cache, scoped=scoped,
+                                       typed=typed, key=key, stats=stats,
+                                       negative_cache=negative_cache)
+        return CachedFunction(func, cache, scoped=scoped, typed=typed,
+                              key=key, coalesce=coalesce, soft_ttl=soft_ttl,
+                              hard_ttl=hard_ttl, executor=executor,
+                              stats=stats, negative_cache=negative_cache)
     return cached_func_decorator
 
 
-def cachedmethod(cache, scoped=True, typed=False, key=None):
+def cachedmethod(cache, scoped=True, typed=False, key=None, coalesce=False,
+                 soft_ttl=None, hard_ttl=None, executor=None, stats=None,
+                 negative_cache=None):
     """Similar to :func:`cached`, ``cachedmethod`` is used to cache
     methods based on their arguments, using any :class:`dict`-like
     *cache* object.
@@ -586,6 +3320,18 @@ def cachedmethod(cache, scoped=True, typed=False, key=None):
         key (callable): A callable with a signature that matches
             :func:`make_cache_key` that returns a tuple of hashable
             values to be used as the key in the cache.
+        coalesce (bool): Whether concurrent cache misses on the same
+            key should share a single call, as with :func:`cached`.
+        soft_ttl (float): Seconds until results go stale, refreshing
+            them in the background, as with :func:`cached`.
+        hard_ttl (float): Seconds until stale results are no longer
+            returned, as with :func:`cached`.
+        executor (concurrent.futures.Executor): Runs background
+            refreshes, as with :func:`cached`.
+        stats (CacheStats): Receives hit and miss timing events, as
+            with :func:`cached`.
+        negative_cache (NegativeCache): Caches "not found" results
+            separately, as with :func:`cached`.
 
     >>> class Lowerer(object):
     ...     def __init__(self):
@@ -601,9 +3347,21 @@ def cachedmethod(cache, scoped=True, typed=False, key=None):
     >>> len(lowerer.cache)
     1
 
+    As with :func:`cached`, coroutine methods have their awaited
+    results cached.
     """
     def cached_method_decorator(func):
-        return CachedMethod(func, cache, scoped=scoped, typed=typed, key=key)
+        if _is_coroutine_function(func):
+            if soft_ttl is not None:
+                raise TypeError('soft_ttl is not supported for coroutine'
+                                ' methods, not %r' % func)
+            return AsyncCachedMethod(func, cache, scoped=scoped,
+                                     typed=typed, key=key, stats=stats,
+                                     negative_cache=negative_cache)
+        return CachedMethod(func, cache, scoped=scoped, typed=typed,
+                            key=key, coalesce=coalesce, soft_ttl=soft_ttl,
+                            hard_ttl=hard_ttl, executor=executor,
+                            stats=stats, negative_cache=negative_cache)
     return cached_method_decorator
 
 
@@ -633,6 +3391,132 @@ class cachedproperty:
         return f'<{cn} func={self.func}>'
 
 
+class threadsafe_cachedproperty(cachedproperty):
+    """A :class:`cachedproperty` which calls the wrapped method only once
+    per instance, even when several threads access it at the same
+    time. Useful for expensive lazy attributes, such as loading a
+    large file or model, where duplicate work means wasted time and
+    memory.
+
+    >>> class Model:
+    ...     @threadsafe_cachedproperty
+    ...     def weights(self):
+    ...         print('loading...')
+    ...         return [0.5, 0.25]
+    >>> model = Model()
+    >>> model.weights
+    loading...
+    [0.5, 0.25]
+    >>> model.weights
+    [0.5, 0.25]
+
+    Locks are only taken while the value is missing. Once stored on
+    the instance, the value is found by normal attribute lookup,
+    without calling into the property at all. Each instance gets its
+    own lock, created on demand and discarded once no thread is
+    waiting on it, so slow computations for one instance do not
+    block others. If the wrapped method raises an exception, nothing
+    is stored, and the next access tries again.
+    """
+    def __init__(self, func):
+        super().__init__(func)
+        self._lock = RLock()
+        self._instance_locks = {}  # id(obj) -> [lock, thread count]
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        name = self.func.__name__
+        # the obj is alive for the whole call, so its id is unique
+        obj_id = id(obj)
+        with self._lock:
+            try:
+                entry = self._instance_locks[obj_id]
+            except KeyError:
+                entry = self._instance_locks[obj_id] = [RLock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                try:
+                    # another thread may have computed it while we waited
+                    return obj.__dict__[name]
+                except KeyError:
+                    pass
+                value = obj.__dict__[name] = self.func(obj)
+                return value
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._instance_locks[obj_id]
+
+
+async def _resolved(value):
+    return value
+
+
+class async_cachedproperty(cachedproperty):
+    """The counterpart of :class:`cachedproperty` for coroutine
+    functions. The property is awaited, and the wrapped coroutine
+    function is called only once per instance, even when the property
+    is awaited concurrently.
+
+    >>> import asyncio
+    >>> class Index:
+    ...     @async_cachedproperty
+    ...     async def entries(self):
+    ...         print('building...')
+    ...         return {'a': 1}
+    >>> async def main():
+    ...     index = Index()
+    ...     return await asyncio.gather(index.entries, index.entries)
+    >>> asyncio.run(main())
+    building...
+    [{'a': 1}, {'a': 1}]
+
+    The first access starts the coroutine as a :class:`asyncio.Task`,
+    which is stored on the instance, and shared by all awaits. A
+    cancelled await does not cancel the shared task. If the coroutine
+    raises an exception, the task is discarded, so the next access
+    tries again. Like other :mod:`asyncio` objects, the task belongs
+    to one event loop, and should only be awaited from it.
+
+    Assigning to the property replaces the cached value, which later
+    awaits return as-is, without calling the wrapped function.
+    """
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        import asyncio
+        name = self.func.__name__
+        task = obj.__dict__.get(name, _MISSING)
+        if task is _MISSING:
+            loop = asyncio.get_running_loop()
+            task = obj.__dict__[name] = loop.create_task(self.func(obj))
+
+            def _discard_failed(task):
+                if task.cancelled() or task.exception() is not None:
+                    if obj.__dict__.get(name) is task:
+                        del obj.__dict__[name]
+            task.add_done_callback(_discard_failed)
+        elif not isinstance(task, asyncio.Future):
+            return _resolved(task)  # an assigned value
+        if task.done():
+            return task
+        return asyncio.shield(task)
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.func.__name__] = value
+
+    def __delete__(self, obj):
+        # defining __set__ and __delete__ makes this a data descriptor,
+        # so that every access goes through __get__, and shield()
+        try:
+            del obj.__dict__[self.func.__name__]
+        except KeyError:
+            raise AttributeError(self.func.__name__)
+
+
 class ThresholdCounter:
     """A **bounded** dict-like Mapping from keys to counts. The
     ThresholdCounter automatically compacts after every (1 /
@@ -808,6 +3692,243 @@ class ThresholdCounter:
             self.update(kwargs)
 
 
+class SpaceSavingCounter:
+    """A **fixed-size** dict-like Mapping from keys to approximate
+    counts, for finding the most common keys ("heavy hitters") in
+    streams with too many distinct keys to count exactly, such as
+    client IPs. Unlike the :class:`ThresholdCounter`, whose size
+    depends on the data, the ``SpaceSavingCounter`` never tracks more
+    than *capacity* keys.
+
+    >>> ssc = SpaceSavingCounter(capacity=2)
+    >>> ssc.update('aaaabbc')
+    >>> ssc.most_common()
+    [('a', 4), ('c', 3)]
+    >>> ssc.get_error('c')
+    2
+
+    When full, a new key replaces the key with the lowest count, and
+    inherits that count, so counts can only be overestimated, never
+    underestimated. The bounds are:
+
+      * A key's count exceeds its true count by at most
+        ``get_error(key)``, which is at most ``total / capacity``.
+      * Any key seen more than ``total / capacity`` times is tracked.
+
+    So a *capacity* of ``1000`` finds all keys making up more than
+    0.1% of the data, as with a :class:`ThresholdCounter` with a
+    *threshold* of ``0.001``, and the API is otherwise kept similar.
+
+    Counters filled separately, e.g., by several worker processes, can
+    be combined with :meth:`merge`, with the same guarantees as if one
+    counter had seen all the data.
+
+    This algorithm is the Space-Saving algorithm, described in
+    "Efficient Computation of Frequent and Top-k Elements in Data
+    Streams" by Metwally, Agrawal & El Abbadi.
+    """
+    def __init__(self, capacity=1000):
+        if capacity <= 0:
+            raise ValueError('expected capacity > 0, not %r' % capacity)
+        self.capacity = capacity
+        self.total = 0
+        self._count_map = {}  # key -> [count, error]
+        # keys grouped by count, with a heap of counts to find the
+        # lowest. the heap may hold stale counts, skipped lazily.
+        self._buckets = {}
+        self._bucket_heap = []
+
+    def _add_to_bucket(self, key, count):
+        try:
+            self._buckets[count][key] = None
+        except KeyError:
+            self._buckets[count] = {key: None}
+            heapq.heappush(self._bucket_heap, count)
+
+    def _remove_from_bucket(self, key, count):
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+
+    def _get_min_count(self):
+        heap, buckets = self._bucket_heap, self._buckets
+        if len(heap) > 2 * len(buckets) + 64:
+            heap[:] = sorted(buckets)  # a sorted list is a valid heap
+        while heap[0] not in buckets:
+            heapq.heappop(heap)
+        return heap[0]
+
+    def _get_floor(self):
+        # the most any untracked key could have been seen
+        if len(self._count_map) < self.capacity:
+            return 0
+        return self._get_min_count()
+
+    def add(self, key, count=1):
+        """Increment the count of *key* by *count*, automatically adding
+        it if it does not exist. If the counter is full, the key with
+        the lowest count is replaced.
+        """
+        if count <= 0:
+            raise ValueError('expected count > 0, not %r' % count)
+        self.total += count
+        count_map = self._count_map
+        try:
+            entry = count_map[key]
+        except KeyError:
+            if len(count_map) < self.capacity:
+                entry = count_map[key] = [0, 0]
+            else:
+                min_count = self._get_min_count()
+                # the oldest key in the lowest bucket goes first
+                victim = next(iter(self._buckets[min_count]))
+                self._remove_from_bucket(victim, min_count)
+                del count_map[victim]
+                entry = count_map[key] = [min_count, min_count]
+        else:
+            self._remove_from_bucket(key, entry[0])
+        entry[0] += count
+        self._add_to_bucket(key, entry[0])
+
+    def update(self, iterable, **kwargs):
+        """Like dict.update() but add counts instead of replacing them, used
+        to add multiple items in one call.
+
+        Source can be an iterable of keys to add, or a mapping of keys
+        to integer counts.
+        """
+        if iterable is not None:
+            if callable(getattr(iterable, 'items', None)):
+                for key, count in iterable.items():
+                    self.add(key, count)
+            else:
+                for key in iterable:
+                    self.add(key)
+        if kwargs:
+            self.update(kwargs)
+
+    def merge(self, other):
+        """Add the counts of another ``SpaceSavingCounter`` into this
+        one, keeping the *capacity* keys with the highest combined
+        counts. Keys tracked by only one counter are credited with the
+        most they could have been seen by the other.
+        """
+        if not isinstance(other, SpaceSavingCounter):
+            raise TypeError('expected a SpaceSavingCounter, not %r'
+                            % (other,))
+        self_floor, other_floor = self._get_floor(), other._get_floor()
+        merged = {}
+        for key, (count, error) in self._count_map.items():
+            other_entry = other._count_map.get(key)
+            if other_entry is None:
+                merged[key] = [count + other_floor, error + other_floor]
+            else:
+                merged[key] = [count + other_entry[0],
+                               error + other_entry[1]]
+        for key, (count, error) in other._count_map.items():
+            if key not in merged:
+                merged[key] = [count + self_floor, error + self_floor]
+        kept = heapq.nlargest(self.capacity, merged.items(),
+                              key=lambda item: item[1][0])
+        self.total += other.total
+        self._count_map = {}
+        self._buckets = {}
+        self._bucket_heap = []
+        for key, entry in kept:
+            self._count_map[key] = entry
+            self._add_to_bucket(key, entry[0])
+
+    def get_error(self, key, default=0):
+        """Get the most by which the count for *key* may be overestimated,
+        defaulting to 0.
+        """
+        try:
+            return self._count_map[key][1]
+        except KeyError:
+            return default
+
+    def elements(self):
+        """Return an iterator of all the elements tracked by the counter.
+        Yields each key as many times as its (estimated) count.
+        """
+        repeaters = itertools.starmap(itertools.repeat, self.iteritems())
+        return itertools.chain.from_iterable(repeaters)
+
+    def most_common(self, n=None):
+        """Get the top *n* keys and counts as tuples. If *n* is omitted,
+        returns all the pairs.
+        """
+        if n is None:
+            return sorted(self.iteritems(), key=lambda x: x[1], reverse=True)
+        if n <= 0:
+            return []
+        return heapq.nlargest(n, self.iteritems(), key=lambda x: x[1])
+
+    def get_common_count(self):
+        """Get the sum of counts guaranteed to belong to the tracked keys,
+        excluding the counts they may have inherited from replaced keys.
+        """
+        return sum([count - error for count, error
+                    in self._count_map.values()])
+
+    def get_uncommon_count(self):
+        """Get the sum of counts not guaranteed to belong to the tracked
+        keys. The long-tail counts.
+        """
+        return self.total - self.get_common_count()
+
+    def get_commonality(self):
+        """Get a float representation of the effective count accuracy. The
+        higher the number, the less uniform the keys being added, and
+        the higher the accuracy of the SpaceSavingCounter.
+        """
+        return float(self.get_common_count()) / self.total
+
+    def __getitem__(self, key):
+        return self._count_map[key][0]
+
+    def __len__(self):
+        return len(self._count_map)
+
+    def __contains__(self, key):
+        return key in self._count_map
+
+    def iterkeys(self):
+        return iter(self._count_map)
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def itervalues(self):
+        count_map = self._count_map
+        for k in count_map:
+            yield count_map[k][0]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        count_map = self._count_map
+        for k in count_map:
+            yield (k, count_map[k][0])
+
+    def items(self):
+        return list(self.iteritems())
+
+    def get(self, key, default=0):
+        "Get count for *key*, defaulting to 0."
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return (f'{cn}(capacity={self.capacity!r}, total={self.total!r},'
+                f' most_common={self.most_common(3)!r})')
+
+
 class MinIDMap:
     """
     Assigns arbitrary weakref-able objects the smallest possible unique
@@ -845,7 +3966,6 @@ class MinIDMap:
         heapq.heappush(self.free, freed)
 
     def _clean(self, ref):
-        print(self.ref_map[ref])
         heapq.heappush(self.free, self.ref_map[ref])
         del self.ref_map[ref]
 
@@ -862,4 +3982,149 @@ class MinIDMap:
         return iter((k, self.mapping[k][0]) for k in iter(self.mapping))
 
 
+class _IDBitmap:
+    """A set of nonnegative integers, stored as a list of 64-bit
+    words, one bit per integer, along with a heap of the indexes of
+    nonzero words, so that the smallest member is found without
+    scanning. Only the heap's smallest word ever becomes zero, so the
+    heap is only pushed and popped when a word fills or empties. (A
+    list of ints is somewhat larger than an array, but quicker.)
+    """
+    __slots__ = ('words', 'heap', 'count')
+
+    def __init__(self):
+        self.words = []
+        self.heap = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, i):
+        words = self.words
+        idx = i >> 6
+        return idx < len(words) and bool(words[idx] >> (i & 63) & 1)
+
+    def add(self, i):
+        "Add *i*, which must not already be a member."
+        words = self.words
+        idx = i >> 6
+        if idx >= len(words):
+            words.extend([0] * (idx + 1 - len(words)))
+        word = words[idx]
+        if not word:
+            heapq.heappush(self.heap, idx)
+        words[idx] = word | (1 << (i & 63))
+        self.count += 1
+
+    def pop_min(self):
+        "Remove and return the smallest member."
+        heap = self.heap
+        if not heap:
+            raise KeyError('pop_min from an empty set')
+        idx = heap[0]
+        word = self.words[idx]
+        low_bit = word & -word
+        self.words[idx] = word ^ low_bit
+        if word == low_bit:
+            heapq.heappop(heap)
+        self.count -= 1
+        return (idx << 6) | (low_bit.bit_length() - 1)
+
+
+class StrongMinIDMap:
+    """A higher-throughput alternative to :class:`MinIDMap`, which
+    holds strong references to its objects, and so needs no weakref
+    callbacks, and works with any hashable object. IDs are released
+    explicitly, with :meth:`drop`, and assigned smallest first.
+
+    >>> idm = StrongMinIDMap()
+    >>> idm.get_many(['a', 'b', 'c'])
+    [0, 1, 2]
+    >>> idm.drop('a')
+    >>> idm.get('d'), idm.get('b'), idm.get('e')
+    (0, 1, 3)
+
+    Freed IDs are kept in a compact bitmap, about one bit per ID, from
+    which the smallest is found in a few steps, however many are free.
+    :meth:`get_many` and :meth:`drop_many` handle whole batches of
+    objects per call.
+
+    Use a :class:`MinIDMap` when objects should release their IDs
+    when garbage collected, and a ``StrongMinIDMap`` when their
+    lifetimes are known, as with connections or requests, or when
+    objects are created and discarded in large numbers.
+    """
+    def __init__(self):
+        self.mapping = {}
+        self._free = _IDBitmap()
+        self._next_id = 0  # the smallest ID never yet assigned
+
+    def get(self, a):
+        "Get the ID of *a*, assigning it the smallest free ID if needed."
+        try:
+            return self.mapping[a]
+        except KeyError:
+            pass
+        if self._free.count:
+            nxt = self._free.pop_min()
+        else:
+            nxt = self._next_id
+            self._next_id += 1
+        self.mapping[a] = nxt
+        return nxt
+
+    def get_many(self, objs):
+        "Get a list of the IDs of *objs*, assigning any as needed."
+        mapping, free = self.mapping, self._free
+        ret = []
+        for a in objs:
+            try:
+                ret.append(mapping[a])
+                continue
+            except KeyError:
+                pass
+            if free.count:
+                nxt = free.pop_min()
+            else:
+                nxt = self._next_id
+                self._next_id += 1
+            mapping[a] = nxt
+            ret.append(nxt)
+        return ret
+
+    def drop(self, a):
+        "Release the ID of *a*, raising a KeyError if it has none."
+        self._free.add(self.mapping.pop(a))
+
+    def drop_many(self, objs):
+        "Release the IDs of *objs*, skipping any without one."
+        mapping, free = self.mapping, self._free
+        for a in objs:
+            freed = mapping.pop(a, None)
+            if freed is not None:
+                free.add(freed)
+
+    def clear(self):
+        self.mapping.clear()
+        self._free = _IDBitmap()
+        self._next_id = 0
+
+    def __contains__(self, a):
+        return a in self.mapping
+
+    def __iter__(self):
+        return iter(self.mapping)
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def iteritems(self):
+        return iter(self.mapping.items())
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return f'<{cn} size={len(self)} max_id={self._next_id - 1}>'
+
+
 # end cacheutils.py
@@ -67,8 +67,10 @@ thanks to `Mark Williams`_ for all his help.
 
 """
 
-from collections.abc import KeysView, ValuesView, ItemsView
-from itertools import zip_longest
+from bisect import bisect_left, insort
+from itertools import chain, count, zip_longest
+from collections.abc import (Mapping, Collection, MappingView, KeysView,
+                             ValuesView, ItemsView)
 
 _MISSING = object()
 
@@ -76,7 +78,9 @@ _MISSING = object()
 PREV, NEXT, KEY, VALUE, SPREV, SNEXT = range(6)
 
 
-__all__ = ['MultiDict', 'OMD', 'OrderedMultiDict', 'OneToOne', 'ManyToMany', 'subdict', 'FrozenDict']
+__all__ = ['MultiDict', 'OMD', 'OrderedMultiDict', 'CompactOrderedMultiDict',
+           'OneToOne', 'ManyToMany', 'IndexedRecords', 'subdict', 'FrozenDict',
+           'PersistentFrozenDict']
 
 
 class OrderedMultiDict(dict):
@@ -269,6 +273,47 @@ class OrderedMultiDict(dict):
         """
         return cls([(k, default) for k in keys])
 
+    @classmethod
+    def from_pairs(cls, pairs):
+        """Create a dictionary from an iterable of (key, value) pairs,
+        keeping all values for repeated keys. The result is the same as
+        passing *pairs* to the constructor, but built in a single pass,
+        which is faster for large inputs, such as parsed query strings
+        and headers.
+
+        >>> OrderedMultiDict.from_pairs([('a', 1), ('b', 2), ('a', 3)])
+        OrderedMultiDict([('a', 1), ('b', 2), ('a', 3)])
+
+        Note that the pairs are not passed through :meth:`add`, so
+        subtypes which override it should use the constructor.
+        """
+        ret = cls()
+        ret._add_pairs(pairs)
+        return ret
+
+    def _add_pairs(self, pairs):
+        # add() and _insert() for a whole iterable of pairs, with the
+        # lookups they repeat for every item hoisted out of the loop
+        root = self.root
+        _map = self._map
+        get_values = super().get
+        set_values = super().__setitem__
+        last = root[PREV]
+        try:
+            for k, v in pairs:
+                values = get_values(k)
+                cell = [last, root, k, v]
+                if values is None:
+                    set_values(k, [v])
+                    _map[k] = [cell]
+                else:
+                    values.append(v)
+                    _map[k].append(cell)
+                last[NEXT] = cell
+                last = cell
+        finally:
+            root[PREV] = last
+
     def update(self, E, **F):
         """Add items from a dictionary or iterable (and/or keyword arguments),
         overwriting values under an existing key. See
@@ -624,16 +669,45 @@ class OrderedMultiDict(dict):
         kvs = ', '.join([repr((k, v)) for k, v in self.iteritems(multi=True)])
         return f'{cn}([{kvs}])'
 
-    def viewkeys(self):
-        "OMD.viewkeys() -> a set-like object providing a view on OMD's keys"
+    def _count_items(self):
+        # the number of items, counting every value of every key
+        return sum(map(len, super().values()))
+
+    def viewkeys(self, multi=False):
+        """OMD.viewkeys() -> a set-like object providing a view on OMD's keys
+
+        Set *multi* to ``True`` for a view on all the keys, including
+        duplicates, in insertion order. Unlike :meth:`keys`, views are
+        not copies, and reflect later changes to the OMD:
+
+        >>> omd = OrderedMultiDict([('a', 1), ('b', 2)])
+        >>> keys = omd.viewkeys(multi=True)
+        >>> omd.add('a', 3)
+        >>> list(keys), len(keys), 'b' in keys
+        (['a', 'b', 'a'], 3, True)
+        """
+        if multi:
+            return _MultiKeysView(self)
         return KeysView(self)
 
-    def viewvalues(self):
-        "OMD.viewvalues() -> an object providing a view on OMD's values"
+    def viewvalues(self, multi=False):
+        """OMD.viewvalues() -> an object providing a view on OMD's values
+
+        Set *multi* to ``True`` for a view on all the values, in
+        insertion order. See :meth:`viewkeys`.
+        """
+        if multi:
+            return _MultiValuesView(self)
         return ValuesView(self)
 
-    def viewitems(self):
-        "OMD.viewitems() -> a set-like object providing a view on OMD's items"
+    def viewitems(self, multi=False):
+        """OMD.viewitems() -> a set-like object providing a view on OMD's items
+
+        Set *multi* to ``True`` for a view on all the items, in
+        insertion order. See :meth:`viewkeys`.
+        """
+        if multi:
+            return _MultiItemsView(self)
         return ItemsView(self)
 
 
@@ -642,6 +716,55 @@ OMD = OrderedMultiDict
 MultiDict = OrderedMultiDict
 
 
+class _MultiView(MappingView, Collection):
+    # Views on all of an OMD's items, duplicate keys included. Not
+    # set-like, because of the duplicates. Lengths take time
+    # proportional to the number of unique keys, rather than items,
+    # except where the OMD type keeps count.
+    __slots__ = ()
+
+    def __len__(self):
+        return self._mapping._count_items()
+
+
+class _MultiKeysView(_MultiView):
+    __slots__ = ()
+
+    def __contains__(self, key):
+        return key in self._mapping
+
+    def __iter__(self):
+        return self._mapping.iterkeys(multi=True)
+
+
+class _MultiValuesView(_MultiView):
+    __slots__ = ()
+
+    def __contains__(self, value):
+        for values in dict.values(self._mapping):
+            if value in values:
+                return True
+        return False
+
+    def __iter__(self):
+        return self._mapping.itervalues(multi=True)
+
+
+class _MultiItemsView(_MultiView):
+    __slots__ = ()
+
+    def __contains__(self, item):
+        try:
+            key, value = item
+            values = dict.get(self._mapping, key)
+        except (TypeError, ValueError):
+            return False  # not a pair, or an unhashable key
+        return values is not None and value in values
+
+    def __iter__(self):
+        return self._mapping.iteritems(multi=True)
+
+
 class FastIterOrderedMultiDict(OrderedMultiDict):
     """An OrderedMultiDict backed by a skip list.  Iteration over keys
     is faster and uses constant memory but adding duplicate key-value
@@ -686,6 +809,12 @@ class FastIterOrderedMultiDict(OrderedMultiDict):
             last[NEXT] = root[PREV] = root[SPREV] = cell
             cells.append(cell)
 
+    def _add_pairs(self, pairs):
+        # each cell's skip links depend on the cells before it
+        self_add = self.add
+        for k, v in pairs:
+            self_add(k, v)
+
     def _remove(self, k):
         cells = self._map[k]
         cell = cells.pop()
@@ -740,6 +869,158 @@ class FastIterOrderedMultiDict(OrderedMultiDict):
             curr = curr[PREV]
 
 
+class CompactOrderedMultiDict(OrderedMultiDict):
+    """An OrderedMultiDict which stores its items in a pair of parallel
+    key and value lists, rather than a linked list of cells. This
+    uses 15-40% less memory per item, and builds faster, at the cost
+    of slower mutation and removal. Suited to large payloads which are
+    built once and then mostly read, like parsed form posts and
+    headers.
+
+    >>> comd = CompactOrderedMultiDict([('a', 1), ('b', 2), ('a', 3)])
+    >>> comd.getlist('a'), comd.poplast()
+    ([1, 3], 3)
+    >>> comd.items(multi=True)
+    [('a', 1), ('b', 2)]
+
+    Each key maps to a list of its positions. Removed items leave
+    tombstones in the lists, which are dropped once they make up half
+    of them. Building from items and copying are faster than with an
+    :class:`OrderedMultiDict`, and lookups and iteration are about as
+    fast, but ``__setitem__()``, :meth:`pop`, and :meth:`poplast` are
+    slower. Otherwise, the API and behavior are the same.
+    See ``misc/bench_omd.py`` for comparisons.
+    """
+    # the lists are compacted once there are this many tombstones and
+    # they are at least half of the lists
+    _compact_min = 16
+
+    def _clear_ll(self):
+        try:
+            _map = self._map
+        except AttributeError:
+            _map = self._map = {}
+        _map.clear()
+        self._keys = []
+        self._values = []
+        self._tombstones = 0
+
+    def _insert(self, k, v):
+        keys = self._keys
+        positions = self._map.get(k)
+        if positions is None:
+            self._map[k] = [len(keys)]
+        else:
+            positions.append(len(keys))
+        keys.append(k)
+        self._values.append(v)
+
+    def _add_pairs(self, pairs):
+        keys, values = self._keys, self._values
+        _map = self._map
+        dict_get, dict_setitem = dict.get, dict.__setitem__
+        for k, v in pairs:
+            key_values = dict_get(self, k)
+            if key_values is None:
+                dict_setitem(self, k, [v])
+                _map[k] = [len(keys)]
+            else:
+                key_values.append(v)
+                _map[k].append(len(keys))
+            keys.append(k)
+            values.append(v)
+
+    def _remove(self, k):
+        positions = self._map[k]
+        pos = positions.pop()
+        if not positions:
+            del self._map[k]
+        keys, values = self._keys, self._values
+        if pos == len(keys) - 1:
+            # the common case of popping the last item, which needs no
+            # tombstone
+            keys.pop()
+            values.pop()
+            if keys and keys[-1] is _MISSING:
+                self._trim()
+            return
+        keys[pos] = values[pos] = _MISSING
+        self._tombstones += 1
+        self._trim()
+
+    def _remove_all(self, k):
+        keys, values = self._keys, self._values
+        positions = self._map.pop(k)
+        for pos in positions:
+            keys[pos] = values[pos] = _MISSING
+        self._tombstones += len(positions)
+        self._trim()
+
+    def _trim(self):
+        # trailing tombstones are dropped right away, so that the last
+        # item is always live, then the rest if there are enough
+        keys, values = self._keys, self._values
+        while keys and keys[-1] is _MISSING:
+            keys.pop()
+            values.pop()
+            self._tombstones -= 1
+        tombstones = self._tombstones
+        if tombstones >= self._compact_min and tombstones * 2 >= len(keys):
+            self._compact()
+
+    def _compact(self):
+        _map = self._map
+        keys, values = [], []
+        for k, v in zip(self._keys, self._values):
+            if k is _MISSING:
+                continue
+            keys.append(k)
+            values.append(v)
+        # positions are rebuilt in the same per-key order
+        for positions in _map.values():
+            del positions[:]
+        for pos, k in enumerate(keys):
+            _map[k].append(pos)
+        self._keys, self._values = keys, values
+        self._tombstones = 0
+
+    def poplast(self, k=_MISSING, default=_MISSING):
+        if k is _MISSING and self._keys:
+            k = self._keys[-1]
+        return super().poplast(k, default)
+
+    def iteritems(self, multi=False):
+        if multi:
+            for k, v in zip(self._keys, self._values):
+                if k is not _MISSING:
+                    yield k, v
+        else:
+            for k in self.iterkeys():
+                yield k, self[k]
+
+    def iterkeys(self, multi=False):
+        if multi:
+            for k in self._keys:
+                if k is not _MISSING:
+                    yield k
+        else:
+            # each key is yielded at its first position
+            _map = self._map
+            for pos, k in enumerate(self._keys):
+                if k is not _MISSING and _map[k][0] == pos:
+                    yield k
+
+    def _count_items(self):
+        return len(self._keys) - self._tombstones
+
+    def __reversed__(self):
+        _map, keys = self._map, self._keys
+        for pos in range(len(keys) - 1, -1, -1):
+            k = keys[pos]
+            if k is not _MISSING and _map[k][0] == pos:
+                yield k
+
+
 _OTO_INV_MARKER = object()
 _OTO_UNIQUE_MARKER = object()
 
@@ -1013,6 +1294,319 @@ class ManyToMany:
         return f'{cn}({list(self.iteritems())!r})'
 
 
+class IndexedRecords:
+    """A collection of records, such as :class:`dict` objects, which
+    can be looked up by the values of their fields, and which indexes
+    the fields it is most often asked about.
+
+    >>> people = IndexedRecords([{'name': 'Ann', 'age': 31},
+    ...                          {'name': 'Bob', 'age': 25},
+    ...                          {'name': 'Cy', 'age': 31}])
+    >>> [p['name'] for p in people.find(age=31)]
+    ['Ann', 'Cy']
+    >>> [p['name'] for p in people.find_range('age', 20, 30)]
+    ['Bob']
+    >>> rid = people.add({'name': 'Di', 'age': 31})
+    >>> len(people.find(age=31)), people.remove(rid)['name']
+    (3, 'Di')
+
+    Lookups start out as scans of every record. Once the scans for a
+    field have visited *index_ratio* times as many records as are in
+    the collection, about what building an index costs, the field is
+    given a hash index for :meth:`find`, or a sorted index for
+    :meth:`find_range`. Set *index_ratio* to ``None`` to only use the
+    indexes created with :meth:`add_index`.
+
+    >>> people.indexed_fields
+    []
+    >>> [p['name'] for p in people.find(age=25)]
+    ['Bob']
+    >>> people.indexed_fields
+    ['age']
+
+    Indexes are kept up to date as records are added and removed, but
+    not as records themselves change, so records should be removed
+    and added again to update them. Hash indexes take constant time
+    to update, while sorted indexes are lists, and take time
+    proportional to the size of the collection, though with a small
+    constant factor. Records missing a field never
+    match it. Fields with unhashable values are never hash indexed,
+    and fields whose values cannot be compared are never sorted.
+
+    Args:
+        records (iterable): Initial records. Defaults to ``None``.
+        index_ratio (float): How many times over the collection a
+            field must be scanned before it is indexed. Defaults to
+            ``2.0``.
+    """
+    def __init__(self, records=None, index_ratio=2.0):
+        if index_ratio is not None and index_ratio < 0:
+            raise ValueError('expected index_ratio >= 0, not %r'
+                             % (index_ratio,))
+        self.index_ratio = index_ratio
+        self.scan_count = 0
+        self._records = {}
+        self._next_id = count()
+        self._indexes = {}  # field -> {value: {record id: None}}
+        self._sorted = {}  # field -> sorted list of (value, record id)
+        self._scan_costs = {}  # (field, is_sorted) -> records scanned
+        self._unindexable = set()  # (field, is_sorted)
+        if records:
+            self.extend(records)
+
+    @property
+    def indexed_fields(self):
+        return list(self._indexes)
+
+    @property
+    def sorted_fields(self):
+        return list(self._sorted)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records.values())
+
+    def __getitem__(self, rid):
+        return self._records[rid]
+
+    def __contains__(self, rid):
+        return rid in self._records
+
+    def add(self, record):
+        """Add *record*, returning its ID, an integer which can be passed
+        to :meth:`remove`, or used to get the record back by index.
+        """
+        rid = next(self._next_id)
+        self._records[rid] = record
+        for field, index in list(self._indexes.items()):
+            try:
+                value = record[field]
+            except KeyError:
+                continue
+            try:
+                index.setdefault(value, {})[rid] = None
+            except TypeError:
+                self._drop_unindexable(field, False)
+        for field, sorted_index in list(self._sorted.items()):
+            try:
+                value = record[field]
+            except KeyError:
+                continue
+            try:
+                insort(sorted_index, (value, rid))
+            except TypeError:
+                self._drop_unindexable(field, True)
+        return rid
+
+    def extend(self, records):
+        "Add each record in the iterable *records*."
+        for record in records:
+            self.add(record)
+
+    def remove(self, rid):
+        """Remove and return the record with the ID *rid*, raising a
+        :exc:`KeyError` if there is none.
+        """
+        record = self._records.pop(rid)
+        for field, index in self._indexes.items():
+            try:
+                value = record[field]
+            except KeyError:
+                continue
+            bucket = index[value]
+            del bucket[rid]
+            if not bucket:
+                del index[value]
+        for field, sorted_index in self._sorted.items():
+            try:
+                value = record[field]
+            except KeyError:
+                continue
+            del sorted_index[bisect_left(sorted_index, (value, rid))]
+        # shrink the scan costs along with the collection, so that
+        # they still count passes over it, rather than records from
+        # back when it was larger
+        size = len(self._records)
+        scan_costs = self._scan_costs
+        for key in scan_costs:
+            scan_costs[key] = scan_costs[key] * size / (size + 1)
+        return record
+
+    def clear(self):
+        """Remove all records, keeping the fields indexed. Scans made
+        before clearing no longer count toward indexing.
+        """
+        self._records.clear()
+        for index in self._indexes.values():
+            index.clear()
+        for sorted_index in self._sorted.values():
+            del sorted_index[:]
+        self._scan_costs.clear()
+        self._unindexable.clear()
+
+    def add_index(self, field, sorted=False):
+        """Index *field*, for :meth:`find` or, if *sorted* is ``True``, for
+        :meth:`find_range`. Raises a :exc:`TypeError` if the values of
+        *field* are unhashable, or cannot be sorted.
+        """
+        indexes = self._sorted if sorted else self._indexes
+        if field in indexes:
+            return
+        build = self._build_sorted if sorted else self._build_index
+        indexes[field] = build(field)
+        self._unindexable.discard((field, sorted))
+
+    def drop_index(self, field, sorted=False):
+        "Stop indexing *field*, if it is indexed."
+        indexes = self._sorted if sorted else self._indexes
+        indexes.pop(field, None)
+        self._scan_costs.pop((field, sorted), None)
+
+    def _build_index(self, field):
+        index = {}
+        for rid, record in self._records.items():
+            try:
+                value = record[field]
+            except KeyError:
+                continue
+            index.setdefault(value, {})[rid] = None
+        return index
+
+    def _build_sorted(self, field):
+        pairs = []
+        for rid, record in self._records.items():
+            try:
+                pairs.append((record[field], rid))
+            except KeyError:
+                continue
+        pairs.sort()
+        return pairs
+
+    def _drop_unindexable(self, field, sorted):
+        self.drop_index(field, sorted)
+        self._unindexable.add((field, sorted))
+
+    def _count_scan(self, field, sorted):
+        # counts a scan against field, returning True if it should be
+        # indexed, rather than scanned
+        if self.index_ratio is None or (field, sorted) in self._unindexable:
+            return False
+        key = (field, sorted)
+        cost = self._scan_costs.get(key, 0) + len(self._records)
+        if cost <= self.index_ratio * len(self._records):
+            self._scan_costs[key] = cost
+            return False
+        try:
+            self.add_index(field, sorted)
+        except TypeError:
+            self._drop_unindexable(field, sorted)
+            return False
+        return True
+
+    def find_ids(self, criteria=None, **kwargs):
+        """Get a list of the IDs of records whose fields equal all the
+        values in the :class:`dict` *criteria*, and/or keyword
+        arguments, in the order the records were added.
+        """
+        if criteria:
+            kwargs = dict(criteria, **kwargs)
+        if not kwargs:
+            return list(self._records)
+        indexes = self._indexes
+        for field in kwargs:
+            if field not in indexes:
+                self._count_scan(field, False)
+        # start with the smallest of the indexed candidate sets
+        candidates = None
+        for field, value in kwargs.items():
+            index = indexes.get(field)
+            if index is None:
+                continue
+            try:
+                bucket = index.get(value, {})
+            except TypeError:
+                return []  # unhashable, so no record can match
+            if candidates is None or len(bucket) < len(candidates):
+                candidates = bucket
+        if candidates is None:
+            self.scan_count += 1
+            candidates = self._records
+        records = self._records
+        ret = []
+        for rid in candidates:
+            record = records[rid]
+            for field, value in kwargs.items():
+                try:
+                    if record[field] != value:
+                        break
+                except KeyError:
+                    break
+            else:
+                ret.append(rid)
+        return ret
+
+    def find(self, criteria=None, **kwargs):
+        """Get a list of the records whose fields equal all the values in
+        the :class:`dict` *criteria*, and/or keyword arguments, in the
+        order they were added.
+        """
+        records = self._records
+        return [records[rid] for rid in self.find_ids(criteria, **kwargs)]
+
+    def find_range(self, field, start=None, stop=None):
+        """Get a list of the records whose *field* is greater than or
+        equal to *start*, and less than *stop*, sorted by *field*. A
+        *start* or *stop* of ``None`` leaves that end unbounded.
+        """
+        records = self._records
+        sorted_index = self._sorted.get(field)
+        if sorted_index is None and self._count_scan(field, True):
+            sorted_index = self._sorted[field]
+        if sorted_index is None:
+            self.scan_count += 1
+            pairs = []
+            for rid, record in records.items():
+                try:
+                    value = record[field]
+                    if ((start is None or start <= value)
+                            and (stop is None or value < stop)):
+                        pairs.append((value, rid))
+                except (KeyError, TypeError):
+                    continue
+            try:
+                pairs.sort()
+            except TypeError:
+                pass
+            return [records[rid] for _, rid in pairs]
+        # values which can't be compared with start or stop are
+        # skipped, as they are when scanning
+        lo, check_start = 0, False
+        if start is not None:
+            try:
+                lo = bisect_left(sorted_index, (start,))
+            except TypeError:
+                check_start = True
+        ret = []
+        for pos in range(lo, len(sorted_index)):
+            value, rid = sorted_index[pos]
+            try:
+                if check_start and not start <= value:
+                    continue
+                if stop is not None and not value < stop:
+                    break
+            except TypeError:
+                continue
+            ret.append(records[rid])
+        return ret
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return (f'<{cn} size={len(self)} indexed_fields={self.indexed_fields!r}'
+                f' sorted_fields={self.sorted_fields!r}>')
+
+
 def subdict(d, keep=None, drop=None):
     """Compute the "subdictionary" of a dict, *d*.
 
@@ -1113,4 +1707,265 @@ class FrozenDict(dict):
     del _raise_frozen_typeerror
 
 
+try:
+    _popcount = int.bit_count
+except AttributeError:  # Python < 3.10
+    def _popcount(x):
+        return bin(x).count('1')
+
+
+_HASH_MASK = (1 << 64) - 1  # hashes are used as unsigned 64-bit ints
+_HAMT_BITS = 5
+_HAMT_MASK = (1 << _HAMT_BITS) - 1
+
+
+class _HAMTNode:
+    # a node of a hash array mapped trie. each set bit of the bitmap
+    # stands for one entry, in order, which is either a (hash, key,
+    # value) leaf tuple, or a child node for the next 5 bits of hash.
+    __slots__ = ('bitmap', 'entries')
+
+    def __init__(self, bitmap, entries):
+        self.bitmap = bitmap
+        self.entries = entries
+
+    def assoc(self, h, key, value, shift):
+        # returns a node with key set to value, and whether the key is
+        # new, sharing all unchanged entries with this node
+        bit = 1 << ((h >> shift) & _HAMT_MASK)
+        idx = _popcount(self.bitmap & (bit - 1))
+        entries = self.entries
+        if not self.bitmap & bit:
+            new_entries = entries[:idx] + ((h, key, value),) + entries[idx:]
+            return _HAMTNode(self.bitmap | bit, new_entries), True
+        entry = entries[idx]
+        if type(entry) is tuple:
+            e_hash, e_key, e_value = entry
+            if e_hash == h and (e_key is key or e_key == key):
+                if e_value is value:
+                    return self, False
+                # as with dict, the original key object is kept
+                new_entry, added = (h, e_key, value), False
+            else:
+                new_entry = _merge_leaves(entry, (h, key, value),
+                                          shift + _HAMT_BITS)
+                added = True
+        else:
+            new_entry, added = entry.assoc(h, key, value, shift + _HAMT_BITS)
+            if new_entry is entry:
+                return self, False
+        new_entries = entries[:idx] + (new_entry,) + entries[idx + 1:]
+        return _HAMTNode(self.bitmap, new_entries), added
+
+    def iteritems(self):
+        for entry in self.entries:
+            if type(entry) is tuple:
+                yield entry[1], entry[2]
+            else:
+                yield from entry.iteritems()
+
+
+class _HAMTCollisionNode:
+    # holds the (key, value) pairs of keys whose hashes are identical
+    __slots__ = ('hash', 'pairs')
+
+    def __init__(self, h, pairs):
+        self.hash = h
+        self.pairs = pairs
+
+    def get(self, key, default):
+        for p_key, p_value in self.pairs:
+            if p_key is key or p_key == key:
+                return p_value
+        return default
+
+    def assoc(self, h, key, value, shift):
+        if h != self.hash:
+            # nest this node in a regular one, alongside the new key
+            node = _HAMTNode(1 << ((self.hash >> shift) & _HAMT_MASK), (self,))
+            return node.assoc(h, key, value, shift)
+        pairs = self.pairs
+        for idx, (p_key, p_value) in enumerate(pairs):
+            if p_key is key or p_key == key:
+                if p_value is value:
+                    return self, False
+                new_pairs = pairs[:idx] + ((p_key, value),) + pairs[idx + 1:]
+                return _HAMTCollisionNode(h, new_pairs), False
+        return _HAMTCollisionNode(h, pairs + ((key, value),)), True
+
+    def iteritems(self):
+        return iter(self.pairs)
+
+
+def _merge_leaves(leaf1, leaf2, shift):
+    # builds the smallest subtree holding two leaves with different
+    # keys, nesting until their hashes differ
+    h1, h2 = leaf1[0], leaf2[0]
+    if h1 == h2:
+        return _HAMTCollisionNode(h1, (leaf1[1:], leaf2[1:]))
+    idx1, idx2 = (h1 >> shift) & _HAMT_MASK, (h2 >> shift) & _HAMT_MASK
+    if idx1 == idx2:
+        return _HAMTNode(1 << idx1,
+                         (_merge_leaves(leaf1, leaf2, shift + _HAMT_BITS),))
+    entries = (leaf1, leaf2) if idx1 < idx2 else (leaf2, leaf1)
+    return _HAMTNode((1 << idx1) | (1 << idx2), entries)
+
+
+_EMPTY_HAMT = _HAMTNode(0, ())
+
+
+class PersistentFrozenDict(Mapping):
+    """An immutable, hashable mapping like :class:`FrozenDict`, for when
+    many slightly different versions are derived from one another, as
+    with layers of configuration. Its :meth:`updated` takes time and
+    memory proportional to the number of items changed, rather than
+    copying the whole mapping, with each version sharing the rest of
+    its structure with the one it came from.
+
+    >>> base = PersistentFrozenDict(host='localhost', port=8080)
+    >>> prod = base.updated(host='example.com')
+    >>> prod['host'], prod['port'], base['host']
+    ('example.com', 8080, 'localhost')
+    >>> prod == {'host': 'example.com', 'port': 8080}
+    True
+    >>> hash(prod) == hash(FrozenDict(prod))
+    True
+
+    Items are stored in a `hash array mapped trie
+    <https://en.wikipedia.org/wiki/Hash_array_mapped_trie>`_, with
+    32-way branching, so lookups and updates take a handful of steps,
+    even for large mappings. Lookups are still a good deal slower than
+    those on a :class:`dict`, so a :class:`FrozenDict` remains the
+    better choice when versions are few. Unlike a FrozenDict,
+    iteration follows the keys' hashes, not their insertion order, and
+    a PersistentFrozenDict is not a :class:`dict` subtype, so use
+    ``dict(pfd)`` to get one, as for JSON serialization.
+    """
+    __slots__ = ('_root', '_size', '_hash')
+
+    def __init__(self, *a, **kw):
+        if len(a) > 1:
+            raise TypeError('%s expected at most 1 argument, got %s'
+                            % (self.__class__.__name__, len(a)))
+        self._root, self._size = _EMPTY_HAMT, 0
+        if a or kw:
+            self._root, self._size = self._assoc_all(a, kw)
+
+    @classmethod
+    def _from_root(cls, root, size):
+        ret = cls.__new__(cls)
+        ret._root, ret._size = root, size
+        return ret
+
+    def _assoc_all(self, a, kw):
+        items = ()
+        if a:
+            other = a[0]
+            if hasattr(other, 'keys'):
+                items = ((k, other[k]) for k in other.keys())
+            else:
+                items = other
+        root, size = self._root, self._size
+        for k, v in chain(items, kw.items()):
+            root, added = root.assoc(hash(k) & _HASH_MASK, k, v, 0)
+            size += added
+        return root, size
+
+    def updated(self, *a, **kw):
+        """Make a copy and add items from a dictionary or iterable (and/or
+        keyword arguments), overwriting values under an existing
+        key. See :meth:`dict.update` for more details.
+        """
+        if len(a) > 1:
+            raise TypeError('updated expected at most 1 argument, got %s'
+                            % len(a))
+        root, size = self._assoc_all(a, kw)
+        if root is self._root:
+            return self
+        return self._from_root(root, size)
+
+    @classmethod
+    def fromkeys(cls, keys, value=None):
+        return cls((k, value) for k in keys)
+
+    def _lookup(self, key, default):
+        h = hash(key) & _HASH_MASK
+        node, shift = self._root, 0
+        while True:
+            bitmap = node.bitmap
+            bit = 1 << ((h >> shift) & _HAMT_MASK)
+            if not bitmap & bit:
+                return default
+            entry = node.entries[_popcount(bitmap & (bit - 1))]
+            if type(entry) is tuple:
+                if entry[0] == h and (entry[1] is key or entry[1] == key):
+                    return entry[2]
+                return default
+            if type(entry) is _HAMTCollisionNode:
+                if entry.hash != h:
+                    return default
+                return entry.get(key, default)
+            node, shift = entry, shift + _HAMT_BITS
+
+    def __getitem__(self, key):
+        ret = self._lookup(key, _MISSING)
+        if ret is _MISSING:
+            raise KeyError(key)
+        return ret
+
+    def get(self, key, default=None):
+        return self._lookup(key, default)
+
+    def __contains__(self, key):
+        return self._lookup(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for k, _ in self._root.iteritems():
+            yield k
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if isinstance(other, PersistentFrozenDict) and self._root is other._root:
+            return True
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        for k, v in self._root.iteritems():
+            try:
+                if other[k] != v:
+                    return False
+            except KeyError:
+                return False
+        return True
+
+    def __hash__(self):
+        try:
+            ret = self._hash
+        except AttributeError:
+            try:
+                ret = self._hash = hash(frozenset(self._root.iteritems()))
+            except Exception as e:
+                ret = self._hash = FrozenHashError(e)
+
+        if ret.__class__ is FrozenHashError:
+            raise ret
+
+        return ret
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return f'{cn}({dict(self._root.iteritems())!r})'
+
+    def __reduce_ex__(self, protocol):
+        return type(self), (dict(self._root.iteritems()),)
+
+    def __copy__(self):
+        return self  # immutable types don't copy, see tuple's behavior
+
+
 # end dictutils.py
@@ -0,0 +1,266 @@
+"""Benchmarks cacheutils.make_cache_key, and cached function and method
+hits, against the list-based key-making and the cached/cachedmethod
+call paths used before the all-positional fast path and signature
+keying. Both sides use the current LRU, so only key-making and the
+decorators' own overhead differ.
+
+Run from the repository root:
+
+    python misc/bench_cache_key.py
+    python misc/bench_cache_key.py --quick --json results.json
+
+With --json, results are also written as a JSON object with a
+"results" list of {"benchmark", "impl", "value", "unit"} records.
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+from operator import attrgetter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from boltons.cacheutils import (LRU, cached, cachedmethod, make_cache_key,
+                                _KWARG_MARK)
+
+
+class LegacyHashedKey(list):
+    __slots__ = 'hash_value'
+
+    def __init__(self, key):
+        self[:] = key
+        self.hash_value = hash(tuple(key))
+
+    def __hash__(self):
+        return self.hash_value
+
+
+def legacy_make_cache_key(args, kwargs, typed=False,
+                          kwarg_mark=_KWARG_MARK,
+                          fasttypes=frozenset([int, str, frozenset,
+                                               type(None)])):
+    key = list(args)
+    if kwargs:
+        sorted_items = sorted(kwargs.items())
+        key.append(kwarg_mark)
+        key.extend(sorted_items)
+    if typed:
+        key.extend([type(v) for v in args])
+        if kwargs:
+            key.extend([type(v) for k, v in sorted_items])
+    elif len(key) == 1 and type(key[0]) in fasttypes:
+        return key[0]
+    return LegacyHashedKey(key)
+
+
+class LegacyCachedFunction:
+    # the cached() call path before signature keying and the stats,
+    # coalescing and refresh options
+    def __init__(self, func, cache, typed=False):
+        self.func = func
+        self.get_cache = lambda: cache
+        self.typed = typed
+        self.key_func = legacy_make_cache_key
+
+    def __call__(self, *args, **kwargs):
+        cache = self.get_cache()
+        key = self.key_func(args, kwargs, typed=self.typed)
+        try:
+            ret = cache[key]
+        except KeyError:
+            ret = cache[key] = self.func(*args, **kwargs)
+        return ret
+
+
+class LegacyCachedMethod:
+    # the matching cachedmethod() call path, which makes a bound copy
+    # through __init__ on every attribute access
+    def __init__(self, func, cache, scoped=True, typed=False, key=None):
+        self.func = func
+        self.__isabstractmethod__ = getattr(func, '__isabstractmethod__', False)
+        if isinstance(cache, str):
+            self.get_cache = attrgetter(cache)
+        elif callable(cache):
+            self.get_cache = cache
+        else:
+            raise TypeError('expected an attribute name or callable')
+        self.scoped = scoped
+        self.typed = typed
+        self.key_func = key or legacy_make_cache_key
+        self.bound_to = None
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        cls = self.__class__
+        ret = cls(self.func, self.get_cache, typed=self.typed,
+                  scoped=self.scoped, key=self.key_func)
+        ret.bound_to = obj
+        return ret
+
+    def __call__(self, *args, **kwargs):
+        obj = args[0] if self.bound_to is None else self.bound_to
+        cache = self.get_cache(obj)
+        key_args = (self.bound_to, self.func) + args if self.scoped else args
+        key = self.key_func(key_args, kwargs, typed=self.typed)
+        try:
+            ret = cache[key]
+        except KeyError:
+            if self.bound_to is not None:
+                args = (self.bound_to,) + args
+            ret = cache[key] = self.func(*args, **kwargs)
+        return ret
+
+
+class Point:
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+
+
+CALL_SHAPES = [('one int', (1,), {}),
+               ('three ints', (1, 2, 3), {}),
+               ('str and None', ('abc', None), {}),
+               ('float', (1.5, 2), {}),
+               ('object', (Point(1, 2),), {}),
+               ('kwargs', (1,), {'b': 2, 'c': 3}),
+               ('typed', (1, 2.0), {})]
+
+# calls to def func(a, b=2), which signature keying normalizes
+SIGNATURE_SHAPES = [('f(1)', (1,), {}),
+                    ('f(1, 3)', (1, 3), {}),
+                    ('f(1, 2)', (1, 2), {}),
+                    ('f(1, b=2)', (1,), {'b': 2}),
+                    ('f(a=1)', (), {'a': 1})]
+
+
+def bench_pair(legacy, current, number, repeat):
+    # alternating runs, so that drift in machine speed hits both sides
+    results = [float('inf'), float('inf')]
+    for _ in range(repeat):
+        for i, func in enumerate((legacy, current)):
+            elapsed = timeit.timeit(func, number=number) / number * 1e9
+            results[i] = min(results[i], elapsed)
+    return results
+
+
+def report(records, benchmark, name, results):
+    for impl, value in zip(('legacy', 'current'), results):
+        records.append({'benchmark': benchmark + ' ' + name, 'impl': impl,
+                        'value': round(value, 3), 'unit': 'ns'})
+    print('  %-14s %10.1f %10.1f %7.2fx'
+          % (name, results[0], results[1], results[0] / results[1]))
+
+
+def print_header(title):
+    print(title)
+    print('  %-14s %10s %10s %8s' % ('shape', 'legacy', 'current', 'speedup'))
+
+
+def bench_make_cache_key(records, number, repeat):
+    print_header('make_cache_key(), ns per key (build + 3 hashes):')
+    for name, args, kwargs in CALL_SHAPES:
+        typed = name == 'typed'
+        runs = []
+        for key_func in (legacy_make_cache_key, make_cache_key):
+            # a miss-and-fill hashes a key about three times
+            def run(key_func=key_func):
+                key = key_func(args, kwargs, typed)
+                hash(key), hash(key), hash(key)
+            runs.append(run)
+        report(records, 'make_cache_key', name,
+               bench_pair(runs[0], runs[1], number, repeat))
+
+
+def bench_cached_hits(records, number, repeat):
+    print_header('cached() function hits, ns per call:')
+    for name, args, kwargs in CALL_SHAPES:
+        typed = name == 'typed'
+
+        def func(*a, **kw):
+            return a
+
+        legacy = LegacyCachedFunction(func, LRU(), typed=typed)
+        current = cached(LRU(), typed=typed)(func)
+        legacy(*args, **kwargs), current(*args, **kwargs)
+        report(records, 'cached hit', name,
+               bench_pair(lambda: legacy(*args, **kwargs),
+                          lambda: current(*args, **kwargs), number, repeat))
+
+
+def bench_signature_hits(records, number, repeat):
+    # the same logical call, spelled several ways, shares one key (and
+    # one cache entry) when keyed by signature
+    def func(a, b=2):
+        return a + b
+
+    cache = LRU()
+    legacy = LegacyCachedFunction(func, LRU())
+    current = cached(cache)(func)
+    for name, args, kwargs in SIGNATURE_SHAPES:
+        legacy(*args, **kwargs), current(*args, **kwargs)
+    print_header('cached() hits on def f(a, b=2), ns per call'
+                 ' (%d cache entries for %d calls):'
+                 % (len(cache), len(SIGNATURE_SHAPES)))
+    for name, args, kwargs in SIGNATURE_SHAPES:
+        report(records, 'cached signature hit', name,
+               bench_pair(lambda: legacy(*args, **kwargs),
+                          lambda: current(*args, **kwargs), number, repeat))
+
+
+def bench_method_hits(records, number, repeat):
+    def method(self, a, b=2):
+        return a + b
+
+    class Thing:
+        legacy = LegacyCachedMethod(method, 'cache')
+        current = cachedmethod('cache')(method)
+
+        def __init__(self):
+            self.cache = LRU()
+
+    thing = Thing()
+    print_header('cachedmethod() hits on def m(self, a, b=2), ns per call:')
+    for name, args, kwargs in SIGNATURE_SHAPES:
+        name = 'm' + name[1:]
+        thing.legacy(*args, **kwargs), thing.current(*args, **kwargs)
+        report(records, 'cachedmethod signature hit', name,
+               bench_pair(lambda: thing.legacy(*args, **kwargs),
+                          lambda: thing.current(*args, **kwargs),
+                          number, repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer iterations, for a smoke test')
+    parser.add_argument('--json', metavar='PATH',
+                        help='also write results as JSON to PATH')
+    args = parser.parse_args()
+
+    # many short runs, of which the best is kept, are steadier than a
+    # few long ones on a busy machine
+    number, repeat = (2000, 10) if args.quick else (5000, 100)
+    records = []
+    print('Python %s on %s' % (platform.python_version(), platform.platform()))
+    bench_make_cache_key(records, number, repeat)
+    bench_cached_hits(records, number, repeat)
+    bench_signature_hits(records, number, repeat)
+    bench_method_hits(records, number, repeat)
+
+    if args.json:
+        data = {'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'platform': platform.platform(),
+                'timestamp': time.time(),
+                'quick': args.quick,
+                'results': records}
+        with open(args.json, 'w') as f:
+            json.dump(data, f, indent=2)
+        print('wrote %d results to %s' % (len(records), args.json))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+"""Benchmarks for cacheutils' LRI, LRU, cached and cachedmethod, with
+functools.lru_cache and dict as baselines. Covers set throughput, hit
+latency, a skewed mixed workload, make_cache_key cost, contention
+between threads, and memory per entry.
+
+Uses only the standard library. Run from the repository root:
+
+    python misc/bench_cacheutils.py
+    python misc/bench_cacheutils.py --quick --json results.json
+
+Results are printed as a table. With --json, they are also written as
+a JSON object with a "results" list of {"benchmark", "impl", "metric",
+"value", "unit"} records, suited to diffing between versions. Pass an
+earlier run's JSON with --compare to list results which got worse by
+more than --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import random
+import timeit
+import platform
+import argparse
+import functools
+import threading
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from boltons.cacheutils import (LRI, LRU, TTLCache, cached, cachedmethod,
+                                make_cache_key)
+
+
+class Results:
+    def __init__(self):
+        self.records = []
+
+    def add(self, benchmark, impl, metric, value, unit):
+        self.records.append({'benchmark': benchmark, 'impl': impl,
+                             'metric': metric, 'value': round(value, 3),
+                             'unit': unit})
+        print('  %-22s %-14s %-10s %14.1f %s'
+              % (benchmark, impl, metric, value, unit))
+
+
+def best_ns(func, number, repeat):
+    "Best-of-repeat time per call of func, in nanoseconds."
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e9
+
+
+def skewed_keys(count, key_space, seed=0):
+    rng = random.Random(seed)
+    weights = [1.0 / (i + 1) for i in range(key_space)]
+    return rng.choices(range(key_space), weights=weights, k=count)
+
+
+def make_lru_cache_func(max_size):
+    @functools.lru_cache(maxsize=max_size)
+    def func(x):
+        return x
+    return func
+
+
+def bench_set(results, size, repeat):
+    # sets over twice the cache's capacity, so half evict
+    keys = list(range(size * 2))
+    for name, factory in (('dict', dict),
+                          ('LRI', lambda: LRI(max_size=size)),
+                          ('LRU', lambda: LRU(max_size=size))):
+        def run():
+            cache = factory()
+            for key in keys:
+                cache[key] = key
+        elapsed = min(timeit.repeat(run, number=1, repeat=repeat))
+        results.add('set', name, 'throughput', len(keys) / elapsed, 'ops/s')
+
+
+def bench_hit(results, size, number, repeat):
+    key = size // 2
+    for name, cache in (('dict', dict()),
+                        ('LRI', LRI(max_size=size)),
+                        ('LRU', LRU(max_size=size))):
+        for i in range(size):
+            cache[i] = i
+        results.add('get_hit', name, 'latency',
+                    best_ns(lambda: cache[key], number, repeat), 'ns')
+    func = make_lru_cache_func(size)
+    func(key)
+    results.add('get_hit', 'lru_cache', 'latency',
+                best_ns(lambda: func(key), number, repeat), 'ns')
+
+
+def bench_mixed(results, size, repeat):
+    # a skewed workload over four times as many keys as fit, filling
+    # misses, as a cache in front of a real lookup would
+    keys = skewed_keys(size * 20, size * 4)
+    for name in ('LRI', 'LRU', 'lru_cache'):
+        def run():
+            if name == 'lru_cache':
+                func = make_lru_cache_func(size)
+                for key in keys:
+                    func(key)
+                return func.cache_info().hits
+            cache = (LRI if name == 'LRI' else LRU)(max_size=size,
+                                                    on_miss=lambda k: k)
+            for key in keys:
+                cache[key]
+            return cache.hit_count
+        elapsed = min(timeit.repeat(run, number=1, repeat=repeat))
+        results.add('mixed', name, 'throughput', len(keys) / elapsed, 'ops/s')
+        results.add('mixed', name, 'hit_ratio', 100.0 * run() / len(keys), '%')
+
+
+def bench_make_cache_key(results, number, repeat):
+    obj = object()
+    shapes = (('positional', (1, 'a', None), {}),
+              ('object', (obj, 1), {}),
+              ('kwargs', (1,), {'b': 2, 'c': 'x'}))
+    for name, args, kwargs in shapes:
+        results.add('make_cache_key', name, 'latency',
+                    best_ns(lambda: make_cache_key(args, kwargs),
+                            number, repeat), 'ns')
+        results.add('make_cache_key_typed', name, 'latency',
+                    best_ns(lambda: make_cache_key(args, kwargs, typed=True),
+                            number, repeat), 'ns')
+
+
+def bench_decorators(results, size, number, repeat):
+    @cached(LRU(max_size=size))
+    def cached_lru(x, y=0):
+        return x
+
+    @cached(LRI(max_size=size))
+    def cached_lri(x, y=0):
+        return x
+
+    @functools.lru_cache(maxsize=size)
+    def lru_cache_func(x, y=0):
+        return x
+
+    class Thing:
+        def __init__(self):
+            self.cache = LRU(max_size=size)
+
+        @cachedmethod('cache')
+        def method(self, x, y=0):
+            return x
+
+        @functools.lru_cache(maxsize=size)
+        def lru_cache_method(self, x, y=0):
+            return x
+
+    thing = Thing()
+    impls = (('cached(LRU)', cached_lru),
+             ('cached(LRI)', cached_lri),
+             ('cachedmethod', thing.method),
+             ('lru_cache', lru_cache_func),
+             ('lru_cache_meth', thing.lru_cache_method))
+    for name, func in impls:
+        func(1), func(1, y=2)
+        results.add('decorator_hit', name, 'latency',
+                    best_ns(lambda: func(1), number, repeat), 'ns')
+        results.add('decorator_hit_kw', name, 'latency',
+                    best_ns(lambda: func(1, y=2), number, repeat), 'ns')
+
+
+def bench_threads(results, size, ops, thread_counts):
+    # each thread does a skewed mix of reads and fills on a shared
+    # cache; total throughput shows how well the lock holds up
+    keys = skewed_keys(ops, size * 4, seed=1)
+    for name in ('LRI', 'LRU', 'lru_cache'):
+        for thread_count in thread_counts:
+            if name == 'lru_cache':
+                target = make_lru_cache_func(size)
+            else:
+                cache = (LRI if name == 'LRI' else LRU)(max_size=size,
+                                                        on_miss=lambda k: k)
+                target = cache.__getitem__
+            per_thread = ops // thread_count
+            barrier = threading.Barrier(thread_count + 1)
+
+            def work(offset):
+                chunk = keys[offset:offset + per_thread]
+                barrier.wait()
+                for key in chunk:
+                    target(key)
+
+            threads = [threading.Thread(target=work, args=(i * per_thread,))
+                       for i in range(thread_count)]
+            for thread in threads:
+                thread.start()
+            barrier.wait()
+            start = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            results.add('threads_%d' % thread_count, name, 'throughput',
+                        per_thread * thread_count / elapsed, 'ops/s')
+
+
+def bench_memory(results, size):
+    # int keys and values are preallocated, so only the container's
+    # own overhead is measured
+    keys = [i + 1000000 for i in range(size)]
+
+    def fill_dict():
+        return {k: k for k in keys}
+
+    def fill_cache(cache_type):
+        def fill():
+            cache = cache_type(max_size=size)
+            for k in keys:
+                cache[k] = k
+            return cache
+        return fill
+
+    def fill_lru_cache():
+        func = make_lru_cache_func(size)
+        for k in keys:
+            func(k)
+        return func
+
+    def fill_cached():
+        func = cached(LRU(max_size=size))(lambda x, y: x)
+        for k in keys:
+            func(k, k)  # two arguments, to pay for a key
+        return func
+
+    for name, fill in (('dict', fill_dict),
+                       ('LRI', fill_cache(LRI)),
+                       ('LRU', fill_cache(LRU)),
+                       ('TTLCache', fill_cache(TTLCache)),
+                       ('lru_cache', fill_lru_cache),
+                       ('cached(LRU)', fill_cached)):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        kept = fill()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del kept
+        results.add('memory', name, 'per_entry', (after - before) / size,
+                    'bytes')
+
+
+# for these units, bigger numbers are better
+HIGHER_IS_BETTER = ('ops/s', '%')
+
+
+def compare(records, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = {(r['benchmark'], r['impl'], r['metric']): r['value']
+                    for r in json.load(f)['results']}
+    regressions = 0
+    print('compared to %s:' % baseline_path)
+    for record in records:
+        old = baseline.get((record['benchmark'], record['impl'],
+                            record['metric']))
+        if not old:
+            continue
+        change = record['value'] / old - 1
+        if record['unit'] in HIGHER_IS_BETTER:
+            change = -change
+        if change > tolerance:
+            regressions += 1
+            print('  REGRESSION %-22s %-14s %-10s %+6.1f%%'
+                  % (record['benchmark'], record['impl'], record['metric'],
+                     change * 100))
+    print('  %d regressions over %d%%' % (regressions, tolerance * 100))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer iterations, for a smoke test')
+    parser.add_argument('--size', type=int, default=1000,
+                        help='cache size (default: 1000)')
+    parser.add_argument('--json', metavar='PATH',
+                        help='also write results as JSON to PATH')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='compare against results saved with --json')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative slowdown counted as a regression'
+                        ' by --compare (default: 0.1)')
+    args = parser.parse_args()
+
+    size = args.size
+    number, repeat = (20000, 3) if args.quick else (200000, 5)
+    ops = 40000 if args.quick else 400000
+
+    results = Results()
+    print('Python %s on %s' % (platform.python_version(), platform.platform()))
+    bench_set(results, size, repeat)
+    bench_hit(results, size, number, repeat)
+    bench_mixed(results, size, repeat)
+    bench_make_cache_key(results, number, repeat)
+    bench_decorators(results, size, number, repeat)
+    bench_threads(results, size, ops, (1, 2, 4, 8))
+    bench_memory(results, size * 10)
+
+    if args.json:
+        data = {'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'platform': platform.platform(),
+                'timestamp': time.time(),
+                'size': size,
+                'quick': args.quick,
+                'results': results.records}
+        with open(args.json, 'w') as f:
+            json.dump(data, f, indent=2)
+        print('wrote %d results to %s' % (len(results.records), args.json))
+    if args.compare:
+        if compare(results.records, args.compare, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""Benchmarks cacheutils.StrongMinIDMap against the weakref-based
+MinIDMap, for churn through short-lived objects, batched assignment,
+reuse of scattered free IDs, and memory per tracked object.
+
+Uses only the standard library. Run from the repository root:
+
+    python misc/bench_minidmap.py
+    python misc/bench_minidmap.py --quick --size 1000000 --json results.json
+
+With --json, results are also written as a JSON object with a
+"results" list of {"benchmark", "impl", "value", "unit"} records.
+"""
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from boltons.cacheutils import MinIDMap, StrongMinIDMap
+
+
+class Obj:
+    # weakref-able, as MinIDMap requires
+    pass
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+IMPLS = ('MinIDMap', 'StrongMinIDMap')
+
+
+def report(records, name, count, results):
+    for impl, elapsed in zip(IMPLS, results):
+        records.append({'benchmark': name, 'impl': impl,
+                        'value': round(elapsed / count * 1e9, 3),
+                        'unit': 'ns'})
+    print('%-22s' % name + ''.join(' %10.1f' % (elapsed / count * 1e9)
+                                   for elapsed in results))
+
+
+def bench_churn(records, count, live=100):
+    # objects get an ID, live for a while, and are released, keeping
+    # about `live` at a time. MinIDMap also gets the weakref-driven
+    # release, where objects are just dropped.
+    def explicit(idm_type):
+        def run():
+            idm = idm_type()
+            wheel = [Obj() for _ in range(live)]
+            for obj in wheel:
+                idm.get(obj)
+            for i in range(count):
+                slot = i % live
+                idm.drop(wheel[slot])
+                wheel[slot] = obj = Obj()
+                idm.get(obj)
+        return run
+
+    def collected():
+        idm = MinIDMap()
+        wheel = [None] * live
+        for i in range(count):
+            wheel[i % live] = obj = Obj()
+            idm.get(obj)
+
+    report(records, 'churn (explicit drop)', count,
+           [timed(explicit(MinIDMap)), timed(explicit(StrongMinIDMap))])
+    report(records, 'churn (collected)', count,
+           [timed(collected), timed(explicit(StrongMinIDMap))])
+
+
+def bench_batch(records, count):
+    objs = [Obj() for _ in range(count)]
+
+    def one_by_one(idm_type):
+        def run():
+            idm = idm_type()
+            for obj in objs:
+                idm.get(obj)
+        return run
+
+    def batched():
+        StrongMinIDMap().get_many(objs)
+
+    report(records, 'assign', count,
+           [timed(one_by_one(MinIDMap)), timed(one_by_one(StrongMinIDMap))])
+    report(records, 'assign (get_many)', count,
+           [timed(one_by_one(MinIDMap)), timed(batched)])
+
+
+def bench_reuse(records, count):
+    # free a random half of the IDs, then reassign them, smallest first
+    objs = [Obj() for _ in range(count)]
+    dropped = random.Random(0).sample(objs, count // 2)
+    results = []
+    for idm_type in (MinIDMap, StrongMinIDMap):
+        idm = idm_type()
+        for obj in objs:
+            idm.get(obj)
+        for obj in dropped:
+            idm.drop(obj)
+        new_objs = [Obj() for _ in dropped]
+
+        def run():
+            for obj in new_objs:
+                idm.get(obj)
+        results.append(timed(run))
+    report(records, 'reuse free IDs', len(dropped), results)
+
+
+def bench_memory(records, count):
+    objs = [Obj() for _ in range(count)]
+    results = []
+    for idm_type in (MinIDMap, StrongMinIDMap):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        idm = idm_type()
+        for obj in objs:
+            idm.get(obj)
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        results.append((after - before) / count)
+        del idm
+    for impl, value in zip(IMPLS, results):
+        records.append({'benchmark': 'memory', 'impl': impl,
+                        'value': round(value, 3), 'unit': 'bytes'})
+    print('%-22s' % 'memory (bytes/object)'
+          + ''.join(' %10.1f' % r for r in results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer objects, for a smoke test')
+    parser.add_argument('--size', type=int,
+                        help='number of objects (default: 200000, or'
+                        ' 20000 with --quick)')
+    parser.add_argument('--json', metavar='PATH',
+                        help='also write results as JSON to PATH')
+    args = parser.parse_args()
+
+    count = args.size or (20000 if args.quick else 200000)
+    records = []
+    print('Python %s on %s, %d objects'
+          % (platform.python_version(), platform.platform(), count))
+    print('%-22s %10s %10s' % ('ns per object', 'MinIDMap', 'Strong'))
+    bench_churn(records, count)
+    bench_batch(records, count)
+    bench_reuse(records, count)
+    bench_memory(records, count)
+
+    if args.json:
+        data = {'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'platform': platform.platform(),
+                'timestamp': time.time(),
+                'size': count,
+                'quick': args.quick,
+                'results': records}
+        with open(args.json, 'w') as f:
+            json.dump(data, f, indent=2)
+        print('wrote %d results to %s' % (len(records), args.json))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,113 +1,208 @@
-import string
+"""Benchmarks dictutils' OrderedMultiDict, FastIterOrderedMultiDict and
+CompactOrderedMultiDict, with dict and collections.OrderedDict as
+baselines, on the same set of items, where every key appears twice.
+
+Uses only the standard library. werkzeug's MultiDict types are added
+to the comparison if installed. Run from the repository root:
+
+    python misc/bench_omd.py
+    python misc/bench_omd.py --quick --size 1000 --json results.json
+
+Times are the best of several runs, in nanoseconds per item. The
+from_pairs row builds the same dicts as init, through the classmethod's
+single-pass path. Actions which only make sense for multidicts, like
+getlist, are skipped for dict and OrderedDict. Memory is measured with
+tracemalloc, as the bytes per item allocated by the container itself.
+"""
+import os
 import sys
-sys.path.append('/home/mahmoud/projects/lithoxyl/')
-
+import json
 import time
-import lithoxyl
-from lithoxyl import sinks, logger
-
-from dictutils import OMD, FastIterOrderedMultiDict
-from collections import OrderedDict as OD
-
-q_sink = lithoxyl.sinks.QuantileSink()
-log = lithoxyl.logger.BaseLogger('bench_stats', sinks=[q_sink])
+import timeit
+import platform
+import argparse
+import tracemalloc
+from collections import OrderedDict
 
-times = 10
-size = 10000
-redun = 2
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-_rng = range(size / redun) * redun
-_unique_keys = set(_rng)
-_bad_rng = range(size, size + size)
-_pairs = zip(_rng, _rng)
+from boltons.dictutils import (OrderedMultiDict, FastIterOrderedMultiDict,
+                               CompactOrderedMultiDict)
 
-# order matters because 'pop' mutates
-_shared_actions = ('setitem', 'iteritems', 'iterkeys', 'getitem', 'keyerror', 'pop')
-_multi_actions = ('multi_iteritems',)
-_all_actions = ('init',) + _multi_actions + _shared_actions
 
-MULTI_IMPLS = (FastIterOrderedMultiDict, OMD)
+MULTI_IMPLS = [('OMD', OrderedMultiDict),
+               ('FastIterOMD', FastIterOrderedMultiDict),
+               ('CompactOMD', CompactOrderedMultiDict)]
 try:
-    from werkzeug.datastructures import MultiDict, OrderedMultiDict as WOMD
-    MULTI_IMPLS += (WOMD, MultiDict)
+    from werkzeug.datastructures import MultiDict as WerkzeugMultiDict
 except ImportError:
-    print('(installing werkzeug is recommended for full comparison)')
-ALL_IMPLS = MULTI_IMPLS + (OD, dict)
-
-
-def bench():
-    for impl in ALL_IMPLS:
-        q_sink = lithoxyl.sinks.QuantileSink()
-        impl_name = '.'.join([impl.__module__, impl.__name__])
-        log = lithoxyl.logger.BaseLogger(impl_name, sinks=[q_sink])
-        print()
-        print('+ %s' % impl_name)
-        for _ in range(times):
-            with log.info('total'):
-                for _ in range(times):
-                    with log.info('init'):
-                        target_dict = impl(_pairs)
-                    if impl in MULTI_IMPLS:
-                        _actions = _multi_actions + _shared_actions
-                    else:
-                        _actions = _shared_actions
-                    for action in _actions:
-                        action_func = globals()['_do_' + action]
-                        with log.info(action):
-                            action_func(target_dict)
-        for action in _all_actions:
-            try:
-                best_msecs = q_sink.qas[impl_name][action].min * 1000
-                print(f'   - {action} - {best_msecs:g} ms')
-            except KeyError:
-                pass
-        best_msecs = q_sink.qas[impl_name]['total'].min * 1000
-        median_msecs = q_sink.qas[impl_name]['total'].median * 1000
-        print(' > ran %d loops of %d items each, best time: %g ms, median time: %g ms' % (times, size, best_msecs, median_msecs))
-
-    print()
-    return
-
-
-def _do_setitem(target_dict):
-    for k, i in enumerate(string.lowercase):
-        target_dict[k] = i
-
+    pass
+else:
+    MULTI_IMPLS.append(('werkzeug', WerkzeugMultiDict))
+BASE_IMPLS = [('OrderedDict', OrderedDict), ('dict', dict)]
 
-def _do_iteritems(target_dict):
-    [_ for _ in target_dict.iteritems()]
 
+def _do_init(impl, pairs, keys):
+    return lambda: impl(pairs)
 
-def _do_iterkeys(target_dict):
-    [_ for _ in target_dict.iterkeys()]
 
+def _do_from_pairs(impl, pairs, keys):
+    return lambda: impl.from_pairs(pairs)
 
-def _do_multi_iteritems(target_dict):
-    [_ for _ in target_dict.iteritems(multi=True)]
 
+def _do_setitem(impl, pairs, keys):
+    target = impl(pairs)
 
-def _do_multi_iterkeys(target_dict):
-    [_ for _ in target_dict.iterkeys(multi=True)]
+    def run():
+        for k in keys:
+            target[k] = k
+    return run
 
 
-def _do_getitem(target_dict):
-    for k in _rng:
-        target_dict[k]
+def _do_getitem(impl, pairs, keys):
+    target = impl(pairs)
 
+    def run():
+        for k in keys:
+            target[k]
+    return run
 
-def _do_keyerror(target_dict):
-    for k in _bad_rng:
-        try:
-            target_dict[k]
-        except KeyError:
-            pass
 
+def _do_getlist(impl, pairs, keys):
+    target = impl(pairs)
 
-def _do_pop(target_dict):
-    for k in _unique_keys:
-        target_dict.pop(k)
-    assert not target_dict
+    def run():
+        for k in keys:
+            target.getlist(k)
+    return run
+
+
+def _do_iteritems(impl, pairs, keys):
+    target = impl(pairs)
+    return lambda: list(target.items())
+
+
+def _do_multi_iteritems(impl, pairs, keys):
+    target = impl(pairs)
+    if impl is WERKZEUG_IMPL:
+        return lambda: list(target.items(multi=True))
+    return lambda: list(target.iteritems(multi=True))
+
+
+def _do_copy(impl, pairs, keys):
+    target = impl(pairs)
+    return target.copy
+
+
+# the mutating actions get a fresh target for every run, built outside
+# of the timing by the setup function
+def _do_pop(impl, pairs, keys):
+    def run(target):
+        for k in keys:
+            target.pop(k)
+    return run
+
+
+def _do_poplast(impl, pairs, keys):
+    def run(target):
+        for _ in pairs:
+            target.poplast()
+    return run
+
+
+WERKZEUG_IMPL = dict(MULTI_IMPLS).get('werkzeug')
+MUTATING = ('pop', 'poplast')
+MULTI_ONLY = ('from_pairs', 'getlist', 'multi_iteritems', 'poplast')
+ACTIONS = ('init', 'from_pairs', 'setitem', 'getitem', 'getlist', 'iteritems',
+           'multi_iteritems', 'copy', 'pop', 'poplast')
+
+
+def time_action(action, impl, pairs, keys, repeat):
+    make = globals()['_do_' + action]
+    if action not in MUTATING:
+        return min(timeit.repeat(make(impl, pairs, keys), number=1,
+                                 repeat=repeat))
+    run = make(impl, pairs, keys)
+    best = None
+    for _ in range(repeat):
+        target = impl(pairs)
+        start = time.perf_counter()
+        run(target)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure_memory(impl, pairs):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    target = impl(pairs)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del target
+    return (after - before) / len(pairs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer repetitions, for a smoke test')
+    parser.add_argument('--size', type=int, default=10000,
+                        help='number of items (default: 10000)')
+    parser.add_argument('--json', metavar='PATH',
+                        help='also write results as JSON to PATH')
+    args = parser.parse_args()
+
+    size = args.size
+    repeat = 3 if args.quick else 10
+    # keys and values are preallocated, so only the containers' own
+    # work and memory are measured
+    keys = [str(i) for i in range(size // 2)]
+    pairs = [(k, k) for k in keys] * 2
+    impls = MULTI_IMPLS + BASE_IMPLS
+
+    print('Python %s on %s, %d items, %d keys'
+          % (platform.python_version(), platform.platform(), len(pairs),
+             len(keys)))
+    print('%-16s' % 'ns per item' + ''.join(' %12s' % name
+                                            for name, _ in impls))
+    records = []
+    for action in ACTIONS:
+        row = []
+        for name, impl in impls:
+            if action in MULTI_ONLY and (name, impl) in BASE_IMPLS:
+                row.append('-')
+                continue
+            if impl is WERKZEUG_IMPL and action in ('from_pairs', 'poplast'):
+                row.append('-')
+                continue
+            value = time_action(action, impl, pairs, keys, repeat)
+            value = value / len(pairs) * 1e9
+            records.append({'benchmark': action, 'impl': name,
+                            'value': round(value, 3), 'unit': 'ns'})
+            row.append('%.1f' % value)
+        print('%-16s' % action + ''.join(' %12s' % v for v in row))
+
+    row = []
+    for name, impl in impls:
+        value = measure_memory(impl, pairs)
+        records.append({'benchmark': 'memory', 'impl': name,
+                        'value': round(value, 3), 'unit': 'bytes'})
+        row.append('%.1f' % value)
+    print('%-16s' % 'bytes per item' + ''.join(' %12s' % v for v in row))
+
+    if args.json:
+        data = {'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'platform': platform.platform(),
+                'timestamp': time.time(),
+                'size': size,
+                'quick': args.quick,
+                'results': records}
+        with open(args.json, 'w') as f:
+            json.dump(data, f, indent=2)
+        print('wrote %d results to %s' % (len(records), args.json))
 
 
 if __name__ == '__main__':
-    bench()
+    main()
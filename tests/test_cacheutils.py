@@ -4,7 +4,7 @@ from abc import abstractmethod, ABCMeta
 
 import pytest
 
-from boltons.cacheutils import LRU, LRI, cached, cachedmethod, cachedproperty, MinIDMap, ThresholdCounter
+from boltons.cacheutils import LRU, LRI, TTLCache, TinyLFU, ShardedLRU, TieredCache, SharedCache, CacheStats, NegativeCache, cached, cachedmethod, cachedproperty, threadsafe_cachedproperty, async_cachedproperty, MinIDMap, StrongMinIDMap, ThresholdCounter, SpaceSavingCounter
 
 
 class CountingCallable:
@@ -212,13 +212,835 @@ def test_lru_with_dupes_2():
     return
 
 
-def _test_linkage(dll, max_count=10000, prev_idx=0, next_idx=1):
+@pytest.mark.parametrize("cache_type", [LRU, LRI, TTLCache])
+def test_weighted_eviction(cache_type):
+    cache = cache_type(max_size=100, max_weight=10,
+                       weigher=lambda k, v: len(v))
+    cache['a'] = 'aaa'
+    cache['b'] = 'bbb'
+    cache['c'] = 'ccc'
+    assert cache.total_weight == 9
+    cache['d'] = 'dd'
+    assert 'a' not in cache
+    assert cache.total_weight == 8
+
+    # updating an item adjusts its weight
+    cache['b'] = 'b'
+    assert cache.total_weight == 6
+    assert len(cache) == 3
+
+    # removal paths all adjust the total
+    del cache['b']
+    assert cache.total_weight == 5
+    assert cache.pop('c') == 'ccc'
+    assert cache.total_weight == 2
+    cache.popitem()
+    assert cache.total_weight == 0
+
+    # items heavier than the max are rejected, without evicting others
+    cache['e'] = 'eeee'
+    cache['huge'] = 'x' * 11
+    assert 'huge' not in cache
+    assert cache.total_weight == 4
+    assert list(cache) == ['e']
+    # replacing an item with one too heavy drops the old value
+    cache['e'] = 'x' * 11
+    assert 'e' not in cache
+    assert cache.total_weight == 0
+
+    cache['f'] = 'ff'
+    copied = cache.copy()
+    assert copied.total_weight == 2
+    cache.clear()
+    assert cache.total_weight == 0
+    assert copied.max_weight == 10
+
+
+def test_weighted_eviction_count_limit_and_errors():
+    cache = LRU(max_size=2, weigher=lambda k, v: v)
+    cache['a'], cache['b'], cache['c'] = 1, 2, 3
+    assert cache.total_weight == 5
+    assert 'a' not in cache
+
+    with pytest.raises(ValueError):
+        cache['d'] = -1
+    assert 'd' not in cache
+    assert cache.total_weight == 5
+
+    with pytest.raises(TypeError):
+        LRU(max_weight=10)
+    with pytest.raises(TypeError):
+        LRU(weigher='nope')
+    with pytest.raises(ValueError):
+        LRU(max_weight=0, weigher=len)
+
+
+class FakeTimer:
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache():
+    timer = FakeTimer()
+    cache = TTLCache(max_size=3, ttl=10, timer=timer)
+    cache['a'] = 1
+    timer.now = 5
+    cache['b'] = 2
+    assert cache['a'] == 1
+    assert 'a' in cache
+
+    # 'a' has expired but is only removed lazily
+    timer.now = 12
+    assert 'a' not in cache
+    assert 'b' in cache
+    with pytest.raises(KeyError):
+        cache['a']
+    assert cache.expired_count == 1
+    assert cache.hit_count == 1
+    assert cache.miss_count == 1
+    assert len(cache) == 1
+
+    # resetting an item pushes its deadline back
+    cache['b'] = 3
+    timer.now = 20
+    assert cache['b'] == 3
+    assert cache.get('a', 'default') == 'default'
+    assert cache.soft_miss_count == 1
+
+    # proactive sweeps happen from the cold end on set
+    cache['c'] = 4
+    timer.now = 23
+    cache['d'] = 5
+    assert set(cache.keys()) == {'c', 'd'}
+    assert cache.expired_count == 2
+
+    # capacity evictions are not expirations
+    cache['e'] = 6
+    cache['f'] = 7
+    assert set(cache.keys()) == {'d', 'e', 'f'}
+    assert cache.expired_count == 2
+
+    timer.now = 40
+    assert cache.expire() == 3
+    assert not cache
+    assert _test_linkage(cache._anchor, 1)
+
+    with pytest.raises(ValueError):
+        TTLCache(ttl=0)
+
+
+def test_ttl_cache_copy_and_on_miss():
+    timer = FakeTimer()
+    cache = TTLCache(max_size=10, ttl=10, timer=timer,
+                     on_miss=lambda k: k.upper())
+    assert cache['a'] == 'A'
+    assert cache.miss_count == 1
+    timer.now = 5
+    cache['b'] = 'B'
+
+    copied = cache.copy()
+    assert copied == cache
+    timer.now = 11
+    assert 'a' not in copied
+    assert copied['b'] == 'B'
+    assert cache['a'] == 'A'
+    assert cache.expired_count == 1
+    assert cache.pop('b') == 'B'
+    timer.now = 30
+    assert cache.pop('a', None) is None
+    repr(cache)
+
+
+def test_tinylfu_basic():
+    cache = TinyLFU(max_size=10)
+    for i in range(10):
+        cache[i] = i
+    assert len(cache) == 10
+    for i in range(100):
+        cache[i] = i
+        assert len(cache) <= 10
+    assert len(cache._get_flattened_ll()) == len(cache)
+
+    cache.clear()
+    cache['a'] = 1
+    assert cache.pop('a') == 1
+    assert cache.get('a') is None
+    cache['b'] = 2
+    del cache['b']
+    assert not cache
+    cache['c'] = 3
+    assert cache.popitem() == ('c', 3)
+    assert cache.setdefault('d', 4) == 4
+    assert cache.copy() == cache
+    repr(cache)
+
+    with pytest.raises(ValueError):
+        TinyLFU(window_ratio=1.5)
+
+
+def test_tinylfu_scan_resistance():
+    hot_keys = list(range(50))
+    lru, tlfu = LRU(max_size=100), TinyLFU(max_size=100)
+    for cache in (lru, tlfu):
+        scan_key = 1000
+        for _ in range(20):
+            for key in hot_keys:
+                if cache.get(key) is None:
+                    cache[key] = key
+            for _ in range(200):
+                scan_key += 1
+                if cache.get(scan_key) is None:
+                    cache[scan_key] = scan_key
+    # the scan flushes the LRU every round, but TinyLFU keeps the hot set
+    assert lru.hit_count == 0
+    assert tlfu.hit_count > 50 * 15
+    assert len([key for key in hot_keys if key in tlfu]) > 45
+
+
+def test_tinylfu_cached_and_on_miss():
+    cache = TinyLFU(max_size=5, on_miss=lambda k: k * 2)
+    assert cache[3] == 6
+    assert cache.miss_count == 1
+    assert cache[3] == 6
+    assert cache.hit_count == 1
+
+    cache = TinyLFU()
+    inner_func = CountingCallable()
+    func = cached(cache)(inner_func)
+    func('a')
+    func('a')
+    assert inner_func.call_count == 1
+    assert cache.hit_count == 1
+
+
+def test_tinylfu_miss_counted_once():
+    # filling a miss is a single access, not a read and a write
+    cache = TinyLFU(max_size=10, on_miss=lambda k: k * 2)
+    cache[3]
+    assert cache._sketch.estimate(3) == 1
+    cache[3]
+    assert cache._sketch.estimate(3) == 2
+
+    cache = TinyLFU(max_size=10)
+    func = cached(cache)(lambda x: x)
+    func('a')
+    key = next(iter(cache))
+    assert cache._sketch.estimate(key) == 1
+
+    # int keys hash the same in every run, so these don't collide
+    # in the sketch
+    cache = TinyLFU(max_size=10, on_miss_many=lambda keys: {k: k for k in keys})
+    cache.get_many([1, 2])
+    assert cache._sketch.estimate(1) == cache._sketch.estimate(2) == 1
+
+    # plain sets still count
+    cache[3] = 1
+    cache[3] = 2
+    assert cache._sketch.estimate(3) == 2
+
+
+@pytest.mark.parametrize("cache_type", [LRI, LRU, TTLCache, TinyLFU, ShardedLRU])
+def test_bulk_methods(cache_type):
+    cache = cache_type(max_size=100)
+    cache.set_many({'a': 1, 'b': 2})
+    cache.set_many([('c', 3)])
+    assert dict(cache.items()) == {'a': 1, 'b': 2, 'c': 3}
+
+    hits, misses = cache.get_many(['a', 'c', 'x', 'a', 'y', 'x'])
+    assert hits == {'a': 1, 'c': 3}
+    assert sorted(misses) == ['x', 'y']
+    assert cache.hit_count == 3
+    assert cache.miss_count == 2
+
+    assert cache.delete_many(['a', 'x', 'b']) == 2
+    assert dict(cache.items()) == {'c': 3}
+    assert cache.get_many([]) == ({}, [])
+
+
+@pytest.mark.parametrize("cache_type", [LRI, LRU, TTLCache, TinyLFU, ShardedLRU])
+def test_copy_keeps_hooks(cache_type):
+    def on_miss(key):
+        return key
+
+    def on_miss_many(keys):
+        return {}
+
+    def on_evict(key, value, reason):
+        pass
+
+    stats = CacheStats()
+    cache = cache_type(max_size=100, on_miss=on_miss, on_miss_many=on_miss_many,
+                       on_evict=on_evict, stats=stats)
+    cache['a'] = 1
+    copied = cache.copy()
+    assert copied == cache and type(copied) is cache_type
+    assert copied.on_miss is on_miss
+    assert copied.on_miss_many is on_miss_many
+    assert copied.on_evict is on_evict
+    assert copied.stats is stats
+
+
+@pytest.mark.parametrize("cache_type", [LRI, LRU, ShardedLRU])
+def test_bulk_on_miss_many(cache_type):
+    calls = []
+
+    def on_miss_many(keys):
+        calls.append(list(keys))
+        return {k: k.upper() for k in keys if k != 'z'}
+
+    cache = cache_type(max_size=100, on_miss_many=on_miss_many)
+    cache['a'] = 'A!'
+    hits, misses = cache.get_many(['a', 'b', 'c', 'z'])
+    assert hits == {'a': 'A!', 'b': 'B', 'c': 'C'}
+    assert misses == ['z']
+    assert len(calls) == 1
+    assert sorted(calls[0]) == ['b', 'c', 'z']
+    assert cache['b'] == 'B'
+    assert cache.miss_count == 3
+
+    # falls back to per-key on_miss
+    cache = cache_type(max_size=100, on_miss=lambda k: k * 2)
+    hits, misses = cache.get_many(['a', 'b'])
+    assert hits == {'a': 'aa', 'b': 'bb'}
+    assert misses == []
+    assert 'a' in cache
+
+
+def test_bulk_update_subclass_setitem():
+    class UpperLRU(LRU):
+        def __setitem__(self, key, value):
+            super().__setitem__(key, value.upper())
+
+    cache = UpperLRU()
+    cache.update({'a': 'x'}, b='y')
+    cache.set_many([('c', 'z')])
+    assert dict(cache) == {'a': 'X', 'b': 'Y', 'c': 'Z'}
+
+
+def test_bulk_get_recency():
+    lru = LRU(max_size=3)
+    lru.set_many([('a', 1), ('b', 2), ('c', 3)])
+    lru.get_many(['a'])
+    lru['d'] = 4
+    assert 'a' in lru
+    assert 'b' not in lru
+
+    timer = FakeTimer()
+    ttl_cache = TTLCache(ttl=10, timer=timer)
+    ttl_cache.set_many({'a': 1})
+    timer.now = 11
+    assert ttl_cache.get_many(['a']) == ({}, ['a'])
+    assert ttl_cache.expired_count == 1
+
+    with pytest.raises(TypeError):
+        LRI(on_miss_many='nope')
+
+
+def test_on_evict_reasons():
+    evicted = []
+
+    def on_evict(key, value, reason):
+        evicted.append((key, value, reason))
+
+    lru = LRU(max_size=2, on_evict=on_evict)
+    lru['a'], lru['b'], lru['c'] = 1, 2, 3
+    del lru['b']
+    assert evicted == [('a', 1, 'capacity')]
+
+    del evicted[:]
+    lri = LRI(max_size=10, max_weight=5, weigher=lambda k, v: v,
+              on_evict=on_evict)
+    lri['a'], lri['b'], lri['c'] = 2, 2, 3
+    assert evicted == [('a', 2, 'weight')]
+    lri['huge'] = 6
+    assert evicted == [('a', 2, 'weight'), ('huge', 6, 'rejected')]
+    assert sorted(lri) == ['b', 'c']
+
+    del evicted[:]
+    timer = FakeTimer()
+    ttl_cache = TTLCache(ttl=10, timer=timer, on_evict=on_evict)
+    ttl_cache['a'] = 1
+    timer.now = 11
+    assert ttl_cache.expire() == 1
+    assert evicted == [('a', 1, 'expired')]
+
+    del evicted[:]
+    tlfu = TinyLFU(max_size=100, on_evict=on_evict)
+    for i in range(100):
+        tlfu[i] = i
+        for _ in range(3):
+            tlfu[i]
+    for i in range(100, 110):
+        tlfu[i] = i
+    assert len(tlfu) == 100
+    assert len(evicted) == 10
+    assert {reason for _, _, reason in evicted} == {'rejected'}
+
+    with pytest.raises(TypeError):
+        LRU(on_evict='nope')
+
+
+def test_cache_stats():
+    stats = CacheStats()
+    lru = LRU(max_size=2, on_miss=lambda k: k * 2, stats=stats)
+    for key in 'aabacab':
+        lru[key]
+    assert stats.hit_count == lru.hit_count == 3
+    assert stats.miss_count == lru.miss_count == 4
+    assert stats.eviction_counts == {'capacity': 2}
+    assert stats.get_hot_keys(1) == [('a', 3)]
+    assert sum(count for _, count in stats.get_miss_time_histogram()) == 4
+    assert 0 <= stats.mean_miss_time <= stats.max_miss_time
+    assert 'CacheStats' in repr(stats)
+
+    # stats can be shared, and are aggregated over the shards
+    sharded = ShardedLRU(max_size=4, shard_count=2, stats=stats)
+    sharded['x'] = 1
+    sharded['x']
+    assert stats.hit_count == 4
+    stats.reset()
+    assert stats.hit_count == 0
+    assert stats.get_hot_keys() == []
+
+    # bulk misses are timed, too
+    lri = LRI(on_miss_many=lambda keys: {k: k for k in keys}, stats=stats)
+    lri.get_many(['x', 'y'])
+    sharded = ShardedLRU(on_miss=lambda k: k, stats=stats)
+    sharded.get_many(['z'])
+    assert stats.miss_count == 3
+    assert sum(count for _, count in stats.get_miss_time_histogram()) == 3
+
+
+def test_cache_stats_cached_dec():
+    stats = CacheStats(track_keys=False)
+
+    @cached(LRU(), stats=stats)
+    def func(x):
+        return x + 1
+
+    func(1), func(1), func(2)
+    assert stats.hit_count == 1
+    assert stats.miss_count == 2
+    assert stats.get_hot_keys() == []
+
+    class Thing:
+        @cachedmethod(lambda self: self.cache, stats=stats)
+        def method(self, x):
+            return x * 2
+
+        def __init__(self):
+            self.cache = LRU()
+
+    thing = Thing()
+    assert thing.method(2) == thing.method(2) == 4
+    assert stats.hit_count == 2
+    assert stats.miss_count == 3
+
+    # hits are counted once, when the cache shares the stats
+    stats.reset()
+    shared = LRU(stats=stats)
+
+    @cached(shared, stats=stats)
+    def shared_func(x):
+        return x
+
+    shared_func(1), shared_func(1)
+    assert stats.hit_count == 1
+    assert stats.miss_count == 1
+
+
+def test_negative_cache():
+    import asyncio
+
+    now = [0]
+    db = {'a': 1, 'none': None}
+    calls = []
+    positive = LRU()
+    negative = NegativeCache(exceptions=KeyError, results=(None,),
+                             max_size=2, ttl=5, timer=lambda: now[0])
+
+    @cached(positive, negative_cache=negative)
+    def lookup(key):
+        calls.append(key)
+        return db[key]
+
+    assert lookup('a') == lookup('a') == 1
+    for _ in range(5):
+        with pytest.raises(KeyError) as exc_info:
+            lookup('b')
+        # replays don't grow the original traceback
+        assert len(exc_info.traceback) < 10
+    assert lookup('none') is None
+    assert lookup('none') is None
+    assert calls == ['a', 'b', 'none']
+    assert list(positive) == ['a']
+    assert sorted(key for _, key in negative) == ['b', 'none']
+
+    # negatives have their own size budget, and never evict positives
+    for key in 'cde':
+        with pytest.raises(KeyError):
+            lookup(key)
+    assert len(negative) == 2
+    assert list(positive) == ['a']
+
+    # and their own ttl
+    now[0] = 10
+    db['e'] = 5
+    assert lookup('e') == 5
+    assert calls[-1] == 'e' and 'e' in positive
+
+    # other exceptions are never cached
+    @cached(LRU(), negative_cache=negative)
+    def fail(x):
+        calls.append(x)
+        raise ValueError(x)
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            fail('f')
+    assert calls.count('f') == 2
+
+    # functions sharing a negative cache don't share their results
+    @cached(LRU(), negative_cache=negative)
+    def other_lookup(key):
+        calls.append(('other', key))
+        return 'found'
+
+    with pytest.raises(KeyError):
+        lookup('h')
+    assert other_lookup('h') == 'found'
+    assert calls[-1] == ('other', 'h')
+
+    # results match by type, as well as by value
+    zeros = NegativeCache(results=(0,))
+
+    @cached(LRU(), typed=True, negative_cache=zeros)
+    def echo(x):
+        return x
+
+    assert echo(False) is False and echo(0) == 0
+    assert len(zeros) == 1
+
+    class Thing:
+        def __init__(self):
+            self.cache = LRU()
+
+        @cachedmethod('cache', negative_cache=NegativeCache(results=(0,)))
+        def method(self, x):
+            calls.append(x)
+            return x
+
+    thing = Thing()
+    assert thing.method(0) == thing.method(0) == 0
+    assert calls.count(0) == 1 and len(thing.cache) == 0
+
+    async_negative = NegativeCache(exceptions=(KeyError, IndexError))
+
+    @cached(LRU(), negative_cache=async_negative)
+    async def async_lookup(key):
+        calls.append(key)
+        return db[key]
+
+    async def main():
+        for _ in range(2):
+            with pytest.raises(KeyError):
+                await async_lookup('g')
+        assert await async_lookup('a') == 1
+    asyncio.run(main())
+    assert calls.count('g') == 1
+    assert len(async_negative) == 1
+
+    with pytest.raises(TypeError):
+        NegativeCache(exceptions=[KeyError, 'nope'])
+    with pytest.raises(TypeError):
+        cached(LRU(), soft_ttl=1, negative_cache=negative)(lambda x: x)
+    copied = negative.copy()
+    assert copied.exceptions == (KeyError,) and copied.results == (None,)
+    assert copied.stats is negative.stats and copied == negative
+    assert 'NegativeCache' in repr(negative)
+
+
+def test_sharded_lru_basic():
+    cache = ShardedLRU(max_size=8, shard_count=4)
+    assert cache.shard_count == 4
+    assert sum(shard.max_size for shard in cache.shards) == 8
+
+    for i in range(20):
+        cache[i] = i * 10
+    assert len(cache) <= 8
+    assert 19 in cache
+    assert cache[19] == 190
+    assert cache.get('nope') is None
+    assert cache.hit_count == 1
+    assert cache.miss_count == 1
+    assert cache.soft_miss_count == 1
+
+    assert cache.pop(19) == 190
+    assert cache.pop(19, None) is None
+    with pytest.raises(KeyError):
+        cache.pop(19)
+    assert cache.setdefault('x', 'y') == 'y'
+    assert cache['x'] == 'y'
+    del cache['x']
+    assert 'x' not in cache
+
+    assert dict(cache.items()) == dict(zip(cache.keys(), cache.values()))
+    assert cache.copy() == cache
+    assert cache == dict(cache.items())
+    repr(cache)
+
+    def on_miss_many(keys):
+        return {}
+
+    def on_evict(key, value, reason):
+        pass
+
+    stats = CacheStats()
+    hooked = ShardedLRU(on_miss_many=on_miss_many, on_evict=on_evict,
+                        stats=stats)
+    copied = hooked.copy()
+    assert copied.on_miss_many is on_miss_many
+    assert copied.on_evict is on_evict
+    assert copied.stats is stats
+
+    cache.clear()
+    assert len(cache) == 0
+    with pytest.raises(KeyError):
+        cache.popitem()
+
+    # shard count never exceeds max_size
+    assert ShardedLRU(max_size=2, shard_count=16).shard_count == 2
+    with pytest.raises(ValueError):
+        ShardedLRU(max_size=0)
+
+
+def test_sharded_lru_on_miss_and_threads():
+    import threading
+
+    cache = ShardedLRU(max_size=1000, on_miss=lambda k: k * 2)
+    errors = []
+
+    def work(offset):
+        try:
+            for i in range(500):
+                assert cache[offset + i] == (offset + i) * 2
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(i * 100,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert cache.hit_count + cache.miss_count == 8 * 500
+    assert len(cache) <= 1000
+
+
+def test_tiered_cache(tmp_path):
+    import json
+
+    path = str(tmp_path / 'cache.db')
+    cache = TieredCache(path, max_size=2)
+    for i in range(5):
+        cache[i] = {'val': i}
+    assert cache.memory_size == 2
+    assert cache.disk_size == 3
+    assert len(cache) == 5
+    assert sorted(cache) == list(range(5))
+    assert 0 in cache
+    assert 'nope' not in cache
+
+    # promotion moves the item to memory, demoting another
+    assert cache[0] == {'val': 0}
+    assert cache.disk_hit_count == 1
+    assert cache.memory_size == 2
+    assert cache.disk_size == 3
+    assert cache[0] == {'val': 0}
+    assert cache.hit_count == 1
+    assert cache.get('nope') is None
+    assert cache.miss_count == 1
+    assert cache.soft_miss_count == 1
+
+    # setting an item on disk replaces it
+    cache[1] = 'new'
+    assert cache[1] == 'new'
+    assert len(cache) == 5
+
+    del cache[2]  # on disk
+    del cache[1]  # in memory
+    assert len(cache) == 3
+    with pytest.raises(KeyError):
+        del cache[1]
+    cache.close()
+    cache.close()  # closing twice is harmless
+
+    # everything survives a restart
+    with TieredCache(path, max_size=2) as cache:
+        assert cache.memory_size == 0
+        assert cache.disk_size == 3
+        assert cache[0] == {'val': 0}
+        assert cache[3] == {'val': 3}
+        assert cache[4] == {'val': 4}
+        cache.clear()
+        assert len(cache) == 0
+        repr(cache)
+
+    # pluggable serializers
+    cache = TieredCache(':memory:', max_size=1, serializer=json,
+                        key_serializer=json)
+    cache['a'], cache['b'] = [1, 2], [3]
+    assert cache['a'] == [1, 2]
+    assert cache.disk_hit_count == 1
+
+
+def test_tiered_cache_max_disk_size_and_cached():
+    cache = TieredCache(':memory:', max_size=2, max_disk_size=3,
+                        on_miss=lambda k: k * 2)
+    for i in range(10):
+        assert cache[i] == i * 2
+    assert cache.memory_size == 2
+    assert cache.disk_size == 3
+    assert sorted(cache) == [5, 6, 7, 8, 9]
+    assert cache.miss_count == 10
+
+    cache = TieredCache(':memory:', max_size=2)
+    inner_func = CountingCallable()
+    func = cached(cache)(inner_func)
+    func('a', b='c')
+    for i in range(5):
+        func(i)
+    func('a', b='c')
+    assert inner_func.call_count == 6
+    assert cache.disk_hit_count == 1
+
+
+def test_shared_cache_basic():
+    cache = SharedCache(max_size=62, slot_size=64, ways=4)
+    assert cache.max_size == 64
+    for i in range(8):
+        cache[i] = str(i)
+    assert cache[3] == '3'
+    assert 3 in cache
+    assert 'nope' not in cache
+    assert cache.get('nope') is None
+    assert cache.hit_count == 1
+    assert cache.miss_count == 1
+    assert cache.soft_miss_count == 1
+
+    # overwriting keeps a single copy
+    cache[3] = 'three'
+    assert cache[3] == 'three'
+    n = len(cache)
+    cache[3] = 'tres'
+    assert len(cache) == n
+    assert sorted(cache) == sorted(k for k in range(8) if k in cache)
+
+    # oversized items are rejected, dropping any old value
+    cache[3] = 'x' * 100
+    assert 3 not in cache
+    assert cache.reject_count == 1
+
+    del cache[4]
+    with pytest.raises(KeyError):
+        del cache[4]
+    assert cache.pop(5) == '5'
+
+    # the cache never grows beyond its slots
+    for i in range(1000):
+        cache[i] = i
+    assert len(cache) <= 64
+    assert len(list(cache)) == len(cache)
+    cache.clear()
+    assert len(cache) == 0
+    repr(cache)
+    cache.close()
+
+    with pytest.raises(ValueError):
+        SharedCache(slot_size=4)
+    with pytest.raises(ValueError):
+        SharedCache(max_size=600, ways=300)
+
+    # the widest sets still evict
+    wide = SharedCache(max_size=512, ways=256, slot_size=64)
+    for i in range(600):
+        wide[i] = i
+    assert len(wide) == 512
+
+
+def test_shared_cache_clock():
+    cache = SharedCache(max_size=4, ways=4, slot_size=64)
+    for k in 'abcd':
+        cache[k] = k
+    # the first eviction clears all reference bits, then takes 'a'
+    cache['e'] = 'e'
+    assert 'a' not in cache
+    # touching 'b' gives it a second chance, so 'c' goes next
+    cache['b']
+    cache['f'] = 'f'
+    assert 'b' in cache
+    assert 'c' not in cache
+
+
+def test_shared_cache_file_and_cached(tmp_path):
+    path = str(tmp_path / 'shared.cache')
+    cache = SharedCache(max_size=8, path=path, on_miss=lambda k: k * 2)
+    assert cache[21] == 42
+    cache.close()
+
+    cache = SharedCache(max_size=8, path=path)
+    assert cache[21] == 42
+    assert cache.miss_count == 1
+    cache.close()
+
+    # a different layout starts over
+    cache = SharedCache(max_size=16, path=path)
+    assert 21 not in cache
+
+    inner_func = CountingCallable()
+    func = cached(cache)(inner_func)
+    func('a', b='c')
+    func('a', b='c')
+    assert inner_func.call_count == 1
+    cache.close()
+
+
+@pytest.mark.skipif(not hasattr(__import__('os'), 'fork'),
+                    reason='requires fork')
+def test_shared_cache_across_processes():
+    import multiprocessing
+
+    ctx = multiprocessing.get_context('fork')
+    cache = SharedCache(max_size=64, slot_size=128)
+
+    def work(offset):
+        for i in range(20):
+            cache[offset + i] = offset + i
+        for i in range(20):
+            cache.get(offset + i)
+
+    procs = [ctx.Process(target=work, args=(i * 20,)) for i in range(3)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+
+    assert len(cache) > 0
+    assert all(cache[k] == k for k in list(cache))
+    assert cache.hit_count + cache.soft_miss_count >= 60
+
+
+def _test_linkage(dll, max_count=10000, prev_attr='prev', next_attr='next'):
     """A function to test basic invariants of doubly-linked lists (with
-    links made of Python lists).
+    links made of slotted objects).
 
     1. Test that the list is not longer than a certain length
-    2. That the forward links (indicated by `next_idx`) correspond to
-    the backward links (indicated by `prev_idx`).
+    2. That the forward links (indicated by `next_attr`) correspond to
+    the backward links (indicated by `prev_attr`).
 
     The `dll` parameter is the root/anchor link of the list.
     """
@@ -232,9 +1054,9 @@ def _test_linkage(dll, max_count=10000, prev_idx=0, next_idx=1):
         if prev is not None and cur is start:
             break
         prev = cur
-        cur = cur[next_idx]
-        if cur[prev_idx] is not prev:
-            raise Exception('prev_idx does not point to prev at i = %r' % i)
+        cur = getattr(cur, next_attr)
+        if getattr(cur, prev_attr) is not prev:
+            raise Exception('prev_attr does not point to prev at i = %r' % i)
         i += 1
 
     return True
@@ -256,6 +1078,146 @@ def test_cached_dec():
     return
 
 
+def test_make_cache_key():
+    import pickle
+    from boltons.cacheutils import make_cache_key
+
+    args = (1, 'a', None, 2.5)
+    assert make_cache_key(args, {}) is args
+    assert make_cache_key(('a',), {}) == 'a'
+    assert make_cache_key((1,), {}) == make_cache_key((1.0,), {})
+    assert make_cache_key((1,), {}, typed=True) != \
+        make_cache_key((1.0,), {}, typed=True)
+    assert make_cache_key((1,), {'b': 2}) != make_cache_key((1, 2), {})
+    assert make_cache_key((True,), {}) != make_cache_key((1,), {})
+    assert make_cache_key((1, False), {}) != make_cache_key((1, 0), {})
+
+    calls = []
+
+    @cached(LRU())
+    def echo(x):
+        calls.append(x)
+        return repr(x)
+
+    assert (echo(1), echo(True)) == ('1', 'True')
+    assert calls == [1, True]
+
+    obj = object()
+    key = make_cache_key((obj, 1), {})
+    assert hash(key) == hash((obj, 1))
+    assert type(key) is tuple  # identity hashes need no caching
+
+    kw_key = make_cache_key((1,), {'b': 2})
+    assert pickle.loads(pickle.dumps(kw_key)) == kw_key
+    with pytest.raises(TypeError):
+        hash(make_cache_key(([],), {}))
+
+
+def test_cached_dec_signature_keys():
+    lru = LRU()
+
+    @cached(lru)
+    def func(a, b=2, *, c=3):
+        return (a, b, c)
+
+    assert func(1) == func(1, 2) == func(1, b=2) == func(a=1) == (1, 2, 3)
+    assert len(lru) == 1
+    assert func(1, c=3) == (1, 2, 3)
+    assert func(1, 5) == func(1, b=5) == (1, 5, 3)
+    assert len(lru) == 3
+    with pytest.raises(TypeError):
+        func(1, a=1)
+    with pytest.raises(TypeError):
+        func(b=1)
+
+    # unhashable defaults are never trimmed from keys
+    unhashable_lru = LRU()
+
+    @cached(unhashable_lru)
+    def unhashable_default(a, b=[]):
+        return a
+
+    assert unhashable_default(1) == unhashable_default(1, b=()) == 1
+    assert len(unhashable_lru) == 2
+
+    # custom key functions see the original arguments
+    seen = []
+
+    def key_func(args, kwargs, typed=False):
+        seen.append((args, kwargs))
+        return repr((args, sorted(kwargs.items())))
+
+    cached(LRU(), key=key_func)(func)(1, b=2)
+    assert seen == [((1,), {'b': 2})]
+
+    class Thing:
+        def __init__(self):
+            self.cache = LRU()
+
+        @cachedmethod('cache')
+        def method(self, a, b=2):
+            return a + b
+
+    thing = Thing()
+    assert thing.method(1) == thing.method(1, b=2) == thing.method(a=1) == 3
+    assert len(thing.cache) == 1
+    assert Thing.method(thing, 1, 2) == 3
+
+
+def test_cached_dec_signature_trimming():
+    lru = LRU()
+
+    @cached(lru)
+    def func(a, b=2, c=None):
+        return (a, b, c)
+
+    # trailing arguments equal to their defaults are dropped, so
+    # func(1) hits without normalizing, and gets a plain key
+    assert func(1, 2, None) == func(1, c=None) == func(1) == (1, 2, None)
+    assert list(lru.keys()) == [1]
+    # only trailing ones, though
+    assert func(1, 2, 3) == func(1, c=3) == (1, 2, 3)
+    assert len(lru) == 2
+    # equal values of other types are kept, as typed keys tell them apart
+    assert func(1, 2.0) == (1, 2.0, None)
+    assert len(lru) == 3
+
+    typed_lru = LRU()
+
+    @cached(typed_lru, typed=True)
+    def typed_func(a, flag=1):
+        return flag
+
+    assert typed_func(1, True) is True
+    assert typed_func(1, 1) == typed_func(1) == 1
+    assert len(typed_lru) == 2
+
+    # extra positional arguments are left as-is
+    star_lru = LRU()
+
+    @cached(star_lru)
+    def star_func(a, b=2, *rest):
+        return (a, b) + rest
+
+    assert star_func(1, 2, 3) == (1, 2, 3)
+    assert star_func(1, 2) == star_func(1) == (1, 2)
+    assert len(star_lru) == 2
+
+    class Thing:
+        def __init__(self):
+            self.cache = LRU()
+
+        @cachedmethod('cache')
+        def method(self, a, b=2):
+            return a + b
+
+    thing = Thing()
+    assert thing.method(1, 2) == thing.method(1) == 3
+    assert [key[2:] for key in thing.cache] == [(1,)]
+    # bound objects hashed by identity still make plain tuple keys
+    assert type(next(iter(thing.cache))) is tuple
+
+
 def test_unscoped_cached_dec():
     lru = LRU()
     inner_func = CountingCallable()
@@ -299,6 +1261,400 @@ def test_callable_cached_dec():
     return
 
 
+def _run_in_threads(func, count=8):
+    import threading
+
+    results, errors = [], []
+
+    def _target():
+        try:
+            results.append(func())
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=_target) for _ in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, errors
+
+
+def test_cached_dec_hit_path():
+    # hits return early, before any of the miss path's setup
+    class RecordingStats:
+        def __init__(self):
+            self.hits, self.misses = [], []
+
+        def on_hit(self, key):
+            self.hits.append(key)
+
+        def on_miss_complete(self, key, elapsed):
+            self.misses.append(key)
+
+    stats = RecordingStats()
+    calls = []
+
+    @cached({}, stats=stats)
+    def func(a, b=None):
+        calls.append((a, b))
+        return b  # falsy results are hits, too
+
+    assert func(1) is None
+    assert func(1) is None
+    assert func(1, None) is None
+    assert func(a=1, b=None) is None
+    assert calls == [(1, None)]
+    assert len(stats.misses) == 1 and stats.hits == stats.misses * 3
+
+    class Thing:
+        def __init__(self):
+            self.cache = {}
+            self.calls = 0
+
+        @cachedmethod('cache', stats=stats)
+        def method(self, x=0):
+            self.calls += 1
+            return self.calls
+
+    thing = Thing()
+    assert thing.method() == thing.method(0) == thing.method(x=0) == 1
+    assert thing.calls == 1
+    assert len(stats.misses) == 2 and len(stats.hits) == 5
+
+
+def test_cached_dec_hit_skips_miss_setup(monkeypatch):
+    # a hit returns before the miss path wraps func for timing, or
+    # consults the negative cache
+    from boltons import cacheutils
+
+    timed = []
+    real_timed_call = cacheutils._timed_call
+
+    def recording_timed_call(func, key, on_miss_complete):
+        timed.append(key)
+        return real_timed_call(func, key, on_miss_complete)
+
+    monkeypatch.setattr(cacheutils, '_timed_call', recording_timed_call)
+    negative = NegativeCache(results=(None,))
+    replayed = []
+    real_replay = negative._replay
+    monkeypatch.setattr(negative, '_replay',
+                        lambda scope, key: replayed.append(key)
+                        or real_replay(scope, key))
+
+    @cached(LRU(), stats=CacheStats(), negative_cache=negative)
+    def func(x):
+        return x
+
+    class Thing:
+        def __init__(self):
+            self.cache = LRU()
+
+        @cachedmethod('cache', stats=CacheStats(), negative_cache=negative)
+        def method(self, x):
+            return x
+
+    thing = Thing()
+    for call in (func, thing.method):
+        del timed[:], replayed[:]
+        assert call(1) == 1
+        assert len(timed) == len(replayed) == 1
+        for _ in range(3):
+            assert call(1) == 1
+        assert len(timed) == len(replayed) == 1
+
+
+def test_cached_dec_early_hit_stats():
+    # early hits are still counted, once, and are never shadowed by
+    # the negative cache
+    stats = CacheStats()
+    negative = NegativeCache(results=(None,))
+    shared = LRU(stats=stats)
+
+    @cached({}, stats=stats, negative_cache=negative)
+    def func(x):
+        return x or None
+
+    @cached(shared, stats=stats, negative_cache=negative)
+    def shared_func(x):
+        return x
+
+    class Thing:
+        def __init__(self):
+            self.cache = {}
+
+        @cachedmethod('cache', stats=stats, negative_cache=negative)
+        def method(self, x):
+            return x or None
+
+    thing = Thing()
+    for call in (func, shared_func, thing.method):
+        assert call(1) == call(1) == call(1) == 1
+    assert stats.hit_count == 6
+    assert stats.miss_count == 3
+    assert negative.hit_count == 0 and negative.miss_count == 3
+
+    # negative results take the negative cache's path, as before
+    assert func(0) is None and func(0) is None
+    assert thing.method(0) is None and thing.method(0) is None
+    assert negative.hit_count == 2
+    assert stats.hit_count == 6 and stats.miss_count == 5
+
+
+def test_cached_dec_coalesce():
+    import time
+
+    lru = LRU()
+    call_count = [0]
+
+    @cached(lru, coalesce=True)
+    def slow(x):
+        call_count[0] += 1
+        time.sleep(0.1)
+        if x == 'bad':
+            raise ValueError(x)
+        return x * 2
+
+    results, errors = _run_in_threads(lambda: slow(21))
+    assert results == [42] * 8
+    assert not errors
+    assert call_count[0] == 1
+    assert len(slow._single_flight) == 0
+
+    results, errors = _run_in_threads(lambda: slow('bad'))
+    assert not results
+    assert len(errors) == 8
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert call_count[0] == 2
+    assert len(slow._single_flight) == 0
+    assert 'bad' not in lru
+
+
+def test_cachedmethod_coalesce():
+    import time
+
+    class Loader:
+        def __init__(self):
+            self.cache = LRU()
+            self.load_count = 0
+
+        @cachedmethod('cache', coalesce=True)
+        def load(self, name):
+            self.load_count += 1
+            time.sleep(0.1)
+            return name.upper()
+
+    loader = Loader()
+    results, errors = _run_in_threads(lambda: loader.load('x'))
+    assert results == ['X'] * 8
+    assert loader.load_count == 1
+    assert len(Loader.load._single_flight) == 0
+
+    # unscoped, instances with their own caches don't share calls
+    class Named:
+        def __init__(self, name):
+            self.cache = LRU()
+            self.name = name
+
+        @cachedmethod('cache', scoped=False, coalesce=True)
+        def get_name(self, x):
+            time.sleep(0.1)
+            return self.name
+
+    first, second = Named('a'), Named('b')
+    callers = [first, second] * 4
+
+    def call_next():
+        named = callers.pop()
+        return named.name, named.get_name(0)
+
+    results, errors = _run_in_threads(call_next)
+    assert sorted(results) == [('a', 'a')] * 4 + [('b', 'b')] * 4
+    assert dict(first.cache) == {0: 'a'}
+    assert dict(second.cache) == {0: 'b'}
+
+
+def test_cached_dec_async():
+    import asyncio
+    import inspect
+
+    lru = LRU()
+    call_count = [0]
+
+    @cached(lru)
+    async def slow_double(x):
+        call_count[0] += 1
+        await asyncio.sleep(0.01)
+        if x < 0:
+            raise ValueError(x)
+        return x * 2
+
+    async def main():
+        results = await asyncio.gather(*[slow_double(21) for _ in range(10)])
+        assert results == [42] * 10
+        assert call_count[0] == 1
+        assert await slow_double(21) == 42
+        assert call_count[0] == 1
+
+        errors = await asyncio.gather(*[slow_double(-1) for _ in range(3)],
+                                      return_exceptions=True)
+        assert all(isinstance(e, ValueError) for e in errors)
+        assert call_count[0] == 2
+        assert len(slow_double._single_flight) == 0
+
+    asyncio.run(main())
+    assert dict(lru) == {21: 42}
+    assert lru.hit_count == 1
+
+    # the wrapper is recognized as a coroutine function, on Python 3.12+
+    # by inspect, and by the marker asyncio uses before then, so that
+    # cached coroutine functions can be stacked
+    if hasattr(inspect, 'markcoroutinefunction'):
+        assert inspect.iscoroutinefunction(slow_double)
+    else:
+        assert asyncio.iscoroutinefunction(slow_double)
+    outer_lru = LRU()
+    stacked = cached(outer_lru)(slow_double)
+    assert asyncio.run(stacked(3)) == 6
+    assert dict(outer_lru) == {3: 6} and lru[3] == 6
+
+
+def test_cachedmethod_async():
+    import asyncio
+
+    class Fetcher:
+        def __init__(self):
+            self.cache = LRU()
+            self.fetch_count = 0
+
+        @cachedmethod('cache')
+        async def fetch(self, url):
+            self.fetch_count += 1
+            await asyncio.sleep(0.01)
+            return url.upper()
+
+    fetcher = Fetcher()
+
+    async def main():
+        results = await asyncio.gather(*[fetcher.fetch('a') for _ in range(5)])
+        assert results == ['A'] * 5
+
+    asyncio.run(main())
+    assert fetcher.fetch_count == 1
+    assert len(fetcher.cache) == 1
+    assert len(Fetcher.fetch._single_flight) == 0
+
+
+class ImmediateExecutor:
+    "Runs submitted calls right away, for deterministic tests."
+    def __init__(self):
+        self.submit_count = 0
+
+    def submit(self, func, *args, **kwargs):
+        self.submit_count += 1
+        func(*args, **kwargs)
+
+
+def test_cached_dec_stale_while_revalidate():
+    timer = FakeTimer()
+    executor = ImmediateExecutor()
+    results = iter([1, 2, ValueError('boom'), 3, 4])
+
+    def _next_result(x):
+        ret = next(results)
+        if isinstance(ret, Exception):
+            raise ret
+        return ret
+
+    stats = CacheStats()
+    lookup = cached(LRU(), soft_ttl=10, hard_ttl=60, executor=executor,
+                    stats=stats)(_next_result)
+    lookup._refresher.timer = timer
+
+    assert lookup('a') == 1
+    timer.now = 5
+    assert lookup('a') == 1
+    assert executor.submit_count == 0
+
+    # stale, returns the old value and refreshes in the background
+    timer.now = 15
+    assert lookup('a') == 1
+    assert executor.submit_count == 1
+    assert lookup('a') == 2
+
+    # failed refreshes keep the stale value, are reported, and are
+    # only retried after another soft_ttl
+    timer.now = 30
+    assert lookup('a') == 2
+    assert lookup('a') == 2
+    assert executor.submit_count == 2
+    assert stats.refresh_error_count == 1
+    assert str(stats.last_refresh_error) == 'boom'
+    timer.now = 40
+    assert lookup('a') == 2
+    assert executor.submit_count == 3
+    assert lookup('a') == 3
+
+    # past the hard ttl, callers wait for a fresh value
+    timer.now = 200
+    assert lookup('a') == 4
+    assert executor.submit_count == 3
+
+
+def test_cached_dec_stale_single_refresh():
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    timer = FakeTimer()
+    release = threading.Event()
+    call_count = [0]
+
+    def slow(x):
+        call_count[0] += 1
+        if call_count[0] > 1:
+            release.wait(5)
+        return call_count[0]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        func = cached(LRU(), soft_ttl=1, executor=executor)(slow)
+        func._refresher.timer = timer
+        assert func('x') == 1
+        timer.now = 2
+        # refreshes are not duplicated while one is in flight
+        assert [func('x') for _ in range(5)] == [1] * 5
+        release.set()
+    assert call_count[0] == 2
+    assert func('x') == 2
+
+
+def test_cachedmethod_stale_while_revalidate():
+    executor = ImmediateExecutor()
+
+    class Config:
+        def __init__(self):
+            self.cache = LRU()
+            self.version = 0
+
+        @cachedmethod('cache', soft_ttl=10, executor=executor)
+        def get_version(self):
+            self.version += 1
+            return self.version
+
+    timer = FakeTimer()
+    Config.get_version._refresher.timer = timer
+    config = Config()
+    assert config.get_version() == 1
+    timer.now = 11
+    assert config.get_version() == 1
+    assert config.get_version() == 2
+
+    with pytest.raises(TypeError):
+        cached(LRU(), hard_ttl=10)(lambda: None)
+    with pytest.raises(ValueError):
+        cached(LRU(), soft_ttl=10, hard_ttl=5)(lambda: None)
+
+
 def test_cachedmethod():
     class Car:
         def __init__(self, cache=None):
@@ -422,6 +1778,115 @@ def test_cachedproperty_maintains_func_abstraction():
         AbstractExpensiveCalculator()
 
 
+def test_threadsafe_cachedproperty():
+    import threading
+    import time
+
+    calls = []
+
+    class Loader:
+        @threadsafe_cachedproperty
+        def data(self):
+            "the data"
+            calls.append(self)
+            time.sleep(0.05)
+            return [id(self)]
+
+    loaders = [Loader(), Loader()]
+    results = []
+    threads = [threading.Thread(target=lambda l=l: results.append(l.data))
+               for l in loaders for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 2
+    assert sorted(map(id, results)) == sorted(
+        [id(l.data) for l in loaders for _ in range(8)])
+    assert Loader.data._instance_locks == {}
+    assert Loader.data.__doc__ == 'the data'
+
+    del loaders[0].data
+    loaders[0].data
+    assert len(calls) == 3
+
+    class Flaky:
+        attempts = 0
+
+        @threadsafe_cachedproperty
+        def value(self):
+            self.attempts += 1
+            if self.attempts == 1:
+                raise ValueError()
+            return 'ok'
+
+    flaky = Flaky()
+    with pytest.raises(ValueError):
+        flaky.value
+    assert flaky.value == 'ok'
+    assert Flaky.value._instance_locks == {}
+
+
+def test_async_cachedproperty():
+    import asyncio
+
+    calls = []
+
+    class Index:
+        attempts = 0
+
+        @async_cachedproperty
+        async def entries(self):
+            calls.append(self)
+            await asyncio.sleep(0.01)
+            return {'a': 1}
+
+        @async_cachedproperty
+        async def flaky(self):
+            self.attempts += 1
+            await asyncio.sleep(0)
+            if self.attempts == 1:
+                raise ValueError()
+            return 'ok'
+
+    async def main():
+        index = Index()
+        results = await asyncio.gather(*[index.entries for _ in range(5)])
+        assert results == [{'a': 1}] * 5
+        assert len(calls) == 1
+        assert await index.entries is results[0]
+
+        # cancelling one await leaves the shared task running
+        other = Index()
+        waiter = asyncio.ensure_future(asyncio.wait_for(other.entries, 0))
+        with pytest.raises(asyncio.TimeoutError):
+            await waiter
+        assert await other.entries == {'a': 1}
+        assert len(calls) == 2
+
+        del other.entries
+        await other.entries
+        assert len(calls) == 3
+
+        with pytest.raises(ValueError):
+            await index.flaky
+        assert await index.flaky == 'ok'
+
+        # assigned values replace the cached one, falsy ones included
+        index.entries = {'b': 2}
+        assert await index.entries == {'b': 2}
+        fresh = Index()
+        fresh.entries = None
+        assert await fresh.entries is None
+        assert len(calls) == 3
+        del fresh.entries
+        assert await fresh.entries == {'a': 1}
+        assert len(calls) == 4
+
+    asyncio.run(main())
+    assert isinstance(Index.entries, async_cachedproperty)
+
+
 def test_min_id_map():
     import sys
     if '__pypy__' in sys.builtin_module_names:
@@ -451,6 +1916,54 @@ def test_min_id_map():
     assert sorted(item[1] for item in items) == list(range(0, len(ref_wheel)))
 
 
+def test_strong_min_id_map():
+    import random
+    from boltons.cacheutils import _IDBitmap
+
+    idm = StrongMinIDMap()
+    assert idm.get_many('abc') == [0, 1, 2]
+    assert idm.get('b') == 1
+    idm.drop('b')
+    assert 'b' not in idm
+    with pytest.raises(KeyError):
+        idm.drop('b')
+    assert idm.get_many('dea') == [1, 3, 0]
+    idm.drop_many('acx')
+    assert sorted(idm.iteritems()) == [('d', 1), ('e', 3)]
+    assert idm.get_many('fgh') == [0, 2, 4]
+    assert len(idm) == 5 and sorted(idm) == list('defgh')
+    assert 'StrongMinIDMap' in repr(idm)
+    idm.clear()
+    assert len(idm) == 0 and idm.get('z') == 0
+
+    # ids stay unique and smallest-first under random churn, across
+    # several bitmap words
+    rng = random.Random(0)
+    idm = StrongMinIDMap()
+    live = set()
+    for i in range(5000):
+        if live and rng.random() < 0.45:
+            obj = rng.choice(sorted(live))
+            live.discard(obj)
+            idm.drop(obj)
+        else:
+            used = set(dict(idm.iteritems()).values())
+            expected = min(set(range(len(used) + 1)) - used)
+            assert idm.get(i) == expected
+            live.add(i)
+    ids = dict(idm.iteritems())
+    assert sorted(ids) == sorted(live)
+    assert len(set(ids.values())) == len(live)
+
+    bitmap = _IDBitmap()
+    for i in (200, 3, 64, 63):
+        bitmap.add(i)
+    assert 64 in bitmap and 65 not in bitmap and 10000 not in bitmap
+    assert [bitmap.pop_min() for _ in range(len(bitmap))] == [3, 63, 64, 200]
+    with pytest.raises(KeyError):
+        bitmap.pop_min()
+
+
 def test_threshold_counter():
     tc = ThresholdCounter(threshold=0.1)
     tc.add(1)
@@ -478,3 +1991,250 @@ def test_threshold_counter():
     assert sorted(tc.keys()) == [2, 5]
     assert sorted(tc.values()) == [1, 10]
     assert sorted(tc.items()) == [(2, 10), (5, 1)]
+
+
+def _zipf_stream(n, key_count, seed):
+    import random
+    rng = random.Random(seed)
+    weights = [1.0 / (i + 1) for i in range(key_count)]
+    return rng.choices(range(key_count), weights=weights, k=n)
+
+
+def test_space_saving_counter():
+    from collections import Counter
+
+    stream = _zipf_stream(20000, 5000, seed=1)
+    exact = Counter(stream)
+    ssc = SpaceSavingCounter(capacity=100)
+    ssc.update(stream)
+
+    assert len(ssc) == 100
+    assert ssc.total == len(stream)
+    bound = ssc.total / ssc.capacity
+    for key, count in ssc.items():
+        assert exact[key] <= count <= exact[key] + ssc.get_error(key)
+        assert ssc.get_error(key) <= bound
+    # every key seen more than total / capacity times is tracked
+    for key, count in exact.items():
+        if count > bound:
+            assert key in ssc
+    assert [k for k, _ in ssc.most_common(3)] == [0, 1, 2]
+    assert ssc.most_common(0) == []
+    assert len(ssc.most_common()) == 100
+    assert ssc.get('nope') == 0 and 'nope' not in ssc
+    assert 0 < ssc.get_commonality() <= 1
+    assert ssc.get_common_count() + ssc.get_uncommon_count() == ssc.total
+
+    ssc = SpaceSavingCounter(capacity=10)
+    ssc.update({'a': 3}, b=2)
+    ssc.add('a')
+    assert sorted(ssc.items()) == [('a', 4), ('b', 2)]
+    assert sorted(ssc.elements()) == ['a'] * 4 + ['b'] * 2
+
+    with pytest.raises(ValueError):
+        SpaceSavingCounter(capacity=0)
+    with pytest.raises(ValueError):
+        ssc.add('a', 0)
+
+
+def test_space_saving_counter_merge():
+    from collections import Counter
+
+    streams = [_zipf_stream(10000, 3000, seed=i) for i in range(3)]
+    counters = []
+    for stream in streams:
+        ssc = SpaceSavingCounter(capacity=50)
+        ssc.update(stream)
+        counters.append(ssc)
+    merged = counters[0]
+    for other in counters[1:]:
+        merged.merge(other)
+
+    exact = Counter()
+    for stream in streams:
+        exact.update(stream)
+    assert merged.total == sum(exact.values())
+    assert len(merged) == 50
+    bound = merged.total / merged.capacity
+    for key, count in merged.items():
+        assert exact[key] <= count <= exact[key] + merged.get_error(key)
+        assert merged.get_error(key) <= bound
+    for key, count in exact.items():
+        if count > bound:
+            assert key in merged
+    assert merged.most_common(1)[0][0] == 0
+
+    # merging into a counter that isn't full adds nothing extra
+    small = SpaceSavingCounter(capacity=10)
+    small.update('ab')
+    other = SpaceSavingCounter(capacity=10)
+    other.update('bc')
+    small.merge(other)
+    assert sorted(small.items()) == [('a', 1), ('b', 2), ('c', 1)]
+    assert small.get_error('a') == 0
+
+    with pytest.raises(TypeError):
+        small.merge(Counter('abc'))
+
+
+def test_lru_snapshot(tmp_path):
+    import io
+    path = tmp_path / 'cache.snapshot'
+    lru = LRU(max_size=4)
+    lru.update([('a', 1), ('b', 2), ('c', 3), ('d', 4)])
+    lru['a']
+    assert lru.save_snapshot(path) == 4
+    assert [p.name for p in tmp_path.iterdir()] == ['cache.snapshot']
+
+    new_lru = LRU(max_size=4)
+    assert new_lru.load_snapshot(str(path)) == 4
+    assert new_lru == lru
+    assert new_lru._get_flattened_ll() == lru._get_flattened_ll()
+    _test_linkage(new_lru._anchor, 5)
+
+    # a smaller cache keeps the most recent items
+    small = LRI(max_size=2)
+    assert small.load_snapshot(path) == 4
+    assert sorted(small.items()) == [('a', 1), ('d', 4)]
+
+    # loaded items are older than, and do not replace, existing ones
+    warm = LRU(max_size=3)
+    warm['b'] = 'live'
+    assert warm.load_snapshot(path) == 3
+    assert warm['b'] == 'live'
+    assert [k for k, _ in warm._get_flattened_ll()[1:]] == ['d', 'a', 'b']
+    warm['e'] = 5
+    assert 'd' not in warm
+
+    full = LRU(max_size=1, values={'z': 26})
+    assert full.load_snapshot(path) == 0
+    assert dict(full) == {'z': 26}
+
+    weighted = LRU(max_size=10, max_weight=7, weigher=lambda k, v: v)
+    weighted['x'] = 1
+    weighted.load_snapshot(path)
+    assert 'x' in weighted
+    assert weighted.total_weight <= 7
+    _test_linkage(weighted._anchor, len(weighted) + 1)
+
+    with pytest.raises(ValueError):
+        LRU().load_snapshot(io.BytesIO(__import__('pickle').dumps('nope')))
+
+
+def test_snapshot_cross_type(tmp_path):
+    caches = {'lri': LRI(), 'lru': LRU(), 'ttl': TTLCache(ttl=60),
+              'tlfu': TinyLFU(max_size=20)}
+    for name, cache in caches.items():
+        cache['a'], cache['b'] = 'A', 'B'
+        cache.save_snapshot(tmp_path / name)
+
+    # LRIs and LRUs share a record shape, so load each other's
+    assert LRU().load_snapshot(tmp_path / 'lri') == 2
+    assert LRI().load_snapshot(tmp_path / 'lru') == 2
+    assert NegativeCache().load_snapshot(tmp_path / 'ttl') == 2
+
+    for saved, loader in [('lru', lambda: TTLCache(ttl=60)),
+                          ('lru', lambda: TinyLFU(max_size=20)),
+                          ('ttl', LRU), ('tlfu', LRU), ('tlfu', LRI),
+                          ('ttl', lambda: TinyLFU(max_size=20))]:
+        cache = loader()
+        with pytest.raises(ValueError, match='cannot load a .* snapshot'
+                                             ' into a ') as exc_info:
+            cache.load_snapshot(tmp_path / saved)
+        assert type(cache).__name__ in str(exc_info.value)
+        assert len(cache) == 0
+
+
+def test_tiny_lfu_snapshot(tmp_path):
+    path = tmp_path / 'tlfu.snapshot'
+    cache = TinyLFU(max_size=20, window_ratio=0.1)
+    for i in range(20):
+        cache[i] = str(i)
+        for _ in range(i % 4):
+            cache[i]
+    assert cache.save_snapshot(path) == 20
+
+    new_cache = TinyLFU(max_size=20, window_ratio=0.1)
+    assert new_cache.load_snapshot(path) == 20
+    assert new_cache == cache
+    for name in ('_window', '_probation', '_protected'):
+        assert list(getattr(new_cache, name)) == list(getattr(cache, name))
+    # frequencies come along, so loaded keys aren't displaced by one-offs
+    for key in cache:
+        assert (new_cache._sketch.estimate(key)
+                >= min(cache._sketch.estimate(key), 15))
+    for i in range(100, 110):
+        new_cache[i] = i
+    assert len(set(new_cache) & set(cache)) >= 17
+
+    # loaded keys are older than existing ones, and only fill free room
+    warm = TinyLFU(max_size=20, window_ratio=0.1)
+    warm[0] = 'live'
+    warm['x'] = 'x'
+    # the window is full, and 0 is already cached
+    assert warm.load_snapshot(path) == 17
+    assert warm[0] == 'live'
+    assert len(warm) == 19
+    assert list(warm._window) == ['x', 0]
+
+
+def test_tiny_lfu_snapshot_partly_full(tmp_path):
+    path = tmp_path / 'tlfu.snapshot'
+    src = TinyLFU(max_size=100)
+    for i in range(100):
+        src[i] = i
+    for i in range(20, 100):
+        src[i]
+    assert len(src._protected) == 79
+    src.save_snapshot(path)
+
+    # more protected keys in the snapshot than the main segments can fit
+    cache = TinyLFU(max_size=100)
+    for i in range(1000, 1065):
+        cache[i] = i
+    for i in range(1000, 1005):
+        cache[i]
+    assert (len(cache._probation), len(cache._protected)) == (59, 5)
+    assert cache.load_snapshot(path) == 35
+    assert len(cache) <= cache.max_size
+    assert len(cache._window) <= cache._window_size
+    assert len(cache._protected) <= cache._protected_size
+    assert (len(cache._probation) + len(cache._protected)
+            <= cache._main_size)
+    segments = (cache._window, cache._probation, cache._protected)
+    assert sorted(k for seg in segments for k in seg) == sorted(cache)
+    for i in range(1000, 1065):
+        assert cache[i] == i
+
+
+def test_ttl_cache_snapshot(tmp_path):
+    path = tmp_path / 'ttl.snapshot'
+    timer = FakeTimer()
+    cache = TTLCache(ttl=10, timer=timer)
+    cache['a'] = 1
+    timer.now = 5
+    cache['b'] = 2
+    timer.now = 8
+    cache['c'] = 3
+    timer.now = 12  # 'a' has expired
+    assert cache.save_snapshot(path) == 2
+
+    # deadlines survive a restart, even with a different timer
+    new_timer = FakeTimer()
+    new_timer.now = 1000
+    new_cache = TTLCache(ttl=10, timer=new_timer)
+    new_cache['z'] = 26  # expires at 1010
+    assert new_cache.load_snapshot(path) == 2
+    assert [k for k, _ in new_cache._get_flattened_ll()[1:]] == ['b', 'c', 'z']
+    new_timer.now = 1004
+    assert new_cache.expire() == 1
+    assert sorted(new_cache) == ['c', 'z']
+    new_timer.now = 1007
+    assert new_cache.expire() == 1
+    assert list(new_cache) == ['z']
+
+    # shorter ttls are respected
+    short = TTLCache(ttl=1, timer=new_timer)
+    assert short.load_snapshot(path) == 2
+    new_timer.now = 1008
+    assert short.expire() == 2
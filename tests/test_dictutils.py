@@ -1,7 +1,7 @@
 import sys
 import pytest
 
-from boltons.dictutils import OMD, OneToOne, ManyToMany, FrozenDict, subdict, FrozenHashError
+from boltons.dictutils import OMD, FastIterOrderedMultiDict, CompactOrderedMultiDict, OneToOne, ManyToMany, IndexedRecords, FrozenDict, PersistentFrozenDict, subdict, FrozenHashError
 
 
 _ITEMSETS = [[],
@@ -308,6 +308,121 @@ def test_ior():
 
 ## END OMD TESTS
 
+def test_compact_omd():
+    import random
+
+    for items in _ITEMSETS:
+        comd = CompactOrderedMultiDict(items)
+        omd = OMD(items)
+        assert comd == omd
+        assert comd.items() == omd.items()
+        assert list(reversed(comd)) == list(reversed(omd))
+        assert comd.copy() == comd
+        assert type(comd.copy()) is CompactOrderedMultiDict
+
+    # random operations give the same results as on an OMD, including
+    # across compactions
+    rng = random.Random(0)
+    comd, omd = CompactOrderedMultiDict(), OMD()
+    for i in range(2000):
+        k, op = rng.randrange(10), rng.random()
+        for target in (comd, omd):
+            if op < 0.5:
+                target.add(k, i)
+            elif op < 0.6:
+                target[k] = i
+            elif op < 0.8:
+                target.poplast(k, None)
+            elif op < 0.9:
+                target.poplast(default=None)
+            else:
+                target.pop(k, None)
+        assert comd.items(multi=True) == omd.items(multi=True)
+        assert comd.items() == omd.items()
+        assert list(reversed(comd)) == list(reversed(omd))
+        assert comd.getlist(k) == omd.getlist(k)
+        assert len(comd._keys) <= 2 * len(omd.items(multi=True)) + 16
+
+    comd = CompactOrderedMultiDict((i % 3, i) for i in range(100))
+    for i in range(90):
+        comd.poplast(i % 3)
+    assert comd._tombstones < 16
+    assert comd.items(multi=True) == [(i % 3, i) for i in range(10)]
+    assert comd.poplast() == 9
+    # removing the last item needs no tombstone, others leave one,
+    # and trailing tombstones are trimmed right away
+    comd = CompactOrderedMultiDict([('a', 1), ('b', 2), ('a', 3), ('c', 4)])
+    assert comd.poplast() == 4
+    assert comd._tombstones == 0 and len(comd._keys) == 3
+    assert comd.poplast('b') == 2
+    assert comd._tombstones == 1 and len(comd._keys) == 3
+    assert comd.poplast('a') == 3
+    assert comd._tombstones == 0 and comd._keys == ['a']
+    comd.addlist('b', [5, 6])
+    comd.add('c', 7)
+    assert comd.popall('b') == [5, 6]
+    assert comd._tombstones == 2
+    assert comd.items(multi=True) == [('a', 1), ('c', 7)]
+    assert comd.popall('c') == [7]
+    assert comd._tombstones == 0 and comd._keys == ['a']
+
+    comd.clear()
+    assert not comd and comd.items(multi=True) == []
+    with pytest.raises(KeyError):
+        comd.poplast()
+
+
+def test_omd_from_pairs():
+    for omd_type in (OMD, FastIterOrderedMultiDict, CompactOrderedMultiDict):
+        for items in _ITEMSETS:
+            expected = omd_type(items)
+            omd = omd_type.from_pairs(iter(items))
+            assert type(omd) is omd_type
+            assert omd.items(multi=True) == expected.items(multi=True)
+            assert list(reversed(omd)) == list(reversed(expected))
+            assert omd.todict(multi=True) == expected.todict(multi=True)
+
+            omd.add('new', 1)
+            assert omd.poplast() == 1
+            assert omd.items(multi=True) == expected.items(multi=True)
+
+        # an unhashable key fails the build
+        with pytest.raises(TypeError):
+            omd_type.from_pairs([('a', 1), ([], 2), ('b', 3)])
+
+
+def test_omd_multi_views():
+    for omd_type in (OMD, FastIterOrderedMultiDict, CompactOrderedMultiDict):
+        omd = omd_type([('a', 1), ('b', 2), ('a', 3)])
+        keys = omd.viewkeys(multi=True)
+        values = omd.viewvalues(multi=True)
+        items = omd.viewitems(multi=True)
+        assert list(keys) == ['a', 'b', 'a']
+        assert list(values) == [1, 2, 3]
+        assert list(items) == [('a', 1), ('b', 2), ('a', 3)]
+        assert len(keys) == len(values) == len(items) == 3
+        assert 'a' in keys and 'c' not in keys
+        assert 3 in values and 4 not in values
+        assert ('a', 1) in items and ('a', 2) not in items
+        assert ('c', 1) not in items
+        # probes which can't be items are never found
+        assert 1 not in items and ('a',) not in items
+        assert ([], 1) not in items
+
+        # views are live
+        omd.add('c', 4)
+        omd.poplast('a')
+        assert list(items) == [('a', 1), ('b', 2), ('c', 4)]
+        assert len(keys) == 3 and 'c' in keys and 3 not in values
+        omd.clear()
+        assert len(items) == 0 and list(items) == [] and 'a' not in keys
+
+        # the default, single-valued views are unchanged
+        omd.update([('a', 1), ('a', 2)])
+        assert list(omd.viewitems()) == [('a', 2)]
+        assert len(omd.viewkeys()) == 1
+
+
 import string
 
 def test_subdict():
@@ -418,6 +533,94 @@ def test_many_to_many():
     assert repr(m2m).startswith('ManyToMany(') and 'B' in repr(m2m)
 
 
+def test_indexed_records():
+    import random
+
+    rng = random.Random(0)
+    records = IndexedRecords()
+    live = {}
+    for i in range(600):
+        if live and rng.random() < 0.3:
+            rid = rng.choice(sorted(live))
+            assert records.remove(rid) is live.pop(rid)
+            continue
+        record = {'id': i, 'color': rng.choice('rgb'), 'size': rng.randrange(20)}
+        if i % 7 == 0:
+            del record['size']
+        live[records.add(record)] = record
+        color, size = rng.choice('rgbx'), rng.randrange(20)
+        expected = [r for r in live.values() if r['color'] == color]
+        assert records.find(color=color) == expected
+        expected = [r for r in expected if r.get('size') == size]
+        assert records.find({'color': color}, size=size) == expected
+        expected = sorted((r for r in live.values() if 5 <= r.get('size', -1) < 10),
+                          key=lambda r: (r['size'], r['id']))
+        assert records.find_range('size', 5, 10) == expected
+    assert records.indexed_fields == ['color', 'size']
+    assert records.sorted_fields == ['size']
+    assert len(records) == len(live) and list(records) == list(live.values())
+    assert records.find() == list(live.values())
+    assert records.find_range('size', stop=1) == [r for r in live.values() if r.get('size') == 0]
+
+    scans = records.scan_count
+    records.find(color='r'), records.find_range('size', 3)
+    assert records.scan_count == scans
+    with pytest.raises(KeyError):
+        records.remove(-1)
+    records.clear()
+    assert len(records) == 0 and records.find(color='r') == []
+
+    # unhashable and unsortable values fall back to scanning
+    mixed = IndexedRecords([{'tags': ['a']}, {'tags': 'a', 'n': None}, {'n': 1}])
+    with pytest.raises(TypeError):
+        mixed.add_index('tags')
+    for _ in range(5):
+        assert mixed.find(tags='a') == [{'tags': 'a', 'n': None}]
+        assert mixed.find_range('n', 0) == [{'n': 1}]
+    assert mixed.indexed_fields == [] and mixed.sorted_fields == []
+    mixed.add_index('n')
+    mixed.add({'n': [1]})
+    assert mixed.indexed_fields == []
+
+    manual = IndexedRecords([{'a': i % 3} for i in range(10)], index_ratio=None)
+    for _ in range(5):
+        manual.find(a=1)
+    assert manual.indexed_fields == [] and manual.scan_count == 5
+    manual.add_index('a')
+    manual.add_index('a', sorted=True)
+    assert len(manual.find(a=1)) == 3 and manual.scan_count == 5
+    assert [r['a'] for r in manual.find_range('a', 1)] == [1] * 3 + [2] * 3
+    manual.drop_index('a')
+    assert manual.indexed_fields == [] and 'IndexedRecords' in repr(manual)
+
+    # scans of a larger collection don't carry over after it shrinks
+    shrunk = IndexedRecords([{'a': i} for i in range(10)])
+    shrunk.find(a=1)
+    for rid in range(5):
+        shrunk.remove(rid)
+    shrunk.find(a=7)
+    assert shrunk.indexed_fields == []
+    shrunk.find(a=7)
+    assert shrunk.indexed_fields == ['a']
+
+    # nor do scans from before a clear
+    cleared = IndexedRecords([{'a': i} for i in range(10)])
+    cleared.find(a=1), cleared.find(a=2)
+    cleared.clear()
+    cleared.extend({'a': i} for i in range(10))
+    cleared.find(a=1), cleared.find(a=2)
+    assert cleared.indexed_fields == []
+
+    # values which can't be compared with the range are skipped,
+    # whether or not the field has been indexed
+    listed = IndexedRecords([{'b': [1]}, {'b': [2]}])
+    for _ in range(4):
+        assert listed.find_range('b', 1, 3) == []
+        assert listed.find_range('b', stop=3) == []
+        assert listed.find_range('b', [2]) == [{'b': [2]}]
+    assert listed.sorted_fields == ['b']
+
+
 def test_frozendict():
     efd = FrozenDict()
     assert isinstance(efd, dict)
@@ -542,3 +745,58 @@ def test_frozendict_api():
 
     import copy
     assert copy.copy(fd) is fd
+
+
+def test_persistent_frozendict():
+    import copy
+    import pickle
+    import random
+
+    class Colliding:
+        # hashes like small ints, to force hash collisions
+        def __init__(self, val):
+            self.val = val
+
+        def __hash__(self):
+            return self.val % 3
+
+        def __eq__(self, other):
+            return isinstance(other, Colliding) and other.val == self.val
+
+    keys = list(range(-40, 40)) + [Colliding(i) for i in range(10)] + ['a', None]
+    rng = random.Random(0)
+    versions = [(PersistentFrozenDict(), {})]
+    for _ in range(500):
+        pfd, d = rng.choice(versions)
+        changes = {rng.choice(keys): rng.randrange(5) for _ in range(3)}
+        new_pfd, new_d = pfd.updated(changes), dict(d)
+        new_d.update(changes)
+        assert new_pfd == new_d and new_d == new_pfd
+        assert len(new_pfd) == len(new_d) and dict(new_pfd) == new_d
+        assert all(new_pfd.get(k, 'x') == new_d.get(k, 'x') for k in keys)
+        assert pfd == d  # earlier versions are unchanged
+        versions.append((new_pfd, new_d))
+
+    pfd = PersistentFrozenDict({'a': 1}, b=2)
+    assert pfd == FrozenDict(a=1, b=2) and pfd != {'a': 1}
+    assert hash(pfd) == hash(FrozenDict(pfd))
+    assert {pfd: 'ok'}[PersistentFrozenDict([('b', 2), ('a', 1)])] == 'ok'
+    assert pfd.updated() is pfd and pfd.updated(a=1) is pfd
+    assert pfd['a'] == 1 and 'b' in pfd and 'c' not in pfd
+    with pytest.raises(KeyError):
+        pfd['c']
+    with pytest.raises(TypeError):
+        pfd['c'] = 3
+    with pytest.raises(TypeError):
+        pfd.updated({}, {})
+    assert sorted(pfd.items()) == [('a', 1), ('b', 2)]
+    assert pickle.loads(pickle.dumps(pfd)) == pfd
+    assert copy.copy(pfd) is pfd
+    assert repr(PersistentFrozenDict(a=1)) == "PersistentFrozenDict({'a': 1})"
+    assert PersistentFrozenDict.fromkeys('ab', 0) == {'a': 0, 'b': 0}
+
+    unhashable = PersistentFrozenDict(a=['A'])
+    with pytest.raises(FrozenHashError):
+        hash(unhashable)
+    with pytest.raises(FrozenHashError):
+        hash(unhashable)  # the error is cached, too